@@ -1,63 +1,6 @@
-import time
-from typing import List
-
-from src import log
-from src.config import config
-from src.mode_parser.flow_parser import FlowParser
-from src.mode_parser.upload_block import Order, loadOrderSave, loadOrders
-from src.uploader.uploader import Uploader
-from src.utils.fileio import getFilesSortedByMtime
-
-
-def getOrderSave() -> (Order, str):
-    orderSavePaths = getFilesSortedByMtime(config.order_path)
-    if orderSavePaths:
-        orderSavePath = orderSavePaths.pop()
-        orderSave, mode = loadOrderSave(orderSavePath)
-        if not len(orderSave.getOutputFilePath()):
-            return orderSave, mode
-    return None, None
-
-
-def loadScript() -> (List[Order], str):
-    order: Order
-    mode: str
-    order, mode = getOrderSave()
-    if order:
-        log.debug("检测到失败的order_script记录，正在尝试恢复")
-        return [order], mode
-    else:
-        log.debug("尝试使用config中的order_script")
-        return loadOrders(config.script_path)
-
-
-def main():
-    mode: str
-    orders, mode = loadScript()
-    uploader = Uploader()
-
-    def flowParser(_orders: List[Order]):
-        flower = FlowParser()
-        while len(_orders):
-            _order = _orders.pop(0)
-            _order.ui.info("开始执行")
-            flower.append(_order)
-            uploader.append(_order)
-        time.sleep(0.5)
-        flower.close()
-
-    def randomParser():
-        pass
-
-    match mode.lower():
-        case "flow":
-            flowParser(orders)
-        case _:
-            log.warn(f"未知的处理模式: {mode}, 尝试使用默认模式: flow")
-            flowParser(orders)
-            pass
-    log.info("执行完毕")
-
-
+# 入口只在主进程中导入程序: 编码进程池在Windows上以spawn方式启动子进程, 子进程会以 __mp_main__ 重新执行本文件,
+# 如果在模块顶层导入 src.log / src.config, 每个子进程都会重新截断日志文件并加载整个程序
 if __name__ == '__main__':
+    from src.app import main
+
     main()
@@ -0,0 +1,148 @@
+import re
+from typing import List, Tuple, Optional, Set
+
+from src.utils.workflow import WorkFlowParser
+
+# 保存提示词文本的输入, SDXL的 CLIPTextEncodeSDXL 同时有 text_g 与 text_l
+TEXT_INPUTS = ("text", "text_g", "text_l", "prompt")
+# 文本由其它节点(Primitive、String等)提供时, 这些节点保存字符串的输入
+STRING_SOURCE_INPUTS = ("text", "string", "value", "prompt")
+
+_EXPLICIT_WEIGHT = re.compile(r"(?s)^(.*):\s*(-?\d+(?:\.\d+)?)\s*$")
+_PAREN_WEIGHT = 1.1
+
+
+def _parseGroup(text: str, pos: int, closing: str) -> Tuple[List[Tuple[str, float]], Optional[float], int]:
+    """
+    :return: (相对于该组的 (文本片段, 权重), 组内显式指定的权重, 结束位置)
+    """
+    pieces: List[Tuple[str, float]] = []
+    buf: List[str] = []
+
+    def flush():
+        if buf:
+            pieces.append(("".join(buf), 1.0))
+            buf.clear()
+
+    while pos < len(text):
+        c = text[pos]
+        if c == "\\" and pos + 1 < len(text):
+            buf.append(text[pos + 1])
+            pos += 2
+            continue
+        if c in "([":
+            flush()
+            inner, explicit, pos = _parseGroup(text, pos + 1, ")" if c == "(" else "]")
+            if explicit is None:
+                explicit = _PAREN_WEIGHT if c == "(" else 1 / _PAREN_WEIGHT
+            pieces.extend((piece, weight * explicit) for piece, weight in inner)
+            continue
+        if c == closing:
+            explicit = None
+            match = _EXPLICIT_WEIGHT.match("".join(buf))
+            if match:
+                buf[:] = [match.group(1)]
+                explicit = float(match.group(2))
+            flush()
+            return pieces, explicit, pos + 1
+        buf.append(c)
+        pos += 1
+
+    # 未闭合的括号视为在末尾闭合
+    flush()
+    return pieces, None, pos
+
+
+def parsePromptWeights(text: str) -> List[Tuple[str, float]]:
+    """
+    解析 comfyui / A1111 的权重语法: (tag) ×1.1, [tag] ÷1.1, (tag:1.3) 指定权重, \\( \\) 为普通括号
+    :return: 按逗号分隔的 (标签, 权重), 保持原顺序并去除重复的标签
+    """
+    pieces, _, _ = _parseGroup(text, 0, "")
+    tags: List[Tuple[str, float]] = []
+    seen: Set[str] = set()
+    for piece, weight in pieces:
+        for part in piece.split(","):
+            tag = part.strip()
+            if not tag or tag == "BREAK" or tag in seen:
+                continue
+            seen.add(tag)
+            tags.append((tag, round(weight, 4)))
+    return tags
+
+
+def _linkedString(wfp: WorkFlowParser, link: list) -> Optional[str]:
+    node = wfp.getNode(str(link[0]))
+    if not node:
+        return None
+    inputs = node.get("inputs", {})
+    for inputName in STRING_SOURCE_INPUTS:
+        value = inputs.get(inputName)
+        if isinstance(value, str):
+            return value
+        if _isLink(value):
+            return _linkedString(wfp, value)
+    return None
+
+
+def _isLink(value) -> bool:
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def _positiveTexts(wfp: WorkFlowParser, link: list, visited: Set[str], texts: List[str]):
+    """
+    沿着 conditioning 连接向上游查找文本编码节点
+    """
+    nodeID = str(link[0])
+    if nodeID in visited:
+        return
+    visited.add(nodeID)
+    node = wfp.getNode(nodeID)
+    if not node:
+        return
+    inputs = node.get("inputs", {})
+
+    found = False
+    for inputName in TEXT_INPUTS:
+        value = inputs.get(inputName)
+        if _isLink(value):
+            value = _linkedString(wfp, value)
+        if isinstance(value, str):
+            found = True
+            if value not in texts:
+                texts.append(value)
+    if found:
+        return
+
+    if "positive" in inputs and "negative" in inputs:
+        # ControlNetApplyAdvanced 等同时处理正负条件的节点, 输出0为正向条件
+        upstream = [inputs["positive"] if link[1] == 0 else inputs["negative"]]
+    else:
+        upstream = [value for inputName, value in inputs.items() if inputName != "clip"]
+    for value in upstream:
+        if _isLink(value):
+            _positiveTexts(wfp, value, visited, texts)
+
+
+def extractPositiveTags(promptGraph: dict) -> List[Tuple[str, float]]:
+    """
+    从实际执行的prompt中提取正向提示词: 从每个采样器的 positive 输入反向找到文本编码节点, 不包含负向提示词
+    :param promptGraph: 提交到comfyui的API格式工作流
+    :return: (标签, 权重)
+    """
+    wfp = WorkFlowParser()
+    wfp.loadWorkFlowDict(promptGraph)
+    texts: List[str] = []
+    for samplerID in wfp.findNodes(inputKey="positive"):
+        positive = wfp.getNode(samplerID)["inputs"]["positive"]
+        if _isLink(positive):
+            _positiveTexts(wfp, positive, {samplerID}, texts)
+
+    tags: List[Tuple[str, float]] = []
+    seen: Set[str] = set()
+    for text in texts:
+        for tag, weight in parsePromptWeights(text):
+            if tag not in seen:
+                seen.add(tag)
+                tags.append((tag, weight))
+    return tags
@@ -391,24 +391,31 @@ class Tagger:
         return r
 
 
-def parseImgTags(order: Order) -> Optional[TagAnalysisResult]:
+def _promptGraphTags(order: Order) -> List[str]:
+    """
+    每张图片实际执行的prompt中的正向提示词, 提交时已经由 extractPositiveTags 提取
+    """
+    tags: List[str] = []
+    logged: set = set()
+    for image in order.getImages():
+        weighted = order.promptTags.get(image.promptKey)
+        if not weighted:
+            continue
+        if image.promptKey not in logged:
+            logged.add(image.promptKey)
+            order.ui.debug(f"正向提示词[{image.promptKey}]: {weighted}")
+        tags.extend(tag for tag, _ in weighted if tag not in tags)
+    return tags
+
+
+def _taskInfoTags(order: Order) -> List[str]:
+    """
+    旧的提取方式: 收集comfyui节点输出中所有的text列表
+    """
     wfp = WorkFlowParser()
-
-    if not order.taskInfo:
-        log.error(f"提取order任务信息失败-输出为空:{order.taskInfo}")
-        return None
-
-    try:
-        taskInfoDump = json.dumps(order.taskInfo)
-    except json.JSONDecodeError as e:
-        order.ui.error(f"提取order任务信息失败:{order.taskInfo}, 错误信息: {e}")
-        return None
-    wfp.reloadWorkFlow(taskInfoDump)
-    try:
-        stringLists: List[List[str]] = wfp.getAllCustomKeyValueType("text", list)
-    except json.JSONDecodeError:
-        wfp.replace("NaN", "null")
-        stringLists: List[List[str]] = wfp.getAllCustomKeyValueType("text", list)
+    # taskInfo 已经是字典, 直接建立索引而不是序列化后再解析
+    wfp.loadWorkFlowDict(order.taskInfo)
+    stringLists: List[List[str]] = wfp.getAllCustomKeyValueType("text", list)
 
     strings: List[str] = []
     for stringList in stringLists:
@@ -419,6 +426,17 @@ def parseImgTags(order: Order) -> Optional[TagAnalysisResult]:
         split_tags = string.split(',')
         filtered_tags = [tag for tag in split_tags if tag]
         tags.extend(filtered_tags)
+    return tags
+
+
+def parseImgTags(order: Order) -> Optional[TagAnalysisResult]:
+    tags = _promptGraphTags(order)
+    if not tags:
+        if not order.taskInfo:
+            log.error(f"提取order任务信息失败-输出为空:{order.taskInfo}")
+            return None
+        order.ui.debug("没有可用的prompt记录, 从comfyui节点输出中提取提示词")
+        tags = _taskInfoTags(order)
 
     order.ui.debug(f"准备处理提示词: {tags}")
 
@@ -0,0 +1,113 @@
+import time
+from typing import List
+
+from src import log
+from src.config import config
+from src.mode_parser.flow_parser import FlowParser
+from src.mode_parser.order_graph import runChains
+from src.mode_parser.pipeline import Pipeline, Stage, SKIP
+from src.mode_parser.parallel import ParallelRunner
+from src.mode_parser.upload_block import Order, ScriptOptions, applyScriptOptions, loadOrderSave, loadOrders
+from src.uploader.uploader import Uploader
+from src.utils.fileio import getFilesSortedByMtime
+
+
+def getOrderSave() -> (Order, str):
+    orderSavePaths = getFilesSortedByMtime(config.order_path)
+    if orderSavePaths:
+        orderSavePath = orderSavePaths.pop()
+        orderSave, mode = loadOrderSave(orderSavePath)
+        if not len(orderSave.getOutputFilePath()):
+            return orderSave, mode
+    return None, None
+
+
+def loadScript() -> (List[Order], str, ScriptOptions):
+    order: Order
+    mode: str
+    order, mode = getOrderSave()
+    if order:
+        log.debug("检测到失败的order_script记录，正在尝试恢复")
+        return [order], mode, applyScriptOptions(order.scriptGlobal)
+    else:
+        log.debug("尝试使用config中的order_script")
+        return loadOrders(config.script_path)
+
+
+def main():
+    mode: str
+    orders, mode, options = loadScript()
+    uploader = Uploader()
+
+    def stages(flower: FlowParser, generateWorkers: int, postProcessWorkers: int, tagWorkers: int,
+               uploadWorkers: int) -> List[Stage]:
+        return [
+            Stage("generate", lambda _order, _: flower.generate(_order), generateWorkers),
+            Stage("post_process", lambda _order, _: flower.postProcess(_order), postProcessWorkers),
+            Stage("tag", lambda _order, _: uploader.tag(_order) or SKIP, tagWorkers),
+            # 按脚本顺序开始上传, 使用 %url% 的upload块会等待它依赖的upload块完成
+            Stage("upload", uploader.upload, uploadWorkers, ordered=True),
+        ]
+
+    def flowParser(_orders: List[Order]):
+        flower = FlowParser()
+        _orders = flower.scheduleOrders(_orders)
+        flower.warmUp(_orders)
+        if config.comfyui_pack_across_orders:
+            # 先把所有order中可以合并的Image装满批次一起生成, 再逐个后处理与上传
+            flower.generateAll(_orders)
+
+        def _run(_order: Order):
+            _order.ui.info("开始执行")
+            if config.comfyui_pack_across_orders:
+                flower.postProcess(_order)
+            else:
+                flower.append(_order)
+            uploader.append(_order)
+
+        # 只有使用 %url% 的upload块需要等待上一个upload块, 互不依赖的链同时执行
+        runChains(_orders, _run, config.pipeline_chain_workers)
+        time.sleep(0.5)
+        flower.close()
+
+    def pipelineParser(_orders: List[Order]):
+        flower = FlowParser()
+        _orders = flower.scheduleOrders(_orders)
+        flower.warmUp(_orders)
+        pipeline = Pipeline(stages(flower, config.pipeline_generate_workers, config.pipeline_post_process_workers,
+                                   config.pipeline_tag_workers, config.pipeline_upload_workers),
+                            config.pipeline_queue_size)
+        try:
+            pipeline.run(_orders)
+        finally:
+            time.sleep(0.5)
+            flower.close()
+
+    def parallelParser(_orders: List[Order]):
+        flower = FlowParser()
+        _orders = flower.scheduleOrders(_orders)
+        flower.warmUp(_orders)
+        runner = ParallelRunner(stages(flower, options.parallelGenerateWorkers, options.parallelPostProcessWorkers,
+                                       options.parallelTagWorkers, options.parallelUploadWorkers),
+                                options.parallelWorkers)
+        try:
+            runner.run(_orders)
+        finally:
+            time.sleep(0.5)
+            flower.close()
+
+    def randomParser():
+        pass
+
+    match mode.lower():
+        case "flow":
+            flowParser(orders)
+        case "pipeline":
+            pipelineParser(orders)
+        case "parallel":
+            parallelParser(orders)
+        case _:
+            log.warn(f"未知的处理模式: {mode}, 尝试使用默认模式: flow")
+            flowParser(orders)
+            pass
+    log.info("执行完毕")
@@ -1,9 +1,9 @@
 import json
 import os.path
 import sys
-from typing import List
+from typing import List, Dict, Any
 
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 
 version = 1
 _abs_path: str = os.getcwd()
@@ -42,10 +42,88 @@ class _Tagger(BaseModel):
     front_tags: list[str] = []
 
 
+class _ComfyuiServer(BaseModel):
+    address: str = "127.0.0.1:7860"
+    workflows: List[str] = []  # 该后端可以执行的workflow文件名称, 为空则可以执行全部
+
+
+class _ComfyuiSaveNode(BaseModel):
+    """
+    脚本要求压缩输出格式时，SaveImage节点被替换成的节点，默认为 WAS Node Suite 的 Image Save
+    """
+    class_type: str = "Image Save"
+    format_input: str = "extension"
+    quality_input: str = "quality"
+    inputs: Dict[str, Any] = {
+        "output_path": "[time(%Y-%m-%d)]",
+        "filename_prefix": "autoloader",
+        "filename_delimiter": "_",
+        "filename_number_padding": 4,
+        "filename_number_start": "false",
+        "dpi": 300,
+        "optimize_image": "true",
+        "lossless_webp": "false",
+        "overwrite_mode": "false",
+        "show_history": "false",
+        "show_history_by_prefix": "true",
+        "embed_workflow": "true",
+        "show_previews": "true",
+    }
+
+
+class _Comfyui(BaseModel):
+    servers: List[_ComfyuiServer] = [_ComfyuiServer()]
+    queue_poll_interval: float = 2.0
+    max_resubmit: int = 3
+    prefetch: int = 2  # 每个后端在正在执行的prompt之外预先排队的prompt数量, 0为关闭
+    pack_across_orders: bool = False  # flow模式下先将所有upload块中工作流相同的图片合并批次一起生成
+    adaptive_batch: bool = False  # 根据每张图片的耗时自动选择批次大小, 显存不足时自动减小
+    adaptive_max_batch: int = 16
+    schedule_by_model_set: bool = False  # 执行前将使用相同模型组合的upload块排在一起(%url%依赖的顺序不变), 开启后上传顺序可能与script不同
+    warm_up: bool = True  # 启动时提交一个1步采样的prompt, 让comfyui提前加载第一个工作流的模型
+    result_cache: bool = False  # 相同的最终工作流(包括种子)直接使用缓存的输出图片, 不再发送到comfyui
+    result_cache_max_mb: int = 2048  # 0为不限制
+    result_cache_max_age_days: float = 7.0  # 超过该天数未使用的缓存被淘汰, 0为不限制
+    workflow_cache_size: int = 64  # 内存中缓存的已解析工作流文件数量, 0为不缓存
+    reconnect_attempts: int = 10
+    reconnect_initial_delay: float = 1.0
+    reconnect_max_delay: float = 30.0
+    prompt_timeout: float = 0.0  # prompt开始执行后允许的最长秒数, 0为不限制(大批次可能执行很久, 停滞由node_stall_timeout检测)
+    node_stall_timeout: float = 600.0  # 执行中的prompt没有任何进度消息的最长秒数, 排队中的prompt超过该秒数后按/queue核对是否丢失, 0为不限制
+    stall_max_attempts: int = 2  # 停滞的prompt被中断后重新排队的最大次数
+    download_concurrency: int = 4
+    encode_executor: str = "thread"  # 图片编码使用的工作池: thread / process
+    encode_workers: int = 2
+    output_codec: str = "jpeg"  # 输出图片的编码方式: jpeg / passthrough / final
+    jpeg_quality: int = 95
+    websocket_output: bool = False  # 将SaveImage节点替换为SaveImageWebsocket, 直接通过websocket接收图片
+    save_node: _ComfyuiSaveNode = _ComfyuiSaveNode()
+
+    @field_validator("output_codec")
+    @classmethod
+    def _checkOutputCodec(cls, value: str) -> str:
+        # 与 src.utils.encoder.OutputCodec 的取值一致
+        if value.lower() not in ("jpeg", "passthrough", "final"):
+            raise ValueError(f"comfyui.output_codec 必须是 jpeg / passthrough / final: {value}")
+        return value.lower()
+
+
+class _Pipeline(BaseModel):
+    queue_size: int = 2  # 相邻阶段之间最多等待的order数量
+    generate_workers: int = 1
+    post_process_workers: int = 2
+    tag_workers: int = 1  # tag分析失败时需要在控制台确认是否重试, 通常保持为1
+    upload_workers: int = 2  # 使用 %url% 的upload块仍会等待它依赖的upload块
+    chain_workers: int = 1  # flow模式下同时执行的互不依赖的upload块链数量, 1为按顺序执行
+    parallel_workers: int = 4  # parallel模式下同时执行的order数量, 可以在script的global.parallel中覆盖
+
+
 class Configuration(BaseModel):
     base: _Base = _Base()
     uploader: _Uploader = _Uploader()
     tagger: _Tagger = _Tagger()
+    comfyui: _Comfyui = _Comfyui()
+    pipeline: _Pipeline = _Pipeline()
     http_proxy: str = "http://127.0.0.1:4275"
 
 
@@ -80,6 +158,41 @@ class Config:
         self.unifans_account_id = configuration.uploader.unifans_account_id
         self.unifans_scheme_ids = configuration.uploader.unifans_scheme_ids
 
+        self.comfyui_servers: List[_ComfyuiServer] = configuration.comfyui.servers
+        self.comfyui_queue_poll_interval: float = configuration.comfyui.queue_poll_interval
+        self.comfyui_max_resubmit: int = configuration.comfyui.max_resubmit
+        self.comfyui_prefetch: int = max(0, configuration.comfyui.prefetch)
+        self.comfyui_pack_across_orders: bool = configuration.comfyui.pack_across_orders
+        self.comfyui_adaptive_batch: bool = configuration.comfyui.adaptive_batch
+        self.comfyui_adaptive_max_batch: int = max(1, configuration.comfyui.adaptive_max_batch)
+        self.comfyui_schedule_by_model_set: bool = configuration.comfyui.schedule_by_model_set
+        self.comfyui_warm_up: bool = configuration.comfyui.warm_up
+        self.comfyui_result_cache: bool = configuration.comfyui.result_cache
+        self.comfyui_result_cache_max_mb: int = max(0, configuration.comfyui.result_cache_max_mb)
+        self.comfyui_result_cache_max_age_days: float = max(0.0, configuration.comfyui.result_cache_max_age_days)
+        self.comfyui_workflow_cache_size: int = max(0, configuration.comfyui.workflow_cache_size)
+        self.comfyui_reconnect_attempts: int = configuration.comfyui.reconnect_attempts
+        self.comfyui_reconnect_initial_delay: float = configuration.comfyui.reconnect_initial_delay
+        self.comfyui_reconnect_max_delay: float = configuration.comfyui.reconnect_max_delay
+        self.comfyui_prompt_timeout: float = configuration.comfyui.prompt_timeout
+        self.comfyui_node_stall_timeout: float = configuration.comfyui.node_stall_timeout
+        self.comfyui_stall_max_attempts: int = configuration.comfyui.stall_max_attempts
+        self.comfyui_download_concurrency: int = configuration.comfyui.download_concurrency
+        self.comfyui_encode_executor: str = configuration.comfyui.encode_executor
+        self.comfyui_encode_workers: int = configuration.comfyui.encode_workers
+        self.comfyui_output_codec: str = configuration.comfyui.output_codec.lower()
+        self.comfyui_jpeg_quality: int = configuration.comfyui.jpeg_quality
+        self.comfyui_websocket_output: bool = configuration.comfyui.websocket_output
+        self.comfyui_save_node: _ComfyuiSaveNode = configuration.comfyui.save_node
+
+        self.pipeline_queue_size: int = max(1, configuration.pipeline.queue_size)
+        self.pipeline_generate_workers: int = max(1, configuration.pipeline.generate_workers)
+        self.pipeline_post_process_workers: int = max(1, configuration.pipeline.post_process_workers)
+        self.pipeline_tag_workers: int = max(1, configuration.pipeline.tag_workers)
+        self.pipeline_upload_workers: int = max(1, configuration.pipeline.upload_workers)
+        self.pipeline_chain_workers: int = max(1, configuration.pipeline.chain_workers)
+        self.pipeline_parallel_workers: int = max(1, configuration.pipeline.parallel_workers)
+
         self.http_proxy = configuration.http_proxy
         self.proxies = {
             "http": self.http_proxy,
@@ -93,6 +206,9 @@ class Config:
         self.output_path: str = os.path.join(self.abs_path, "data\\outputs")
 
         self.workflow_path: str = os.path.join(self.abs_path, "data\\workflow")
+        self.batch_tuner_path: str = os.path.join(self.abs_path, "data\\batch_tuner.json")
+        self.result_cache_path: str = os.path.join(self.abs_path, "data\\cache")
+        self.salt_path: str = os.path.join(self.abs_path, "data\\salt.json")
         self.workflow_name_sfw_name: str = "default_sfw.json"
         self.workflow_name_nsfw_censored_name: str = "default_nsfw_censored.json"
         self.workflow_name_nsfw_name: str = "default_nsfw.json"
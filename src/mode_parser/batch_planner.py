@@ -0,0 +1,169 @@
+import json
+import random
+from typing import List, Dict, Optional, Callable
+
+from src.mode_parser.upload_block import Order, Image
+from src.utils.hasher import hashMixSalt
+
+
+class BatchKey:
+    """
+    只有该键相同的Image才能放进同一个comfyui批次: 工作流、固定种子节点及其种子、输出格式、扫描参数都必须一致,
+    设置了 uniform_string 的order派生的种子与upload块有关, 只与自己的Image合并批次
+    """
+
+    def __init__(self, workflowName: str, fixedNodeSeedNames: tuple, fixedSeed: Optional[int],
+                 outputFormat: str, outputQuality: int, params: str = "", seedSource: tuple = ()):
+        self.workflowName = workflowName
+        self.fixedNodeSeedNames = fixedNodeSeedNames
+        self.fixedSeed = fixedSeed  # 没有固定种子节点时种子不影响结果, 为None
+        self.outputFormat = outputFormat
+        self.outputQuality = outputQuality
+        self.params = params  # 参数扫描组合的规范化JSON, 没有扫描时为空
+        self.seedSource = seedSource  # (uniform_string, upload块序号), 种子随机时为空
+
+    def _tuple(self) -> tuple:
+        return (self.workflowName, self.fixedNodeSeedNames, self.fixedSeed, self.outputFormat, self.outputQuality,
+                self.params, self.seedSource)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BatchKey) and self._tuple() == other._tuple()
+
+    def __hash__(self) -> int:
+        return hash(self._tuple())
+
+    def __repr__(self) -> str:
+        return f"BatchKey{self._tuple()}"
+
+
+class PlannedBatch:
+    def __init__(self, key: BatchKey, order: Order, fixedSeed: int, seedIndex: int = 0):
+        self.key = key
+        self.order = order  # 提供批次设置(固定种子节点、输出格式)的order, 同一批次中所有order的这些设置都相同
+        self.fixedSeed = fixedSeed
+        self.seedIndex = seedIndex  # 由 uniform_string 派生种子时使用的图片序号
+        self.members: List[tuple[Order, Image]] = []  # 顺序与comfyui输出图片的顺序一致
+
+    def size(self) -> int:
+        return len(self.members)
+
+    def orders(self) -> List[Order]:
+        ls: List[Order] = []
+        for order, _ in self.members:
+            if order not in ls:
+                ls.append(order)
+        return ls
+
+
+def orderSeed(order: Order) -> int:
+    """
+    order的固定种子: 有 uniform_string 时由其加盐哈希得到, 否则随机
+    """
+    if order.ui.workflowUniformString:
+        return hashMixSalt(order.ui.workflowUniformString)
+    return random.randint(0, 2 ** 63 - 1)
+
+
+def _fixedNodeSeedNames(order: Order) -> tuple:
+    return tuple(str(name) for name in order.ui.workflowFixedNodeSeedNames or []
+                 if isinstance(name, (str, int)))
+
+
+def paramsKey(image: Image) -> str:
+    return json.dumps(image.params, sort_keys=True, ensure_ascii=False) if image.params else ""
+
+
+def imageSeedIndex(image: Image) -> int:
+    """
+    派生种子使用的图片序号: 参数扫描的各组合使用相同的种子序列, 生成的图片之间只有扫描的参数不同
+    """
+    return image.sweepIndex if image.params else image.getIndex()
+
+
+def _chunks(members: List[tuple[Order, Image]], size: int, aligned: bool) -> List[List[tuple[Order, Image]]]:
+    """
+    按批次大小切分; aligned 时批次边界对齐到图片序号的整数倍, 恢复时只剩部分Image也得到与首次运行相同的批次
+    """
+    chunks: List[List[tuple[Order, Image]]] = []
+    for member in members:
+        if (not chunks or len(chunks[-1]) >= size
+                or aligned and imageSeedIndex(member[1]) // size != imageSeedIndex(chunks[-1][0][1]) // size):
+            chunks.append([])
+        chunks[-1].append(member)
+    return chunks
+
+
+def planBatches(orders: List[Order], batchSize: Optional[Callable[[BatchKey, int], int]] = None) -> List[PlannedBatch]:
+    """
+    将多个order中所有活动的Image按照 BatchKey 分组并装满批次
+    每组的批次大小取组内order的 batch 的最小值，保证不会超过任何一个order所允许的显存占用，
+    不满一个批次的剩余Image合并为一个较小的批次发送，而不是逐张发送
+    参数扫描中不同组合的Image无法放进同一批次, 各组合按顺序相邻排列, comfyui可以复用未改变的上游节点的缓存
+    :param batchSize: (分组, 脚本中的批次大小) -> 实际使用的批次大小, 用于自适应批次
+    :return: 按分组首次出现的顺序排列的批次
+    """
+    groups: Dict[BatchKey, List[tuple[Order, Image]]] = {}
+    groupBatch: Dict[BatchKey, int] = {}
+    groupOrder: Dict[BatchKey, Order] = {}
+    groupSeed: Dict[BatchKey, int] = {}
+
+    for order in orders:
+        seed = orderSeed(order)
+        fixedNodeSeedNames = _fixedNodeSeedNames(order)
+        seedSource = (order.ui.workflowUniformString, order.ui._uploadIndex) if order.ui.workflowUniformString else ()
+        for image in order.sortByActive():
+            key = BatchKey(
+                image.workflowName,
+                fixedNodeSeedNames,
+                seed if fixedNodeSeedNames else None,
+                (order.ui.workflowOutputFormat or "").lower(),
+                order.ui.workflowOutputQuality,
+                paramsKey(image),
+                seedSource,
+            )
+            if key not in groups:
+                groups[key] = []
+                groupBatch[key] = max(1, order.ui.batch)
+                groupOrder[key] = order
+                groupSeed[key] = seed
+            else:
+                groupBatch[key] = min(groupBatch[key], max(1, order.ui.batch))
+            groups[key].append((order, image))
+
+    batches: List[PlannedBatch] = []
+    for key, members in groups.items():
+        size = max(1, batchSize(key, groupBatch[key])) if batchSize else groupBatch[key]
+        for chunk in _chunks(members, size, bool(key.seedSource)):
+            batch = PlannedBatch(key, groupOrder[key], groupSeed[key], imageSeedIndex(chunk[0][1]))
+            batch.members = chunk
+            batches.append(batch)
+    return batches
+
+
+def splitBatch(batch: PlannedBatch, size: int) -> List[PlannedBatch]:
+    """
+    将一个批次拆分为多个不超过size的批次, 用于显存不足后重试
+    """
+    ls: List[PlannedBatch] = []
+    for start in range(0, batch.size(), max(1, size)):
+        part = PlannedBatch(batch.key, batch.order, batch.fixedSeed, batch.seedIndex + start)
+        part.members = batch.members[start:start + max(1, size)]
+        ls.append(part)
+    return ls
+
+
+def groupByModelSet(batches: List[PlannedBatch], modelSet: Callable[[str], tuple],
+                    loaded: Optional[tuple] = None) -> List[PlannedBatch]:
+    """
+    将使用相同模型组合的批次排在一起, 减少comfyui切换checkpoint/LoRA/VAE的次数
+    模型组合按首次出现的顺序执行(当前已加载的组合最先), 同一组合内保持原有顺序,
+    因此每个order自己的批次仍然按原顺序执行
+    :param modelSet: 工作流名称 -> 模型组合
+    :param loaded: comfyui当前已加载的模型组合
+    """
+    groups: Dict[tuple, List[PlannedBatch]] = {}
+    if loaded is not None:
+        groups[loaded] = []
+    for batch in batches:
+        groups.setdefault(modelSet(batch.key.workflowName), []).append(batch)
+    return [batch for group in groups.values() for batch in group]
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Any
+
+from src import log
+from src.config import config
+
+# 新测量值在每张图片耗时的滑动平均中所占的权重
+_SMOOTHING = 0.3
+
+
+def workflowHash(workflowName: str) -> str:
+    """
+    工作流文件内容的sha256，更换模型或分辨率后工作流内容改变，会重新学习批次大小
+    """
+    hasher = hashlib.sha256()
+    with open(os.path.join(config.workflow_path, workflowName), mode="rb") as f:
+        hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+class BatchTuner:
+    """
+    根据每个工作流在不同批次大小下的每张图片耗时，寻找吞吐量最高的批次大小
+
+    从脚本中的 batch 开始, 每次在当前最优值与更大的值之间试探(翻倍或取与已测量的更大值的中点),
+    comfyui报告显存不足时记录上限并减半重试, 学习结果按工作流哈希保存在磁盘上
+
+    表结构: {哈希: {"workflow": 名称, "ceiling": 显存上限(0为未知), "samples": {批次大小: {"seconds_per_image", "count"}}}}
+    """
+
+    def __init__(self, path: str, maxBatch: int):
+        self._path = path
+        self._maxBatch = max(1, maxBatch)
+        self._lock = threading.Lock()
+        self._table: Dict[str, Dict[str, Any]] = self._load()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if not os.path.isfile(self._path):
+            return {}
+        try:
+            with open(self._path, mode="r", encoding="utf-8") as f:
+                table = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            log.warn(f"读取批次大小记录失败, 将重新学习: {self._path}, {e}")
+            return {}
+        return table if isinstance(table, dict) else {}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(self._path, mode="w", encoding="utf-8") as f:
+                json.dump(self._table, f, ensure_ascii=False, indent=4)
+        except OSError as e:
+            log.warn(f"保存批次大小记录失败: {self._path}, {e}")
+
+    def _entry(self, workflowName: str) -> Dict[str, Any]:
+        key = workflowHash(workflowName)
+        entry = self._table.setdefault(key, {"workflow": workflowName, "ceiling": 0, "samples": {}})
+        entry["workflow"] = workflowName
+        return entry
+
+    def _ceiling(self, entry: Dict[str, Any]) -> int:
+        return min(entry["ceiling"] or self._maxBatch, self._maxBatch)
+
+    def suggest(self, workflowName: str, requested: int) -> int:
+        """
+        :param workflowName: 工作流文件名称
+        :param requested: 脚本中设置的批次大小, 没有任何测量值时使用
+        :return: 本次应使用的批次大小
+        """
+        with self._lock:
+            entry = self._entry(workflowName)
+            ceiling = self._ceiling(entry)
+            samples = {int(size): sample for size, sample in entry["samples"].items() if int(size) <= ceiling}
+            if not samples:
+                return max(1, min(requested, ceiling))
+
+            best = min(samples, key=lambda size: samples[size]["seconds_per_image"])
+            larger = [size for size in samples if size > best]
+            candidate = (best + min(larger)) // 2 if larger else min(best * 2, ceiling)
+            if candidate > best and candidate not in samples:
+                log.debug(f"{workflowName} 当前最优批次 {best}, 试探批次 {candidate}")
+                return candidate
+            return best
+
+    def record(self, workflowName: str, batchSize: int, seconds: float):
+        """
+        记录一个批次的执行耗时(不含排队时间)
+        """
+        if batchSize <= 0 or seconds <= 0:
+            return
+        secondsPerImage = seconds / batchSize
+        with self._lock:
+            entry = self._entry(workflowName)
+            sample = entry["samples"].get(str(batchSize))
+            if sample:
+                sample["seconds_per_image"] += (secondsPerImage - sample["seconds_per_image"]) * _SMOOTHING
+                sample["count"] += 1
+            else:
+                entry["samples"][str(batchSize)] = {"seconds_per_image": secondsPerImage, "count": 1}
+            self._save()
+        log.debug(f"{workflowName} 批次 {batchSize} 每张图片耗时 {secondsPerImage:.2f}s")
+
+    def recordOutOfMemory(self, workflowName: str, batchSize: int) -> int:
+        """
+        记录显存不足，此后不再尝试该批次及更大的批次
+        :return: 重试时使用的批次大小
+        """
+        with self._lock:
+            entry = self._entry(workflowName)
+            ceiling = max(1, batchSize - 1)
+            entry["ceiling"] = min(entry["ceiling"] or ceiling, ceiling)
+            for size in list(entry["samples"]):
+                if int(size) > entry["ceiling"]:
+                    del entry["samples"][size]
+            self._save()
+        retry = max(1, batchSize // 2)
+        log.warn(f"{workflowName} 批次 {batchSize} 显存不足, 上限调整为 {entry['ceiling']}, 使用批次 {retry} 重试")
+        return retry
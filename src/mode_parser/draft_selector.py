@@ -0,0 +1,98 @@
+from typing import List, Dict
+
+from PIL import Image, ImageFilter, ImageStat
+
+from src import log
+from src.utils.workflow import WorkFlowParser
+
+# 两张草稿的平均哈希相差不超过该位数时视为重复
+_DUPLICATE_DISTANCE = 5
+
+
+def _averageHash(path: str) -> int:
+    with Image.open(path) as img:
+        small = img.convert("L").resize((8, 8))
+    pixels = list(small.getdata())
+    mean = sum(pixels) / len(pixels)
+    value = 0
+    for pixel in pixels:
+        value = (value << 1) | (pixel > mean)
+    return value
+
+
+def _sharpness(path: str) -> float:
+    """
+    边缘图的方差, 模糊、崩坏或几乎纯色的草稿得分较低
+    """
+    with Image.open(path) as img:
+        edges = img.convert("L").filter(ImageFilter.FIND_EDGES)
+    return ImageStat.Stat(edges).var[0]
+
+
+def rankDrafts(paths: List[str], method: str) -> List[int]:
+    """
+    对草稿排序, 完整工作流按顺序取前number张
+    all: 保持生成顺序
+    dedupe: 排除与前面的草稿重复的草稿以及读取失败的草稿
+    score: 按清晰度从高到低
+    :return: 草稿下标, all / score 中读取失败的草稿排在最后
+    """
+    method = method.lower()
+    valid: List[int] = []
+    broken: List[int] = []
+    for index, path in enumerate(paths):
+        (valid if path else broken).append(index)
+
+    if method == "all":
+        return valid + broken
+
+    if method == "dedupe":
+        kept: List[int] = []
+        duplicates: List[int] = []
+        hashes: List[int] = []
+        for index in valid:
+            try:
+                value = _averageHash(paths[index])
+            except OSError as e:
+                log.warn(f"读取草稿失败: {paths[index]}, {e}")
+                broken.append(index)
+                continue
+            if any(bin(value ^ other).count("1") <= _DUPLICATE_DISTANCE for other in hashes):
+                duplicates.append(index)
+                continue
+            hashes.append(value)
+            kept.append(index)
+        log.info(f"草稿去重: {len(kept)} 张保留, {len(duplicates)} 张重复")
+        return kept
+
+    if method == "score":
+        scores = {}
+        for index in valid:
+            try:
+                scores[index] = _sharpness(paths[index])
+            except OSError as e:
+                log.warn(f"读取草稿失败: {paths[index]}, {e}")
+                broken.append(index)
+        ranked = sorted(scores, key=lambda i: scores[i], reverse=True)
+        log.debug(f"草稿得分: {[round(scores[i], 1) for i in ranked]}")
+        return ranked + broken
+
+    log.error(f"不支持的草稿选择方式: {method}, 保持生成顺序")
+    return valid + broken
+
+
+def applyDraft(wfp: WorkFlowParser, seeds: Dict[str, int], batchSize: int, batchIndex: int) -> List[str]:
+    """
+    让完整工作流以草稿的种子、批次大小与批次位置执行, 得到与选中的草稿相同的构图
+    :return: 设置了种子的节点ID
+    :raise ValueError: 完整工作流中没有草稿的任何种子节点, 执行结果与草稿无关
+    """
+    applied = wfp.setNodeInputs("seed", seeds)
+    if seeds and not applied:
+        raise ValueError(f"完整工作流中没有草稿的种子节点{sorted(seeds)}, 需要保留草稿工作流中基础采样部分的节点ID")
+    missing = sorted(set(seeds) - set(applied))
+    if missing:
+        log.warn(f"完整工作流中缺少草稿的种子节点{missing}, 这些节点的种子与草稿不同")
+    wfp.setAllCustomKeyValue("batch_size", lambda: batchSize)
+    wfp.insertLatentFromBatch(batchIndex)
+    return applied
@@ -1,19 +1,47 @@
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
 import random
-from typing import List
+from collections import deque
+from typing import List, Deque, Optional, Dict, Callable, Any
 
+from src import log
+from src.aigc.prompt_extractor import extractPositiveTags
 from src.config import config
+from src.mode_parser.batch_planner import PlannedBatch, BatchKey, planBatches, splitBatch, groupByModelSet, orderSeed
+from src.mode_parser.batch_tuner import BatchTuner
+from src.mode_parser.draft_selector import rankDrafts, applyDraft
 from src.mode_parser.media_post_processor import extraImgPostProcess
+from src.mode_parser.order_graph import groupChainsByModelSet
+from src.mode_parser.result_cache import ResultCache, workflowKey
+from src.socket.comfyui_client import WEBSOCKET_OUTPUT_NODE, ComfyuiExecutionError
 from src.socket.websockets_api import Comfyui
 from src.mode_parser.upload_block import Order, Image
 from src.utils.fileio import makeSuffixDirs
-from src.utils.hasher import hashMixSalt
-from src.utils.workflow import WorkFlowParser
+from src.utils.hasher import deriveSeed
+from src.utils.workflow import WorkFlowParser, workflowCache
+
+
+# 草稿去重后数量不足时, 最多追加生成草稿的次数
+_MAX_EXTRA_DRAFT_ROUNDS = 2
 
 
 class FlowParser:
     def __init__(self):
         self._websocket: Comfyui = Comfyui()
-        self._wfp: WorkFlowParser = WorkFlowParser()
+        self._tuner: Optional[BatchTuner] = None
+        self._cache: Optional[ResultCache] = None
+        if config.comfyui_result_cache:
+            self._cache = ResultCache(config.result_cache_path, config.comfyui_result_cache_max_mb * 1024 * 1024,
+                                      config.comfyui_result_cache_max_age_days * 24 * 3600)
+        self._modelSets: Dict[str, tuple] = {}
+        self._loadedModelSet: Optional[tuple] = None  # 最近一次提交的批次使用的模型组合
+        if config.comfyui_adaptive_batch:
+            self._tuner = BatchTuner(config.batch_tuner_path, config.comfyui_adaptive_max_batch)
+        if config.comfyui_workflow_cache_size:
+            log.debug(f"已预加载 {workflowCache.warm(config.workflow_path)} 个工作流")
 
     def close(self):
         self._websocket.close()
@@ -24,84 +52,324 @@ class FlowParser:
         # makeSuffixDirs(config.output_path, "_reviewed")
         return saveDirPath
 
-    def _setWorkFlowBatch(self, batch: int):
-        self._wfp.setAllCustomKeyValue("batch_size", lambda: batch)
+    def _modelSet(self, workflowName: str) -> tuple:
+        if workflowName not in self._modelSets:
+            wfp = WorkFlowParser()
+            wfp.reloadFile(workflowName)
+            self._modelSets[workflowName] = wfp.getModelSet()
+        return self._modelSets[workflowName]
+
+    def scheduleOrders(self, orders: List[Order]) -> List[Order]:
+        """
+        在生成之前按模型组合调整upload块的执行顺序, 使用 %url% 的upload块仍然排在它依赖的upload块之后
+        """
+        if not config.comfyui_schedule_by_model_set:
+            return orders
+
+        def _orderModelSet(order: Order) -> tuple:
+            workflowName = next((image.workflowName for image in order.sortByActive() if image.workflowName), "")
+            return self._modelSet(workflowName) if workflowName else ()
+
+        return groupChainsByModelSet(orders, _orderModelSet, self._loadedModelSet)
+
+    def warmUp(self, orders: List[Order]):
+        """
+        用第一个要执行的工作流以1张图片、1步采样提交一个预热prompt, 让comfyui在正式批次之前加载模型
+        预热结果直接丢弃, 不等待其完成
+        """
+        if not config.comfyui_warm_up:
+            return
+        workflowName = next((image.workflowName for order in orders for image in order.sortByActive()
+                             if image.workflowName), "")
+        if not workflowName:
+            return
+
+        wfp = WorkFlowParser()
+        wfp.reloadFile(workflowName)
+        self._setWorkFlowBatch(wfp, 1)
+        wfp.setAllCustomKeyValue("seed", lambda: random.randint(0, 2 ** 63 - 1))
+        wfp.setAllCustomKeyValue("steps", lambda: 1)
+        if config.comfyui_websocket_output:
+            wfp.replaceNodeClass(["SaveImage"], WEBSOCKET_OUTPUT_NODE, {})
+        affinity = self._modelSet(workflowName)
+        self._loadedModelSet = affinity
+
+        def _done(future: concurrent.futures.Future):
+            if future.exception():
+                log.warn(f"预热prompt执行失败: {future.exception()}")
+                return
+            for images in future.result().images.values():
+                for image in images:
+                    image.discard()
+            log.info(f"预热完成: {workflowName}")
+
+        log.info(f"使用 {workflowName} 预热comfyui, 模型: {affinity}")
+        self._websocket.submit(wfp.getWorkFlowDict(), workflowName, affinity=affinity).add_done_callback(_done)
 
-    def _setWorkflowKey(self, order: Order, fixedSeed: int):
-        self._wfp.setAllCustomKeyValue("seed", lambda: random.randint(0, 2 ** 63 - 1))
+    def _suggestBatch(self, key: BatchKey, requested: int) -> int:
+        return self._tuner.suggest(key.workflowName, requested)
+
+    @staticmethod
+    def _setWorkFlowBatch(wfp: WorkFlowParser, batch: int):
+        wfp.setAllCustomKeyValue("batch_size", lambda: batch)
+
+    @staticmethod
+    def _setWorkflowOutput(wfp: WorkFlowParser, order: Order):
+        if order.ui.workflowOutputFormat:
+            # 直接让comfyui输出压缩格式, 优先于websocket输出(SaveImageWebsocket只能输出PNG)
+            quality = order.ui.workflowOutputQuality or config.comfyui_jpeg_quality
+            wfp.setSaveFormat(order.ui.workflowOutputFormat.lower(), quality)
+            return
+        if config.comfyui_websocket_output:
+            wfp.replaceNodeClass(["SaveImage"], WEBSOCKET_OUTPUT_NODE, {})
+
+    @staticmethod
+    def _setWorkflowKey(wfp: WorkFlowParser, order: Order, fixedSeed: int, imageIndex: int = 0):
+        if order.ui.workflowUniformString:
+            # 由 uniform_string 派生确定性的种子, 重新运行时得到相同的工作流
+            nodeIndex = itertools.count()
+            wfp.setAllCustomKeyValue("seed", lambda: deriveSeed(order.ui.workflowUniformString, order.ui._uploadIndex,
+                                                                imageIndex, next(nodeIndex)))
+        else:
+            wfp.setAllCustomKeyValue("seed", lambda: random.randint(0, 2 ** 63 - 1))
 
         for fixedNodeSeedName in order.ui.workflowFixedNodeSeedNames:
-            if isinstance(fixedNodeSeedName, str):
-                self._wfp.setUnsafelyNodeID(fixedNodeSeedName, "seed", fixedSeed)
+            if not isinstance(fixedNodeSeedName, (str, int)):
+                order.ui.error(f"固定的节点种子名称类型错误: {fixedNodeSeedName} {type(fixedNodeSeedName)}")
                 continue
-            if isinstance(fixedNodeSeedName, int):
-                self._wfp.setUnsafelyNodeID(str(fixedNodeSeedName), "seed", fixedSeed)
+            # 节点ID或节点标题
+            nodeIDs = wfp.resolveNodes(str(fixedNodeSeedName))
+            if not nodeIDs:
+                order.ui.error(f"工作流中不存在要固定种子的节点: {fixedNodeSeedName}")
+            for nodeID in nodeIDs:
+                wfp.setUnsafelyNodeID(nodeID, "seed", fixedSeed)
+
+    @staticmethod
+    def _setWorkflowParams(wfp: WorkFlowParser, order: Order, params: Dict[str, Dict[str, Any]]):
+        """
+        设置参数扫描组合中的节点输入, 同一批次的Image组合相同
+        """
+        for nodeName, inputs in params.items():
+            nodeIDs = wfp.resolveNodes(str(nodeName))
+            if not nodeIDs:
+                order.ui.error(f"参数扫描: 工作流中不存在节点: {nodeName}")
                 continue
-            order.ui.error(f"固定的节点种子名称类型错误: {fixedNodeSeedName} {type(fixedNodeSeedName)}")
-
-    def _requestComfyui(self, order: Order, saveDirPath: str):
-        def _requestLoop() -> List[str]:
-            def __requestLoop(images: List[Image]) -> List[str]:
-                __batch = len(images)
-                if not __batch:
-                    order.ui.fatal("无效的批次数量: 0")
-
-                __result: List[str] = []
-
-                self._wfp.reloadFile(images[0].workflowName)  # 如果一个批次包含多个Image，则只使用第一个的工作流
-                self._setWorkFlowBatch(__batch)
-                self._setWorkflowKey(order, seed)
-                comfyuiFilePaths, taskInfo = self._websocket.send(self._wfp.getWorkFlow(), saveDirPath)
-                order.taskInfo = taskInfo
-                __result.extend(comfyuiFilePaths)
-                order.saveOrder()
-                return __result
-
-            if order.ui.workflowUniformString:
-                seed = hashMixSalt(order.ui.workflowUniformString)
+            for inputName, value in inputs.items():
+                if not wfp.setNodeInputs(inputName, {nodeID: value for nodeID in nodeIDs}):
+                    order.ui.error(f"参数扫描: 节点{nodeName}没有输入: {inputName}")
+        if params:
+            order.ui.debug(f"参数扫描组合: {params}")
+
+    @staticmethod
+    def _recordPromptTags(batch: PlannedBatch, workflow: dict):
+        """
+        在提交时提取正向提示词, order中只保存提取结果而不是整个工作流, 相同的提示词共用一个键
+        """
+        tags = [[tag, weight] for tag, weight in extractPositiveTags(workflow)]
+        key = hashlib.sha1(json.dumps(tags, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+        for _order in batch.orders():
+            _order.promptTags[key] = tags
+        for _, image in batch.members:
+            image.promptKey = key
+
+    def _runBatches(self, batches: List[PlannedBatch], saveDirPath: str,
+                    prepare: Optional[Callable[[WorkFlowParser, PlannedBatch], None]] = None) -> List[tuple[Image, str]]:
+        """
+        提交批次并收集输出
+        :param prepare: 在提交前进一步修改工作流, 设置后由它负责记录Image的批次信息
+        :return: (Image, 输出文件路径), 编码失败的路径为空
+        """
+        # 每次调用使用独立的WorkFlowParser, 流水线模式下多个order可以同时生成
+        wfp = WorkFlowParser()
+
+        def __submit(batch: PlannedBatch) -> tuple[str, Optional[concurrent.futures.Future]]:
+            wfp.reloadFile(batch.key.workflowName)
+            self._setWorkFlowBatch(wfp, batch.size())
+            firstOrder, firstImage = batch.members[0]
+            self._setWorkflowKey(wfp, firstOrder, batch.fixedSeed, batch.seedIndex)
+            self._setWorkflowParams(wfp, firstOrder, firstImage.params)
+            self._setWorkflowOutput(wfp, batch.order)
+            if prepare:
+                prepare(wfp, batch)
             else:
-                seed = random.randint(0, 2 ** 63 - 1)
+                seeds = wfp.getNodeInputs("seed")
+                for batchIndex, (_, image) in enumerate(batch.members):
+                    image.seeds, image.batchSize, image.batchIndex = seeds, batch.size(), batchIndex
+            workflow = wfp.getWorkFlowDict()
+            self._recordPromptTags(batch, workflow)
+            key = workflowKey(workflow) if self._cache else ""
+            if key:
+                cached = self._cache.get(key, saveDirPath)
+                if cached is not None:
+                    batch.order.ui.info(f"命中生成结果缓存, 跳过comfyui请求: {key[:12]}")
+                    result.extend(zip([image for _, image in batch.members], cached))
+                    return key, None
 
-            _result: List[str] = []
-            _activeImages = order.sortByActive()
+            affinity = self._modelSet(batch.key.workflowName)
+            self._loadedModelSet = affinity
+            return key, self._websocket.sendAsync(workflow, saveDirPath, batch.key.workflowName, affinity)
 
-            _loop = int(len(_activeImages) / order.ui.batch)
-            _singleLoop = len(_activeImages) % order.ui.batch
-            if not _loop and not _singleLoop:
-                order.ui.fatal(f"无效的批次分解: 将{order.ui.number} / {order.ui.batch}的商{_loop}余{_singleLoop}")
+        def __receive(batch: PlannedBatch, key: str, future: concurrent.futures.Future) -> List[tuple[Image, str]]:
+            try:
+                comfyuiFilePaths, taskInfo, timing = self._websocket.receive(future, saveDirPath)
+            except ComfyuiExecutionError as e:
+                if not self._tuner or not e.outOfMemory or batch.size() <= 1:
+                    raise
+                # 显存不足: 记录上限并拆分为更小的批次重新排队
+                retry = self._tuner.recordOutOfMemory(batch.key.workflowName, batch.size())
+                waiting.extendleft(reversed(splitBatch(batch, retry)))
+                return []
+            if self._tuner and timing and not prepare:
+                self._tuner.record(batch.key.workflowName, batch.size(), timing.get("execution_time", 0.0))
+            if len(comfyuiFilePaths) != batch.size():
+                batch.order.ui.error(f"comfyui输出的图片数量{len(comfyuiFilePaths)}与批次大小{batch.size()}不一致")
+            for _order in batch.orders():
+                _order.taskInfo = taskInfo
+                _order.timings.append(timing)
+                _order.saveOrder()
+            if key:
+                generated.append((key, comfyuiFilePaths))
+            return list(zip([image for _, image in batch.members], comfyuiFilePaths))
 
-            for _ in range(_loop):
-                order.ui.info(f"剩余 {_loop} 次 {order.ui.batch} 批次comfyui请求")
-                _result.extend(__requestLoop(_activeImages[:order.ui.batch]))
-                _activeImages = _activeImages[order.ui.batch:]
-                _loop -= 1
+        # 每个后端除了正在执行的批次外，再预先排队 prefetch 个批次，避免下载/保存期间GPU空闲
+        # 结果仍然按提交顺序收集
+        waiting: Deque[PlannedBatch] = deque(batches)
+        result: List[tuple[Image, str]] = []
+        generated: List[tuple[str, List[str]]] = []  # 需要写入生成结果缓存的 (工作流哈希, 输出路径)
+        pending: Deque[tuple[PlannedBatch, str, concurrent.futures.Future]] = deque()
+        while waiting or pending:
+            while waiting and len(pending) < self._websocket.capacity():
+                batch = waiting.popleft()
+                merged = len(batch.orders())
+                batch.order.ui.info(f"剩余 {len(waiting) + 1} 次 {batch.size()} 批次comfyui请求"
+                                    + (f", 合并了 {merged} 个upload块" if merged > 1 else ""))
+                key, future = __submit(batch)
+                if future:
+                    pending.append((batch, key, future))
+            if pending:
+                result.extend(__receive(*pending.popleft()))
 
-            for _ in range(_singleLoop):
-                order.ui.info(f"剩余 {_singleLoop} 次 单批次comfyui请求")
-                _result.extend(__requestLoop(_activeImages[:1]))
-                _activeImages = _activeImages[1:]
-                _singleLoop -= 1
+        failed = self._websocket.flush()
+        for key, paths in generated:
+            if paths and not any(path in failed for path in paths):
+                self._cache.put(key, paths)
+        return [(image, outputPath if outputPath not in failed else "") for image, outputPath in result]
 
-            return _result
+    def _requestComfyui(self, orders: List[Order], saveDirPath: str):
+        batches = planBatches(orders, self._suggestBatch if self._tuner else None)
+        for order in orders:
+            order.ui.debug(f"活动的images对象数量: {len(order.sortByActive())}")
 
+        for image, outputPath in self._runBatches(groupByModelSet(batches, self._modelSet, self._loadedModelSet),
+                                                  saveDirPath):
+            image.outputPath = outputPath
+        self._checkOutputs(orders)
+
+    def _requestTwoPhase(self, order: Order, saveDirPath: str):
+        """
+        先用草稿工作流生成所有草稿, 按 draft_select 选出的草稿再以相同的种子、批次大小与批次位置执行完整工作流
+        完整工作流需要保留草稿工作流中基础采样部分的节点ID, 才能得到与草稿相同的构图
+        """
         activeImages = order.sortByActive()
-        if activeImages:
-            order.ui.debug(f"活动的images对象数量: {len(activeImages)}")
-            result = _requestLoop()
-            for activeImage in activeImages:
-                activeImage.outputPath = result.pop(0)
-
-        counter = 0
-        for activeImage in order.sortByActive():
-            if not activeImage.outputPath:
-                counter += 1
-        if counter:
-            order.ui.fatal(f"没有将所有的活动的Image对象填充outputPath: 对象数量: {counter}")
+        if not activeImages:
+            return
+        fixedSeed = orderSeed(order)
+        draftDirPath = os.path.join(saveDirPath, "draft")
+        os.makedirs(draftDirPath, exist_ok=True)
+        drafts: List[Image] = []
 
-    def append(self, order: Order):
+        def __draft(count: int):
+            newDrafts: List[Image] = []
+            for index in range(len(drafts), len(drafts) + count):
+                draft = Image()
+                draft.setIndex(index)
+                draft.workflowName = order.ui.workflowDraftName
+                newDrafts.append(draft)
+            draftBatch = PlannedBatch(BatchKey(order.ui.workflowDraftName, (), None, "", 0), order, fixedSeed,
+                                      len(drafts))
+            draftBatch.members = [(order, draft) for draft in newDrafts]
+            order.ui.info(f"生成 {count} 张草稿: {order.ui.workflowDraftName}")
+            for draft, outputPath in self._runBatches(splitBatch(draftBatch, order.ui.batch), draftDirPath):
+                draft.outputPath = outputPath
+            drafts.extend(newDrafts)
+
+        # 已经完成的图片不再需要草稿, 只按剩余数量保持超采样的比例
+        __draft(len(activeImages) + order.ui.draftNumber() - order.ui.number)
+        ranked = rankDrafts([draft.outputPath for draft in drafts], order.ui.workflowDraftSelect)
+        for _ in range(_MAX_EXTRA_DRAFT_ROUNDS):
+            if len(ranked) >= len(activeImages):
+                break
+            # 去重后草稿不足: 追加生成缺少数量两倍的草稿
+            order.ui.info(f"可用的草稿只有 {len(ranked)} 张, 少于需要的 {len(activeImages)} 张")
+            __draft((len(activeImages) - len(ranked)) * 2)
+            ranked = rankDrafts([draft.outputPath for draft in drafts], order.ui.workflowDraftSelect)
+        if len(ranked) < len(activeImages):
+            fallback = [index for index, draft in enumerate(drafts) if draft.outputPath and index not in ranked]
+            order.ui.warn(f"追加草稿后仍然不足, 使用 {len(activeImages) - len(ranked)} 张重复的草稿补足")
+            ranked += fallback
+
+        survivors = [drafts[index] for index in ranked[:len(activeImages)]]
+        order.ui.info(f"从 {len(drafts)} 张草稿中选出 {len(survivors)} 张执行完整工作流: {[d.getIndex() for d in survivors]}")
+
+        finalPlan: List[PlannedBatch] = []
+        for image, survivor in zip(activeImages, survivors):
+            image.seeds, image.batchSize, image.batchIndex = dict(survivor.seeds), survivor.batchSize, survivor.batchIndex
+            batch = PlannedBatch(BatchKey(image.workflowName, (), None, "", 0), order, fixedSeed, image.getIndex())
+            batch.members = [(order, image)]
+            finalPlan.append(batch)
+
+        def _prepare(wfp: WorkFlowParser, batch: PlannedBatch):
+            _image = batch.members[0][1]
+            try:
+                applyDraft(wfp, _image.seeds, _image.batchSize, _image.batchIndex)
+            except ValueError as e:
+                order.ui.fatal(f"{_image.workflowName}: {e}")
+
+        for image, outputPath in self._runBatches(finalPlan, saveDirPath, _prepare):
+            image.outputPath = outputPath
+        self._checkOutputs([order])
+
+    @staticmethod
+    def _checkOutputs(orders: List[Order]):
+        for order in orders:
+            counter = 0
+            for activeImage in order.sortByActive():
+                if not activeImage.outputPath:
+                    counter += 1
+            if counter:
+                order.ui.fatal(f"没有将所有的活动的Image对象填充outputPath: 对象数量: {counter}")
+
+    def generate(self, order: Order):
+        """
+        生成阶段: 将order中所有活动的Image发送到comfyui并填充outputPath
+        """
+        self.generateAll([order])
+
+    def generateAll(self, orders: List[Order]):
+        """
+        一次性生成多个order: 所有order中工作流与固定种子设置相同的Image会被装进同一个批次,
+        脚本中有很多小upload块时可以减少prompt数量并填满每个批次
+        设置了草稿工作流的order单独按两阶段生成
+        """
         saveDirPath = self._initWorkflowParserAndOutputPath()
-        order.ui.debug("_requestComfyui")
-        self._requestComfyui(order, saveDirPath)
+        twoPhase = [order for order in orders if order.ui.workflowDraftName]
+        singlePhase = [order for order in orders if not order.ui.workflowDraftName]
+        if singlePhase:
+            log.debug(f"_requestComfyui: {len(singlePhase)} 个order")
+            self._requestComfyui(singlePhase, saveDirPath)
+        for order in twoPhase:
+            order.ui.debug("_requestTwoPhase")
+            self._requestTwoPhase(order, saveDirPath)
+
+    @staticmethod
+    def postProcess(order: Order):
+        """
+        后处理阶段: 打码、水印、最终编码与排序，不占用comfyui
+        """
         order.ui.debug("_extraImgPostProcess")
         extraImgPostProcess(order)
         order.sort()
+
+    def append(self, order: Order):
+        self.generate(order)
+        self.postProcess(order)
@@ -1,9 +1,12 @@
+import os
+
 from PIL import Image
 
 from src import log
 from src.config import config
 from src.mode_parser.upload_block import Order
 from src.utils.detector import detector, detectorYolo, mosaicBlurry, putWatermark
+from src.utils.encoder import OutputCodec, encodeJpeg, COMPRESSED_EXTENSIONS
 
 
 def extraImgPostProcess(order: Order):
@@ -18,6 +21,29 @@ def extraImgPostProcess(order: Order):
             putWatermark(activeImage.outputPath, config.watermark_path)
             activeImage.watermarkFin = True
 
+    if config.comfyui_output_codec == OutputCodec.FINAL.value:
+        for image in order.getImages():
+            image.outputPath = _finalEncode(image.outputPath)
+
+
+def _finalEncode(srcPath: str) -> str:
+    """
+    final 模式下，后处理期间一直保留无损的原始文件，在全部后处理结束后只编码一次JPEG
+    """
+    if not srcPath or os.path.splitext(srcPath)[1].lower() in COMPRESSED_EXTENSIONS:
+        return srcPath
+    dstPath = os.path.splitext(srcPath)[0] + ".jpg"
+    try:
+        _, seconds, warning = encodeJpeg(srcPath, dstPath, config.comfyui_jpeg_quality)
+    except Exception as e:
+        log.error(f"最终编码图片失败, 保留原始文件: {srcPath}, {e}")
+        return srcPath
+    if warning:
+        log.warn(warning)
+    os.remove(srcPath)
+    log.debug(f"最终编码完成: {dstPath} 耗时 {seconds:.3f}s")
+    return dstPath
+
 def _parseMosaicBlurry(savePath: str) -> str:
     log.debug(f"马赛克检测开始，打开了文件{savePath}")
     with Image.open(savePath) as image:
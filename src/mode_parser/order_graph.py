@@ -0,0 +1,86 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from typing import List, Callable, Dict, Optional
+
+from src import log
+from src.mode_parser.upload_block import Order
+
+
+def buildChains(orders: List[Order]) -> List[List[Order]]:
+    """
+    按照 dependsOn 将order拆分为互不依赖的链, 链内的order必须依次执行
+    """
+    chains: List[List[Order]] = []
+    chainOf = {}
+    for order in orders:
+        if order.dependsOn is not None and id(order.dependsOn) in chainOf:
+            chain = chainOf[id(order.dependsOn)]
+        else:
+            chain = []
+            chains.append(chain)
+        chain.append(order)
+        chainOf[id(order)] = chain
+    return chains
+
+
+def groupChainsByModelSet(orders: List[Order], modelSet: Callable[[Order], tuple],
+                          loaded: Optional[tuple] = None) -> List[Order]:
+    """
+    将使用相同模型组合的链排在一起, 减少upload块之间comfyui切换checkpoint/LoRA/VAE的次数
+    链作为整体移动, 链内(依赖 %url% 的upload块)保持原有顺序; 链按第一个order的模型组合分组,
+    组合按首次出现的顺序执行(当前已加载的组合最先)
+    :param modelSet: order -> 模型组合
+    :param loaded: comfyui当前已加载的模型组合
+    """
+    groups: Dict[tuple, List[List[Order]]] = {}
+    if loaded is not None:
+        groups[loaded] = []
+    for chain in buildChains(orders):
+        groups.setdefault(modelSet(chain[0]), []).append(chain)
+    scheduled = [order for chains in groups.values() for chain in chains for order in chain]
+    if scheduled != orders:
+        log.info(f"按模型组合调整upload块的执行顺序: {[order.ui._uploadIndex for order in scheduled]}")
+    return scheduled
+
+
+def runChains(orders: List[Order], function: Callable[[Order], None], workers: int):
+    """
+    同时执行多条互不依赖的链, 每条链内按顺序对每个order调用function
+    :param workers: 同时执行的链数量
+    """
+    chains = buildChains(orders)
+    log.info(f"{len(orders)} 个upload块分为 {len(chains)} 条独立的链, 同时执行 {min(workers, len(chains))} 条")
+
+    stop = threading.Event()  # 任意一条链失败后, 不再开始新的order
+
+    def _runChain(chain: List[Order]):
+        try:
+            for order in chain:
+                if stop.is_set():
+                    break
+                try:
+                    function(order)
+                except BaseException:
+                    stop.set()
+                    raise
+                finally:
+                    order.finished.set()
+        finally:
+            for order in chain:
+                order.finished.set()  # 没有执行的order也要放行依赖它的order
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="order-chain")
+    try:
+        futures = [executor.submit(_runChain, chain) for chain in chains]
+        _, pending = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in pending:
+            future.cancel()
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+    for chain in chains:
+        for order in chain:
+            order.finished.set()
+    for future in futures:
+        if not future.cancelled():
+            future.result()  # 重新抛出链中的异常, 包括 log.fatal 的 SystemExit
@@ -0,0 +1,43 @@
+import threading
+from typing import List
+
+from src import log
+from src.mode_parser.order_graph import runChains
+from src.mode_parser.pipeline import Stage, SKIP
+from src.mode_parser.upload_block import Order
+
+
+class ParallelRunner:
+    """
+    同时执行多个order, 每个工作者带着一个order依次经过所有阶段
+
+    与 Pipeline 不同, 阶段之间没有队列, 每个阶段用信号量限制同时执行的order数量 (Stage.workers),
+    例如生成受comfyui后端数量限制、打标签只允许一个, 而后处理与上传可以同时进行多个
+    使用 %url% 的upload块仍然在它依赖的upload块之后执行
+    """
+
+    def __init__(self, stages: List[Stage], workers: int):
+        if not stages:
+            raise ValueError("parallel模式至少需要一个阶段")
+        self._stages = stages
+        self._semaphores = [threading.BoundedSemaphore(stage.workers) for stage in stages]
+        self._workers = max(1, workers)
+
+    def run(self, orders: List[Order]):
+        runChains(orders, self._runOrder, self._workers)
+
+    def _runOrder(self, order: Order):
+        order.ui.info("开始执行")
+        payload = None
+        for stage, semaphore in zip(self._stages, self._semaphores):
+            with semaphore:
+                order.ui.debug(f"阶段开始: {stage.name}")
+                try:
+                    payload = stage.function(order, payload)
+                except Exception as e:
+                    order.ui.error(f"阶段 {stage.name} 执行失败: {e}")
+                    log.debug(f"阶段 {stage.name} 异常", exc_info=True)
+                    return
+            if payload is SKIP:
+                order.ui.info(f"阶段 {stage.name} 跳过了该order的后续阶段")
+                return
@@ -0,0 +1,148 @@
+import heapq
+import queue
+import threading
+from typing import Callable, Any, List, Optional
+
+from src import log
+from src.mode_parser.upload_block import Order
+
+# 阶段函数返回 SKIP 时，该order不再进入后续阶段
+SKIP = object()
+
+_SENTINEL = object()
+
+
+class _Item:
+    def __init__(self, seq: int, order: Order, payload: Any = None, skip: bool = False):
+        self.seq = seq
+        self.order = order
+        self.payload = payload
+        self.skip = skip  # 已被前面的阶段跳过或执行失败，只为有序阶段占位
+
+    def __lt__(self, other: "_Item") -> bool:
+        return self.seq < other.seq
+
+
+class Stage:
+    def __init__(self, name: str, function: Callable[[Order, Any], Any], workers: int = 1, ordered: bool = False):
+        """
+        :param name: 阶段名称，仅用于日志
+        :param function: 阶段函数 (order, 上一阶段的返回值) -> 传给下一阶段的值，返回 SKIP 则跳过后续阶段
+        :param workers: 该阶段同时处理的order数量
+        :param ordered: 是否严格按照脚本中的顺序开始处理order
+        """
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.ordered = ordered
+
+
+class Pipeline:
+    """
+    分阶段流水线执行多个order，阶段之间使用有界队列
+
+    例如 生成 -> 后处理 -> 打标签 -> 上传，order N+1 在GPU上生成的同时 order N 进行后处理、order N-1 正在上传，
+    总耗时趋近于最慢的阶段而不是所有阶段之和
+    """
+
+    def __init__(self, stages: List[Stage], queueSize: int = 2):
+        if not stages:
+            raise ValueError("流水线至少需要一个阶段")
+        self._stages = stages
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=max(1, queueSize)) for _ in stages]
+        self._queues.append(queue.Queue())  # 最后一个阶段的输出
+        self._stopped = threading.Event()
+        self._fatal: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    def run(self, orders: List[Order]):
+        threads: List[threading.Thread] = []
+        for index, stage in enumerate(self._stages):
+            threads.extend(self._startStage(stage, self._queues[index], self._queues[index + 1]))
+
+        for seq, order in enumerate(orders):
+            self._queues[0].put(_Item(seq, order, skip=self._stopped.is_set()))
+        self._queues[0].put(_SENTINEL)
+
+        while (item := self._queues[-1].get()) is not _SENTINEL:
+            item.order.finished.set()  # 被跳过的order也要放行依赖它的order
+        for thread in threads:
+            thread.join()
+
+        if self._fatal:
+            # 与顺序执行时的 log.fatal 保持一致，所有进行中的order结束后再退出
+            raise self._fatal
+
+    def _startStage(self, stage: Stage, inbox: queue.Queue, outbox: queue.Queue) -> List[threading.Thread]:
+        work: queue.Queue = queue.Queue(maxsize=stage.workers)
+        remaining = [stage.workers]
+        remainingLock = threading.Lock()
+
+        def _dispatch():
+            # 有序阶段使用最小堆缓存乱序到达的order，按seq依次交给工作者
+            pending: List[_Item] = []
+            nextSeq = 0
+            while True:
+                item = inbox.get()
+                if item is _SENTINEL:
+                    break
+                if not stage.ordered:
+                    work.put(item)
+                    continue
+                heapq.heappush(pending, item)
+                while pending and pending[0].seq == nextSeq:
+                    work.put(heapq.heappop(pending))
+                    nextSeq += 1
+            while pending:
+                work.put(heapq.heappop(pending))
+            for _ in range(stage.workers):
+                work.put(_SENTINEL)
+
+        def _work():
+            while True:
+                item = work.get()
+                if item is _SENTINEL:
+                    break
+                if not item.skip and not self._stopped.is_set():
+                    item = self._process(stage, item)
+                else:
+                    item.skip = True
+                outbox.put(item)
+            with remainingLock:
+                remaining[0] -= 1
+                if not remaining[0]:
+                    outbox.put(_SENTINEL)
+
+        threads = [threading.Thread(target=_dispatch, name=f"pipeline-{stage.name}-dispatch", daemon=True)]
+        threads.extend(
+            threading.Thread(target=_work, name=f"pipeline-{stage.name}-{i}", daemon=True)
+            for i in range(stage.workers)
+        )
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _process(self, stage: Stage, item: _Item) -> _Item:
+        item.order.ui.debug(f"流水线阶段开始: {stage.name}")
+        try:
+            payload = stage.function(item.order, item.payload)
+        except SystemExit as e:
+            # log.fatal 在工作线程中只会结束当前线程，这里转交给主线程
+            item.order.ui.error(f"流水线阶段 {stage.name} 遇到致命错误, 停止提交新的order")
+            with self._lock:
+                self._fatal = self._fatal or e
+            self._stopped.set()
+            item.skip = True
+            return item
+        except Exception as e:
+            item.order.ui.error(f"流水线阶段 {stage.name} 执行失败: {e}")
+            log.debug(f"流水线阶段 {stage.name} 异常", exc_info=True)
+            item.skip = True
+            return item
+
+        if payload is SKIP:
+            item.order.ui.info(f"流水线阶段 {stage.name} 跳过了该order的后续阶段")
+            item.skip = True
+            return item
+        item.payload = payload
+        return item
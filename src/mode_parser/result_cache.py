@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import List, Optional, Dict, Any
+
+from src import log
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def workflowKey(workflow: str | dict) -> str:
+    """
+    最终API工作流的规范化哈希: 键排序、去除空白后计算sha256, 种子等所有输入都包含在内
+    """
+    if isinstance(workflow, str):
+        workflow = json.loads(workflow)
+    canonical = json.dumps(workflow, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _fileHash(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, mode="rb") as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """
+    以内容寻址的生成结果缓存
+
+    objects/ 下按文件内容的sha256保存输出图片, index.json 记录 工作流哈希 -> 输出图片对象,
+    命中时将对象复制到输出目录(后处理会原地修改图片, 不能直接使用缓存中的文件)
+    超过 maxAge 秒未使用的条目与超出 maxBytes 时最久未使用的条目会被淘汰
+    """
+
+    def __init__(self, path: str, maxBytes: int, maxAge: float):
+        self._path = path
+        self._objectsPath = os.path.join(path, "objects")
+        self._indexPath = os.path.join(path, "index.json")
+        self._maxBytes = maxBytes
+        self._maxAge = maxAge
+        self._lock = threading.Lock()
+        os.makedirs(self._objectsPath, exist_ok=True)
+        self._index: Dict[str, Dict[str, Any]] = self._load()
+        with self._lock:
+            self._evict()
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if not os.path.isfile(self._indexPath):
+            return {}
+        try:
+            with open(self._indexPath, mode="r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            log.warn(f"读取生成结果缓存索引失败, 将重新建立: {self._indexPath}, {e}")
+            return {}
+        return index if isinstance(index, dict) else {}
+
+    def _save(self):
+        try:
+            with open(self._indexPath, mode="w", encoding="utf-8") as f:
+                json.dump(self._index, f, ensure_ascii=False)
+        except OSError as e:
+            log.warn(f"保存生成结果缓存索引失败: {self._indexPath}, {e}")
+
+    def _objectPath(self, name: str) -> str:
+        return os.path.join(self._objectsPath, name)
+
+    def get(self, key: str, saveDirPath: str) -> Optional[List[str]]:
+        """
+        :return: 复制到saveDirPath中的输出图片路径, 未命中或缓存对象丢失时为None
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            if not entry:
+                return None
+            if not all(os.path.isfile(self._objectPath(name)) for name in entry["objects"]):
+                del self._index[key]
+                self._save()
+                return None
+            entry["last_used"] = time.time()
+            self._save()
+            objects = list(entry["objects"])
+
+        paths: List[str] = []
+        for name in objects:
+            path = os.path.join(saveDirPath, f"{int(time.time() * 1000)}-{name}")
+            shutil.copyfile(self._objectPath(name), path)
+            paths.append(path)
+        return paths
+
+    def put(self, key: str, paths: List[str]):
+        """
+        保存一个prompt的全部输出图片
+        """
+        try:
+            objects = [_fileHash(path) + os.path.splitext(path)[1].lower() for path in paths]
+        except OSError as e:
+            log.warn(f"读取输出图片失败, 不写入生成结果缓存: {e}")
+            return
+
+        # 复制对象与写入索引需要在同一个锁内, 否则其它线程淘汰时会把尚未写入索引的对象当作无用对象删除
+        with self._lock:
+            size = 0
+            try:
+                for path, name in zip(paths, objects):
+                    objectPath = self._objectPath(name)
+                    if not os.path.isfile(objectPath):
+                        shutil.copyfile(path, objectPath)
+                    size += os.path.getsize(objectPath)
+            except OSError as e:
+                log.warn(f"写入生成结果缓存失败: {e}")
+                return
+            now = time.time()
+            self._index[key] = {"objects": objects, "bytes": size, "created": now, "last_used": now}
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        removed = 0
+        for key in [k for k, v in self._index.items() if self._maxAge and now - v["last_used"] > self._maxAge]:
+            del self._index[key]
+            removed += 1
+
+        total = sum(entry["bytes"] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_used"]):
+            if not self._maxBytes or total <= self._maxBytes:
+                break
+            total -= self._index.pop(key)["bytes"]
+            removed += 1
+
+        referenced = {name for entry in self._index.values() for name in entry["objects"]}
+        for name in os.listdir(self._objectsPath):
+            if name not in referenced:
+                try:
+                    os.remove(self._objectPath(name))
+                except OSError as e:
+                    log.warn(f"删除生成结果缓存对象失败: {name}, {e}")
+        if removed:
+            log.debug(f"生成结果缓存淘汰了 {removed} 个条目, 剩余 {len(self._index)} 个 {total / 1024 / 1024:.1f}MB")
+        self._save()
@@ -1,11 +1,18 @@
+import itertools
 import json
 import os
-from typing import List, Dict
+import threading
+from typing import List, Dict, Optional, Any
 
 from src import log
 from src.config import config
 from src.uploader.payloadbase import allowWebsite
 from src.utils.fileio import getSuffixPath
+from src.utils.hasher import setSalt
+
+
+# 没有设置 draft_number 时草稿数量为number的倍数
+DRAFT_OVERSAMPLE = 2
 
 
 class UploadInfo:
@@ -19,6 +26,13 @@ class UploadInfo:
         self.workflowFixedNodeSeedNames: List[str] = []
         self.workflowUniformString: str = ""
         self.workflowName: str = ""
+        self.workflowOutputFormat: str = ""
+        self.workflowOutputQuality: int = 0
+        self.workflowDraftName: str = ""  # 草稿工作流, 设置后先生成低分辨率草稿, 只对选中的草稿执行完整工作流
+        self.workflowDraftNumber: int = 0  # 草稿数量, 必须大于number, 0为number的两倍
+        self.workflowDraftSelect: str = "score"  # 草稿的选择方式: all / dedupe / score
+        self.workflowSweep: Dict[str, Dict[str, list]] = {}  # 参数扫描: {节点ID或标题: {输入名: [取值]}}
+        self.workflowSweepMode: str = "grid"  # grid: 所有取值的组合 / list: 按位置一一对应
 
         self.rmDefaultTags: List[str] = []
         self.addDefaultTags: List[str] = []
@@ -43,6 +57,13 @@ class UploadInfo:
             "workflow: fixed_node_seed_names": [self.workflowFixedNodeSeedNames, list],
             "workflow: uniform_string": [self.workflowUniformString, str],
             "workflow: workflow_name": [self.workflowName, str],
+            "workflow: output_format": [self.workflowOutputFormat, str],
+            "workflow: output_quality": [self.workflowOutputQuality, int],
+            "workflow: draft_workflow_name": [self.workflowDraftName, str],
+            "workflow: draft_number": [self.workflowDraftNumber, int],
+            "workflow: draft_select": [self.workflowDraftSelect, str],
+            "workflow: sweep": [self.workflowSweep, dict],
+            "workflow: sweep_mode": [self.workflowSweepMode, str],
 
             "number": [self.number, int],
             "batch": [self.batch, int],
@@ -67,15 +88,89 @@ class UploadInfo:
             self.error(f"因为number < PackerStartPos 因此无法进行打包")
             return False
 
+        if self.workflowOutputFormat and self.workflowOutputFormat.lower() not in ("webp", "jpg", "jpeg", "png"):
+            self.error(f"不支持的输出格式:{self.workflowOutputFormat}")
+            return False
+
+        if not 0 <= self.workflowOutputQuality <= 100:
+            self.error(f"输出质量必须在0~100之间:{self.workflowOutputQuality}")
+            return False
+
         if self.number <= 0:
             self.error(f"number生成的数量不能小于0:{self.number}")
             return False
 
+        if self.workflowDraftName:
+            if not self.workflowName:
+                self.error("使用draft_workflow_name时必须设置workflow_name, 草稿与完整工作流的基础采样部分需要一致")
+                return False
+            if self.workflowDraftNumber and self.workflowDraftNumber <= self.number:
+                self.error(f"draft_number必须大于number, 否则所有草稿都会执行完整工作流:{self.workflowDraftNumber}")
+                return False
+            if self.workflowDraftSelect.lower() not in ("all", "dedupe", "score"):
+                self.error(f"不支持的草稿选择方式:{self.workflowDraftSelect}")
+                return False
+
+        if self.workflowSweep and not self._checkSweep():
+            return False
+
         if self.batch < 0:
             self.error(f"batch批次数量不能小于0:{self.batch}")
             return False
         return True
 
+    def draftNumber(self) -> int:
+        return self.workflowDraftNumber or self.number * DRAFT_OVERSAMPLE
+
+    def _checkSweep(self) -> bool:
+        if self.workflowSweepMode.lower() not in ("grid", "list"):
+            self.error(f"不支持的参数扫描方式:{self.workflowSweepMode}")
+            return False
+        if self.workflowDraftName:
+            self.error("参数扫描不能与draft_workflow_name同时使用")
+            return False
+        lengths = set()
+        for nodeName, inputs in self.workflowSweep.items():
+            if not isinstance(inputs, dict) or not inputs:
+                self.error(f"workflow: sweep: {nodeName}必须是 {{输入名: [取值]}}")
+                return False
+            for inputName, values in inputs.items():
+                if not isinstance(values, list) or not values:
+                    self.error(f"workflow: sweep: {nodeName}: {inputName}的取值必须是非空列表:{values}")
+                    return False
+                lengths.add(len(values))
+        if self.workflowSweepMode.lower() == "list" and len(lengths) > 1:
+            self.error(f"sweep_mode为list时所有取值列表的长度必须相同:{sorted(lengths)}")
+            return False
+        variants = len(self.sweepVariants())
+        if self.number < variants:
+            self.error(f"number不能小于参数扫描的组合数量:{self.number} < {variants}")
+            return False
+        return True
+
+    def sweepVariants(self) -> List[Dict[str, Dict[str, Any]]]:
+        """
+        展开参数扫描, 没有设置sweep时只有一个空组合
+        grid 模式中越靠后的参数变化越快, 相邻的组合只相差少数参数, comfyui可以复用上游节点的缓存
+        :return: [{节点ID或标题: {输入名: 取值}}]
+        """
+        slots = [(nodeName, inputName, values) for nodeName, inputs in self.workflowSweep.items()
+                 for inputName, values in inputs.items()]
+        if not slots:
+            return [{}]
+        if self.workflowSweepMode.lower() == "list":
+            combinations = zip(*(values for _, _, values in slots))
+        else:
+            combinations = itertools.product(*(values for _, _, values in slots))
+
+        variants: List[Dict[str, Dict[str, Any]]] = []
+        for combination in combinations:
+            variant: Dict[str, Dict[str, Any]] = {}
+            for (nodeName, inputName, _), value in zip(slots, combination):
+                variant.setdefault(nodeName, {})[inputName] = value
+            variants.append(variant)
+        return variants
+
     def fatal(self, msg, *args, **kwargs):
         log.fatal(f"uploads[{self._uploadIndex}]: {msg}", *args, **kwargs)
 
@@ -92,6 +187,46 @@ class UploadInfo:
         log.debug(f"uploads[{self._uploadIndex}]: {msg}", *args, **kwargs)
 
 
+class ScriptOptions:
+    """
+    script.json 中 global 块的设置
+    """
+
+    def __init__(self):
+        self.deleteFilesEnable: bool = False
+        self.salt: Optional[str] = None  # 覆盖项目的持久化种子盐
+
+        # parallel 模式: 同时执行的order数量与每个阶段同时执行的数量, 未设置时使用config中pipeline的值
+        self.parallelWorkers: int = config.pipeline_parallel_workers
+        self.parallelGenerateWorkers: int = config.pipeline_generate_workers
+        self.parallelPostProcessWorkers: int = config.pipeline_post_process_workers
+        self.parallelTagWorkers: int = config.pipeline_tag_workers
+        self.parallelUploadWorkers: int = config.pipeline_upload_workers
+
+    def load(self, _global: dict):
+        self.deleteFilesEnable = bool(_global.get("delete_files_enable", self.deleteFilesEnable))
+
+        salt = _global.get("salt")
+        if isinstance(salt, (str, int)) and not isinstance(salt, bool) and str(salt):
+            self.salt = str(salt)
+        elif salt is not None:
+            log.error(f"global: salt必须是字符串或整数: {salt}")
+
+        parallel: dict = _global.get("parallel") or {}
+        for key, attr in (("workers", "parallelWorkers"),
+                          ("generate_workers", "parallelGenerateWorkers"),
+                          ("post_process_workers", "parallelPostProcessWorkers"),
+                          ("tag_workers", "parallelTagWorkers"),
+                          ("upload_workers", "parallelUploadWorkers")):
+            value = parallel.get(key)
+            if value is None:
+                continue
+            if not isinstance(value, int) or value < 1:
+                log.error(f"global: parallel: {key}必须是大于0的整数: {value}")
+                continue
+            setattr(self, attr, value)
+
+
 class Image:
     def __init__(self):
         self._index: int = 0
@@ -103,6 +238,16 @@ class Image:
         self.watermarkEnable: bool = False
         self.watermarkFin: bool = False
 
+        # 生成该图片的prompt中每个节点的种子、批次大小与在批次中的位置, 用于以相同种子重新生成
+        self.seeds: Dict[str, int] = {}
+        self.batchSize: int = 0
+        self.batchIndex: int = 0
+        # 生成该图片的prompt的正向提示词在 Order.promptTags 中的键
+        self.promptKey: str = ""
+        # 参数扫描中该图片使用的组合 {节点ID或标题: {输入名: 取值}}, 以及在该组合中的序号
+        self.params: Dict[str, Dict[str, Any]] = {}
+        self.sweepIndex: int = 0
+
     def setIndex(self, index: int):
         self._index = index
 
@@ -117,19 +262,44 @@ class Order:
         self._mode: str = ""
 
         self.taskInfo = {}
+        self.timings: List[dict] = []  # 每个comfyui批次的执行耗时记录, 见 PromptTiming
+        # 实际执行的prompt中的正向提示词 {键: [[标签, 权重]]}, 相同的提示词只保存一份
+        self.promptTags: Dict[str, List[list]] = {}
         self.dstURL: str = ""
         self.extensionFileContextPath: str = ""
 
+        self.dependsOn: Optional[Order] = None  # caption中使用 %url% 时依赖的上一个upload块
+        self.imagesBefore: Optional[int] = None  # script中排在该upload块之前的图片总数, 用于 %allNumber%
+        self.scriptGlobal: dict = {}  # script的global块, 随order保存, 恢复时重新应用
+        self.finished = threading.Event()  # 上传完成(或被跳过)后设置, 依赖它的order在此之前不会开始上传
+
         self.ui = ui
         self._init()
 
+    def usesPreviousURL(self) -> bool:
+        return any("%url%" in (text or "") for text in (self.ui.targetCaption, self.ui.targetExtensionFileContext))
+
+    def uploadDir(self) -> str:
+        """
+        上传时附加文件(下载链接、压缩包)的目录, 每个upload块独立, 并行上传时不会互相覆盖
+        """
+        path = os.path.join(config.output_path, f"upload_{self.ui._uploadIndex}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
     def _init(self):
         self._addImage()
 
     def _addImage(self):
+        # number张图片按顺序平均分配给参数扫描的各个组合, 相同组合的图片相邻, 可以放进同一个批次
+        variants = self.ui.sweepVariants()
         for i in range(self.ui.number):
             image = Image()
             image.setIndex(i)
+            variantIndex = i * len(variants) // self.ui.number
+            image.params = variants[variantIndex]
+            variantStart = (variantIndex * self.ui.number + len(variants) - 1) // len(variants)
+            image.sweepIndex = i - variantStart
             self._setSfwLevelNum(image, i)
             image.mosaicEnable = self.ui.mosaicEnable
             image.watermarkEnable = self.ui.waterMarkEnable
@@ -204,7 +374,8 @@ class Order:
         return ls
 
     def saveOrder(self):
-        save_filename = getSuffixPath("image_order.json")  # 使用不同的基础文件名区分
+        # 使用不同的基础文件名区分, 带上upload块序号避免流水线模式下同时执行的order互相覆盖
+        save_filename = getSuffixPath(f"image_order_{self.ui._uploadIndex}.json")
         old_order_folder_path = os.path.join(config.order_path, "old")
         if not os.path.exists(old_order_folder_path):
             try:
@@ -225,6 +396,12 @@ class Order:
             "_images": [vars(img).copy() for img in self._images],
             # 保存 taskInfo
             "taskInfo": self.taskInfo,
+            # 保存每个批次的执行耗时记录
+            "timings": self.timings,
+            # 保存正向提示词
+            "promptTags": self.promptTags,
+            # 保存script的global块(种子盐等)
+            "scriptGlobal": self.scriptGlobal,
             # 保存目标 URL
             "dstURL": self.dstURL
         }
@@ -251,7 +428,20 @@ class Order:
             self.ui.fatal(f"保存 ImageOrder 时发生未知错误: {e}")
 
 
-def loadOrders(orderScriptPath: str) -> (List[Order], str):
+def applyScriptOptions(_global: dict) -> ScriptOptions:
+    """
+    读取global块并应用其中的种子盐, 从order记录恢复时使用保存的global块, 以得到相同的种子
+    """
+    options = ScriptOptions()
+    if _global:
+        options.load(_global)
+    if options.salt is not None:
+        setSalt(options.salt)
+        log.debug("使用script中设置的种子盐")
+    return options
+
+
+def loadOrders(orderScriptPath: str) -> (List[Order], str, ScriptOptions):
     orders: List[Order] = []
     try:
         with open(orderScriptPath, mode="r", encoding="utf-8") as f:
@@ -262,7 +452,8 @@ def loadOrders(orderScriptPath: str) -> (List[Order], str):
     _uploads: List[dict] = script.get("uploads")
     if not len(_uploads):
         log.error("上传块中没有对象")
-    _global: dict = script.get("global")
+    _global: dict = script.get("global") or {}
+    options = applyScriptOptions(_global)
 
     uploadInfos: List[UploadInfo] = []
     index: int = 0
@@ -288,6 +479,13 @@ def loadOrders(orderScriptPath: str) -> (List[Order], str):
                 log.debug(f"upload块[{index}] 没有携带workflow, 稍后将会使用默认的workflow")
             ui.workflowFixedNodeSeedNames = workflow.get("fixed_node_seed_names")
             ui.workflowUniformString = workflow.get("uniform_string")
+            ui.workflowOutputFormat = workflow.get("output_format", "")
+            ui.workflowOutputQuality = workflow.get("output_quality", 0)
+            ui.workflowDraftName = workflow.get("draft_workflow_name", "")
+            ui.workflowDraftNumber = workflow.get("draft_number", 0)
+            ui.workflowDraftSelect = workflow.get("draft_select", "score")
+            ui.workflowSweep = workflow.get("sweep", {})
+            ui.workflowSweepMode = workflow.get("sweep_mode", "grid")
 
         ui.number = upload.get("number")
         ui.batch = upload.get("batch")
@@ -303,8 +501,25 @@ def loadOrders(orderScriptPath: str) -> (List[Order], str):
             continue
 
         order: Order = Order(uploadInfo)
+        order.scriptGlobal = _global
         orders.append(order)
-    return orders, script.get("mode")
+    linkDependencies(orders)
+    return orders, script.get("mode"), options
+
+
+def linkDependencies(orders: List[Order]):
+    """
+    使用 %url% 的upload块依赖它的上一个upload块, 其它upload块之间互不依赖, 可以同时执行
+    %allNumber% 按script中的位置计算, 不依赖其它upload块的完成顺序
+    """
+    imagesBefore = 0
+    for order in orders:
+        order.imagesBefore = imagesBefore
+        imagesBefore += order.len()
+    for previous, order in zip(orders, orders[1:]):
+        if order.usesPreviousURL():
+            order.dependsOn = previous
+            order.ui.debug(f"依赖upload块[{previous.ui._uploadIndex}]的URL")
 
 
 def loadOrderSave(order_save_path: str) -> tuple[Order, str] | tuple[None, str]:
@@ -373,6 +588,9 @@ def loadOrderSave(order_save_path: str) -> tuple[Order, str] | tuple[None, str]:
 
         # 4. 恢复其他属性
         order.taskInfo = order_data.get("taskInfo", {})  # 提供默认空字典
+        order.timings = order_data.get("timings", [])
+        order.promptTags = order_data.get("promptTags", {})
+        order.scriptGlobal = order_data.get("scriptGlobal", {})
         order.dstURL = order_data.get("dstURL", "")  # 提供默认空字符串
 
         # 5. （可选）执行检查
@@ -0,0 +1,707 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Any, BinaryIO
+
+import httpx
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import InvalidHandshake
+
+from src import log
+
+# 在future注册之前就到达的消息最多缓存的prompt数量
+_MAX_ORPHAN_PROMPTS = 64
+
+# 通过websocket二进制帧直接输出图片的节点
+WEBSOCKET_OUTPUT_NODE = "SaveImageWebsocket"
+_BINARY_EVENT_PREVIEW_IMAGE = 1
+_BINARY_IMAGE_FORMATS = {1: "jpg", 2: "png"}
+
+_DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# 看门狗检查进行中prompt的间隔秒数
+_WATCHDOG_INTERVAL = 5.0
+
+
+def _queuedPromptIDs(queue: Dict[str, list], keys: tuple = ("queue_running", "queue_pending")) -> set[str]:
+    """
+    /queue 中每一项为 [序号, prompt_id, prompt, extra_data, outputs_to_execute]
+    """
+    return {item[1] for key in keys for item in queue.get(key) or []
+            if isinstance(item, list) and len(item) > 1}
+
+
+class ComfyuiExecutionError(Exception):
+    """
+    comfyui执行prompt时返回了 execution_error / execution_interrupted
+    """
+
+    def __init__(self, promptID: str, data: dict):
+        self.promptID = promptID
+        self.data = data
+        self.nodeID: str = data.get("node_id", "")
+        self.nodeType: str = data.get("node_type", "")
+        self.exceptionType: str = data.get("exception_type", "")
+        self.exceptionMessage: str = data.get("exception_message", "")
+        super().__init__(
+            f"prompt {promptID} 在节点 {self.nodeID}({self.nodeType}) 执行失败: "
+            f"{self.exceptionType} {self.exceptionMessage}")
+
+    @property
+    def outOfMemory(self) -> bool:
+        """
+        是否为显存不足 (torch.cuda.OutOfMemoryError 等)
+        """
+        return "OutOfMemory" in self.exceptionType or "out of memory" in self.exceptionMessage.lower()
+
+
+class ComfyuiStallError(Exception):
+    """
+    prompt超过了执行期限或长时间没有任何进度消息，已被看门狗中断
+    """
+
+    def __init__(self, promptID: str, nodeID: str, reason: str):
+        self.promptID = promptID
+        self.nodeID = nodeID
+        super().__init__(f"prompt {promptID} 在节点 {nodeID or '-'} 停滞: {reason}")
+
+
+class ComfyuiRequestError(Exception):
+    """
+    comfyui的HTTP接口返回了错误状态码，通常是prompt本身无效
+    """
+
+    def __init__(self, url: str, statusCode: int, body: str):
+        self.url = url
+        self.statusCode = statusCode
+        self.body = body
+        super().__init__(f"comfyui请求失败: {url} {statusCode} {body[:500]}")
+
+
+class OutputImage:
+    """
+    comfyui输出的一张图片，内容保存在内存(data)或者已经流式下载到磁盘的文件(path)中
+    """
+
+    def __init__(self, filename: str, data: bytes = b"", path: str = "", sha256: str = ""):
+        self.filename: str = filename
+        self.data: bytes = data
+        self.path: str = path
+        self.sha256: str = sha256 or hashlib.sha256(data).hexdigest()
+
+    def open(self) -> BinaryIO:
+        if self.path:
+            return open(self.path, mode="rb")
+        return io.BytesIO(self.data)
+
+    def read(self) -> bytes:
+        with self.open() as f:
+            return f.read()
+
+    def discard(self):
+        """
+        删除已经下载到磁盘的原始文件
+        """
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = ""
+
+
+class PromptTiming:
+    """
+    单个prompt的执行耗时记录，由 execution_start / execution_cached / executing / executed / progress 消息生成
+    时间均为本地收到消息时的unix时间戳(秒)
+    """
+
+    def __init__(self, promptID: str, prompt: dict, serverAddress: str):
+        self.promptID: str = promptID
+        self.serverAddress: str = serverAddress
+        self.queuedAt: float = time.time()
+        self.startedAt: float = 0.0
+        self.finishedAt: float = 0.0
+        self.cachedNodes: List[str] = []
+        self.nodes: Dict[str, dict] = {}
+        self._classTypes: Dict[str, str] = {
+            nodeID: node.get("class_type", "") for nodeID, node in prompt.items() if isinstance(node, dict)
+        }
+        self._currentNodeID: str = ""
+
+    def _node(self, nodeID: str) -> dict:
+        if nodeID not in self.nodes:
+            self.nodes[nodeID] = {
+                "class_type": self._classTypes.get(nodeID, ""),
+                "start": 0.0,
+                "end": 0.0,
+                "steps": 0,
+                "first_step": 0.0,
+                "last_step": 0.0,
+            }
+        return self.nodes[nodeID]
+
+    def _closeCurrent(self, at: float):
+        if self._currentNodeID:
+            node = self._node(self._currentNodeID)
+            if not node["end"]:
+                node["end"] = at
+            self._currentNodeID = ""
+
+    def record(self, messageType: str, data: dict, at: float):
+        match messageType:
+            case "execution_start":
+                self.startedAt = at
+            case "execution_cached":
+                self.cachedNodes.extend(data.get("nodes") or [])
+            case "executing":
+                self._closeCurrent(at)
+                nodeID = data.get("node")
+                if nodeID is None:
+                    self.finishedAt = at
+                    return
+                if not self.startedAt:
+                    self.startedAt = at
+                self._node(nodeID)["start"] = at
+                self._currentNodeID = nodeID
+            case "executed":
+                if not data.get("node"):
+                    return
+                node = self._node(data.get("node"))
+                if not node["end"]:
+                    node["end"] = at
+            case "progress":
+                if not (data.get("node") or self._currentNodeID):
+                    return
+                node = self._node(data.get("node") or self._currentNodeID)
+                if not node["first_step"]:
+                    node["first_step"] = at
+                node["last_step"] = at
+                node["steps"] = data.get("value", node["steps"])
+            case "execution_error" | "execution_interrupted":
+                self._closeCurrent(at)
+                self.finishedAt = at
+
+    def currentNodeID(self) -> str:
+        return self._currentNodeID
+
+    def slowestNodes(self, n: int = 3) -> List[tuple[str, str, float]]:
+        durations = [
+            (nodeID, node["class_type"], node["end"] - node["start"])
+            for nodeID, node in self.nodes.items() if node["start"] and node["end"]
+        ]
+        return sorted(durations, key=lambda d: d[2], reverse=True)[:n]
+
+    def toDict(self) -> dict:
+        return {
+            "prompt_id": self.promptID,
+            "server_address": self.serverAddress,
+            "queued_at": self.queuedAt,
+            "started_at": self.startedAt,
+            "finished_at": self.finishedAt,
+            "queue_wait": self.startedAt - self.queuedAt if self.startedAt else 0.0,
+            "execution_time": self.finishedAt - self.startedAt if self.startedAt and self.finishedAt else 0.0,
+            "cached_nodes": self.cachedNodes,
+            "nodes": self.nodes,
+        }
+
+
+class PromptResult:
+    def __init__(self, promptID: str):
+        self.promptID: str = promptID
+        self.images: Dict[str, List[OutputImage]] = {}
+        self.outputs: Dict[str, dict] = {}
+        self.history: dict = {}
+        self.timing: Optional[PromptTiming] = None
+
+
+class _PromptTask:
+    def __init__(self, promptID: str, future: asyncio.Future, prompt: dict, downloadPath: str,
+                 timing: PromptTiming):
+        self.promptID = promptID
+        self.future = future
+        self.downloadPath = downloadPath
+        self.timing = timing
+        self.outputs: Dict[str, dict] = {}
+        self.websocketNodes: set[str] = {
+            nodeID for nodeID, node in prompt.items() if node.get("class_type") == WEBSOCKET_OUTPUT_NODE
+        }
+        self.frames: Dict[str, List[OutputImage]] = {}
+        self.lastActivity: float = time.time()
+
+
+class ComfyuiClient:
+    """
+    基于asyncio的comfyui客户端
+
+    一个websocket连接上可以同时维持多个进行中的prompt，submit()为每个prompt_id返回一个future，
+    由唯一的读取任务按prompt_id分发 executing / executed / execution_error 消息
+    """
+
+    def __init__(self, serverAddress: str, clientID: str = "", downloadConcurrency: int = 4,
+                 reconnectAttempts: int = 10, reconnectInitialDelay: float = 1.0, reconnectMaxDelay: float = 30.0,
+                 promptTimeout: float = 0.0, nodeStallTimeout: float = 0.0):
+        """
+        :param serverAddress: comfyui后端地址
+        :param clientID: websocket的clientId，为空则随机生成
+        :param downloadConcurrency: 同时从 /view 下载图片的最大数量
+        :param reconnectAttempts: 连接失败或断开后的最大重连次数
+        :param reconnectInitialDelay: 第一次重连前等待的秒数，之后每次翻倍
+        :param reconnectMaxDelay: 两次重连之间等待的最大秒数
+        :param promptTimeout: 单个prompt开始执行后允许的最长秒数，0表示不限制
+        :param nodeStallTimeout: 执行中的prompt没有任何进度消息的最长秒数，0表示不限制
+        """
+        self.serverAddress: str = serverAddress
+        self.clientID: str = clientID or str(uuid.uuid4())
+        self._reconnectAttempts: int = reconnectAttempts
+        self._reconnectInitialDelay: float = reconnectInitialDelay
+        self._reconnectMaxDelay: float = reconnectMaxDelay
+        self._reconnecting: bool = False
+        self._promptTimeout: float = promptTimeout
+        self._nodeStallTimeout: float = nodeStallTimeout
+        self._watchdog: Optional[asyncio.Task] = None
+        self._downloadConcurrency: int = max(1, downloadConcurrency)
+        self._downloads: asyncio.Semaphore = asyncio.Semaphore(self._downloadConcurrency)
+        self._http: Optional[httpx.AsyncClient] = None
+        self._ws: Optional[ClientConnection] = None
+        self._reader: Optional[asyncio.Task] = None
+        self._tasks: Dict[str, _PromptTask] = {}
+        self._orphans: Dict[str, List[dict]] = {}
+        self._finishing: set[asyncio.Task] = set()
+        self._executingPromptID: str = ""
+        self._executingNodeID: str = ""
+
+    @property
+    def connected(self) -> bool:
+        return (self._ws is not None and self._reader is not None and not self._reader.done()
+                and not self._reconnecting)
+
+    @property
+    def reconnecting(self) -> bool:
+        return self._reconnecting
+
+    def inflight(self) -> int:
+        return len(self._tasks)
+
+    async def connect(self):
+        await self._open()
+        self._reader = asyncio.create_task(self._readLoop())
+        if (self._promptTimeout or self._nodeStallTimeout) and (not self._watchdog or self._watchdog.done()):
+            self._watchdog = asyncio.create_task(self._watchdogLoop())
+        log.debug(f"comfyui websocket 已连接: {self.serverAddress}")
+
+    async def connectWithRetry(self):
+        """
+        按指数退避重试连接，超过最大重连次数后抛出最后一次的异常
+        """
+        delay = self._reconnectInitialDelay
+        for attempt in range(self._reconnectAttempts + 1):
+            try:
+                await self.connect()
+                return
+            except OSError as e:
+                if attempt >= self._reconnectAttempts:
+                    raise
+                log.warn(f"连接comfyui失败({attempt + 1}/{self._reconnectAttempts}), {delay:.1f}秒后重试: "
+                         f"{self.serverAddress}, {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self._reconnectMaxDelay)
+
+    async def _open(self):
+        if not self._http:
+            # 复用keep-alive连接；comfyui通常在本机或局域网，不经过系统代理
+            self._http = httpx.AsyncClient(
+                base_url=f"http://{self.serverAddress}",
+                limits=httpx.Limits(max_connections=self._downloadConcurrency + 2,
+                                    max_keepalive_connections=self._downloadConcurrency + 2),
+                timeout=httpx.Timeout(60.0, connect=10.0),
+                trust_env=False,
+            )
+        try:
+            self._ws = await connect(
+                f"ws://{self.serverAddress}/ws?clientId={self.clientID}",
+                max_size=None,
+            )
+        except InvalidHandshake as e:
+            raise ConnectionError(f"comfyui websocket 握手失败: {self.serverAddress}, {e}") from e
+
+    async def close(self):
+        if self._watchdog:
+            self._watchdog.cancel()
+            try:
+                await self._watchdog
+            except asyncio.CancelledError:
+                pass
+            self._watchdog = None
+        if self._reader:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        if self._ws:
+            await self._ws.close()
+            self._ws = None
+            log.info(f"WebSocket closed: {self.serverAddress}")
+        if self._http:
+            await self._http.aclose()
+            self._http = None
+        self._failAll(ConnectionError(f"comfyui客户端已关闭: {self.serverAddress}"))
+
+    async def submit(self, prompt: dict, downloadPath: str = "") -> asyncio.Future:
+        """
+        将prompt加入comfyui队列
+        :param prompt: API格式的工作流
+        :param downloadPath: 输出图片流式下载到的目录，为空则保存在内存中
+        :return: 在prompt执行完毕后得到 PromptResult 的future
+        """
+        if not self.connected:
+            raise ConnectionError(f"comfyui websocket 未连接: {self.serverAddress}")
+        timing = PromptTiming("", prompt, self.serverAddress)
+        response = await self.queuePrompt(prompt)
+        promptID: str = response["prompt_id"]
+        timing.promptID = promptID
+        task = _PromptTask(promptID, asyncio.get_running_loop().create_future(), prompt, downloadPath, timing)
+        self._tasks[promptID] = task
+        for message in self._orphans.pop(promptID, []):
+            self._dispatch(message)
+        return task.future
+
+    async def _readLoop(self):
+        while True:
+            try:
+                async for out in self._ws:
+                    if isinstance(out, str):
+                        message = json.loads(out)
+                        message["_receivedAt"] = time.time()
+                        self._trackExecuting(message)
+                        self._dispatch(message)
+                    else:
+                        self._receiveFrame(out)
+                reason = "连接已关闭"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                reason = f"连接中断: {e}"
+            log.warn(f"comfyui websocket {reason}: {self.serverAddress}, 正在尝试重连")
+
+            if not await self._reconnect():
+                self._failAll(ConnectionError(f"comfyui websocket {reason}, 重连失败: {self.serverAddress}"))
+                return
+            await self._recover()
+
+    async def _reconnect(self) -> bool:
+        """
+        使用同一个clientId重新连接websocket，comfyui会继续向该clientId推送进行中prompt的消息
+        """
+        self._reconnecting = True
+        self._executingPromptID = ""
+        self._executingNodeID = ""
+        delay = self._reconnectInitialDelay
+        try:
+            for attempt in range(self._reconnectAttempts):
+                await asyncio.sleep(delay)
+                try:
+                    await self._open()
+                    log.info(f"comfyui websocket 已重连: {self.serverAddress}")
+                    return True
+                except OSError as e:
+                    log.warn(f"comfyui websocket 重连失败({attempt + 1}/{self._reconnectAttempts}): "
+                             f"{self.serverAddress}, {e}")
+                delay = min(delay * 2, self._reconnectMaxDelay)
+            return False
+        finally:
+            self._reconnecting = False
+
+    async def _recover(self):
+        """
+        断线期间已经执行完毕的prompt不会再收到websocket消息，通过 /history/{prompt_id} 找回它们的结果
+        """
+        await self._reconcile(list(self._tasks.values()))
+
+    async def _reconcile(self, tasks: List[_PromptTask]):
+        """
+        按 /queue 与 /history 核对prompt的状态: 已完成的从历史记录中取回结果，
+        两者中都不存在的prompt已随后端重启丢失，以 ConnectionError 结束，由调用方重新提交
+        """
+        if not tasks:
+            return
+        # 先查询队列再查询历史记录: comfyui先写入历史记录再将prompt移出队列，两次查询之间完成的prompt不会被遗漏
+        try:
+            queued: Optional[set[str]] = _queuedPromptIDs(await self.getQueue())
+        except (OSError, ComfyuiRequestError) as e:
+            log.warn(f"查询comfyui队列失败: {self.serverAddress}, {e}")
+            queued = None
+
+        for task in tasks:
+            if self._tasks.get(task.promptID) is not task:
+                continue  # 查询期间已经通过websocket消息结束
+            try:
+                entry = (await self.getHistory(task.promptID)).get(task.promptID)
+            except (OSError, ComfyuiRequestError) as e:
+                log.warn(f"查询prompt {task.promptID} 的历史记录失败: {e}")
+                continue
+            if self._tasks.get(task.promptID) is not task:
+                continue
+            if not entry:
+                if queued is None or task.promptID in queued:
+                    continue  # 仍在排队或执行中，等待后续的websocket消息
+                self._tasks.pop(task.promptID, None)
+                log.warn(f"prompt {task.promptID} 不在comfyui的队列与历史记录中, 后端可能已经重启: {self.serverAddress}")
+                if not task.future.done():
+                    task.future.set_exception(
+                        ConnectionError(f"prompt {task.promptID} 已从comfyui中丢失: {self.serverAddress}"))
+                continue
+
+            self._tasks.pop(task.promptID, None)
+            status: dict = entry.get("status") or {}
+            if status.get("status_str") == "error":
+                errorData = {"prompt_id": task.promptID}
+                for messageType, data in status.get("messages") or []:
+                    if messageType in ("execution_error", "execution_interrupted"):
+                        errorData = data
+                if not task.future.done():
+                    task.future.set_exception(ComfyuiExecutionError(task.promptID, errorData))
+                continue
+
+            if task.websocketNodes:
+                # 断线期间的二进制帧已经丢失，history中也没有这些图片
+                if not task.future.done():
+                    task.future.set_exception(
+                        ConnectionError(f"prompt {task.promptID} 的websocket输出在断线期间丢失"))
+                continue
+
+            log.info(f"从历史记录中恢复了断线期间完成的prompt: {task.promptID}")
+            task.outputs.update(entry.get("outputs") or {})
+            self._scheduleFinish(task)
+
+    def _trackExecuting(self, message: dict):
+        if message.get("type") != "executing" or not isinstance(message.get("data"), dict):
+            return
+        data = message["data"]
+        self._executingNodeID = data.get("node") or ""
+        self._executingPromptID = (data.get("prompt_id") or "") if self._executingNodeID else ""
+
+    def _receiveFrame(self, frame: bytes):
+        """
+        二进制帧不携带prompt_id，按照最近一次 executing 消息所指的节点归属
+        """
+        if int.from_bytes(frame[:4], byteorder="big") != _BINARY_EVENT_PREVIEW_IMAGE:
+            return
+        if not self._executingPromptID:
+            return
+        imageFormat = _BINARY_IMAGE_FORMATS.get(int.from_bytes(frame[4:8], byteorder="big"), "png")
+        self._dispatch({
+            "type": "binary",
+            "_receivedAt": time.time(),
+            "data": {
+                "prompt_id": self._executingPromptID,
+                "node": self._executingNodeID,
+                "format": imageFormat,
+                "frame": frame[8:],
+            },
+        })
+
+    def _dispatch(self, message: dict):
+        data = message.get("data")
+        if not isinstance(data, dict):
+            return
+        promptID = data.get("prompt_id")
+        if not promptID:
+            return
+
+        task = self._tasks.get(promptID)
+        if not task:
+            # queue_prompt 的HTTP响应可能晚于websocket消息到达
+            if promptID not in self._orphans and len(self._orphans) >= _MAX_ORPHAN_PROMPTS:
+                self._orphans.pop(next(iter(self._orphans)))
+            self._orphans.setdefault(promptID, []).append(message)
+            return
+
+        task.lastActivity = message.get("_receivedAt") or time.time()
+        task.timing.record(message.get("type"), data, task.lastActivity)
+        match message.get("type"):
+            case "executing":
+                if data.get("node") is None:
+                    self._tasks.pop(promptID, None)
+                    self._scheduleFinish(task)
+            case "executed":
+                task.outputs[data.get("node")] = data.get("output") or {}
+            case "binary":
+                if data.get("node") in task.websocketNodes:
+                    frames = task.frames.setdefault(data.get("node"), [])
+                    frames.append(OutputImage(f"{data.get('node')}_{len(frames)}.{data.get('format')}",
+                                              data.get("frame")))
+            case "execution_error" | "execution_interrupted":
+                self._tasks.pop(promptID, None)
+                if not task.future.done():
+                    task.future.set_exception(ComfyuiExecutionError(promptID, data))
+
+    async def _watchdogLoop(self):
+        """
+        对已经开始执行的prompt强制执行整体期限与节点停滞期限，超时后中断并交给调用方重新排队；
+        长时间没有任何消息的排队中prompt按 /queue 核对，避免丢失的prompt或错过的 execution_start 让期限失效
+        """
+        queuedCheckAfter = self._nodeStallTimeout or self._promptTimeout
+        while True:
+            await asyncio.sleep(_WATCHDOG_INTERVAL)
+            if self._reconnecting:
+                continue
+            now = time.time()
+            idleQueued: List[_PromptTask] = []
+            for task in list(self._tasks.values()):
+                if not task.timing.startedAt:
+                    if now - task.lastActivity > queuedCheckAfter:
+                        idleQueued.append(task)
+                    continue
+                reason = ""
+                if self._promptTimeout and now - task.timing.startedAt > self._promptTimeout:
+                    reason = f"执行超过 {self._promptTimeout:.0f}s"
+                elif self._nodeStallTimeout and now - task.lastActivity > self._nodeStallTimeout:
+                    reason = f"{now - task.lastActivity:.0f}s 没有任何进度"
+                if reason:
+                    await self._interrupt(task, reason)
+            if idleQueued:
+                await self._checkQueued(idleQueued)
+
+    async def _checkQueued(self, tasks: List[_PromptTask]):
+        """
+        核对没有收到 execution_start 的prompt: 仍在等待的重新计时，正在执行的从现在开始计算期限，
+        不在队列中的按历史记录取回结果或作为丢失的prompt结束
+        """
+        try:
+            queue = await self.getQueue()
+        except (OSError, ComfyuiRequestError) as e:
+            log.warn(f"查询comfyui队列失败: {self.serverAddress}, {e}")
+            return
+        running = _queuedPromptIDs(queue, ("queue_running",))
+        pending = _queuedPromptIDs(queue, ("queue_pending",))
+        now = time.time()
+        missing: List[_PromptTask] = []
+        for task in tasks:
+            if self._tasks.get(task.promptID) is not task or task.timing.startedAt:
+                continue
+            if task.promptID in running:
+                log.debug(f"prompt {task.promptID} 已经开始执行但没有收到 execution_start: {self.serverAddress}")
+                task.timing.startedAt = now
+                task.lastActivity = now
+            elif task.promptID in pending:
+                task.lastActivity = now
+            else:
+                missing.append(task)
+        await self._reconcile(missing)
+
+    async def _interrupt(self, task: _PromptTask, reason: str):
+        nodeID = task.timing.currentNodeID()
+        log.warn(f"comfyui prompt 停滞, 正在中断: {self.serverAddress} {task.promptID} 节点 {nodeID}, {reason}")
+        self._tasks.pop(task.promptID, None)
+        try:
+            await self._request("POST", "/interrupt", json={"prompt_id": task.promptID})
+        except (OSError, ComfyuiRequestError) as e:
+            log.warn(f"中断comfyui prompt失败: {self.serverAddress} {task.promptID}, {e}")
+        if not task.future.done():
+            task.future.set_exception(ComfyuiStallError(task.promptID, nodeID, reason))
+
+    def _scheduleFinish(self, task: _PromptTask):
+        finishing = asyncio.create_task(self._finish(task))
+        self._finishing.add(finishing)
+        finishing.add_done_callback(self._finishing.discard)
+
+    async def _finish(self, task: _PromptTask):
+        result = PromptResult(task.promptID)
+        result.timing = task.timing
+        if task.websocketNodes:
+            # 图片已经通过二进制帧收到，不再请求 /history 与 /view
+            result.outputs = task.outputs
+            result.history = {"outputs": task.outputs}
+            result.images = task.frames
+            if not task.future.done():
+                task.future.set_result(result)
+            return
+
+        try:
+            result.history = (await self.getHistory(task.promptID))[task.promptID]
+            result.outputs = result.history.get("outputs") or task.outputs
+            # 同一个prompt的全部输出并发下载，并发数量由信号量限制
+            downloads: Dict[str, List[asyncio.Task]] = {}
+            for nodeID, nodeOutput in result.outputs.items():
+                downloads[nodeID] = [
+                    asyncio.create_task(self.getImage(image["filename"], image["subfolder"], image["type"],
+                                                      task.downloadPath))
+                    for image in nodeOutput.get("images", [])
+                ]
+            for nodeID, nodeDownloads in downloads.items():
+                result.images[nodeID] = list(await asyncio.gather(*nodeDownloads))
+        except Exception as e:
+            if not task.future.done():
+                task.future.set_exception(e)
+            return
+        if not task.future.done():
+            task.future.set_result(result)
+
+    def _failAll(self, e: Exception):
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            if not task.future.done():
+                task.future.set_exception(e)
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        if not self._http:
+            raise ConnectionError(f"comfyui客户端未连接: {self.serverAddress}")
+        try:
+            response = await self._http.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            raise ConnectionError(f"comfyui请求失败: {self.serverAddress}{url}, {e}") from e
+        if response.is_error:
+            raise ComfyuiRequestError(url, response.status_code, response.text)
+        return response
+
+    async def queuePrompt(self, prompt: dict) -> dict:
+        response = await self._request("POST", "/prompt", json={"prompt": prompt, "client_id": self.clientID})
+        return response.json()
+
+    async def getImage(self, filename: str, subfolder: str, folderType: str, downloadPath: str = "") -> OutputImage:
+        """
+        从 /view 下载一张图片
+        :param downloadPath: 流式写入的目录，为空则读入内存
+        """
+        params = {"filename": filename, "subfolder": subfolder, "type": folderType}
+        async with self._downloads:
+            if not downloadPath:
+                response = await self._request("GET", "/view", params=params)
+                return OutputImage(filename, response.content)
+
+            if not self._http:
+                raise ConnectionError(f"comfyui客户端未连接: {self.serverAddress}")
+            hasher = hashlib.sha256()
+            downloadID = f"{int(time.time() * 1000)}-{uuid.uuid4().hex}"
+            tmpPath = os.path.join(downloadPath, f"{downloadID}.part")
+            try:
+                async with self._http.stream("GET", "/view", params=params) as response:
+                    if response.is_error:
+                        await response.aread()
+                        raise ComfyuiRequestError("/view", response.status_code, response.text)
+                    with open(tmpPath, mode="wb") as f:
+                        async for chunk in response.aiter_bytes(_DOWNLOAD_CHUNK_SIZE):
+                            hasher.update(chunk)
+                            f.write(chunk)
+            except httpx.TransportError as e:
+                if os.path.exists(tmpPath):
+                    os.remove(tmpPath)
+                raise ConnectionError(f"comfyui下载图片失败: {self.serverAddress} {filename}, {e}") from e
+
+        sha256 = hasher.hexdigest()
+        # 保留临时文件名中的uuid: 内容相同的输出(相同种子)各自占用一个文件, 一张被丢弃不会删除另一张;
+        # .download 后缀与编码池保存的最终输出文件名区分
+        path = os.path.join(downloadPath, f"{downloadID}.download{os.path.splitext(filename)[1]}")
+        os.replace(tmpPath, path)
+        return OutputImage(filename, path=path, sha256=sha256)
+
+    async def getQueue(self) -> Dict[str, list]:
+        return (await self._request("GET", "/queue")).json()
+
+    async def getHistory(self, promptID: str) -> Dict[str, Any]:
+        return (await self._request("GET", f"/history/{promptID}")).json()
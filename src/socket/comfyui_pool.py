@@ -0,0 +1,187 @@
+import asyncio
+from typing import List, Optional
+
+from src import log
+from src.socket.comfyui_client import ComfyuiClient, PromptResult, ComfyuiRequestError, ComfyuiStallError
+
+
+class _Backend:
+    def __init__(self, address: str, workflows: List[str], clientOptions: dict):
+        self.address: str = address
+        self.workflows: List[str] = workflows
+        self.client: ComfyuiClient = ComfyuiClient(address, **clientOptions)
+        self.queueDepth: int = 0
+        self.affinity: Optional[tuple] = None  # 最近一次提交的prompt使用的模型组合
+        self._submittedSincePoll: int = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.client.connected
+
+    def compatible(self, workflowName: str) -> bool:
+        return not self.workflows or not workflowName or workflowName in self.workflows
+
+    def load(self) -> int:
+        return max(self.queueDepth + self._submittedSincePoll, self.client.inflight())
+
+    def markSubmitted(self):
+        self._submittedSincePoll += 1
+
+    async def poll(self):
+        queue = await self.client.getQueue()
+        self.queueDepth = len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+        self._submittedSincePoll = 0
+
+
+class ComfyuiPool:
+    """
+    多个comfyui后端的负载均衡池
+
+    定时轮询每个后端的 /queue 深度，每个批次发送到负载最低且可以执行该workflow的后端，
+    后端断开时将其上未完成的prompt重新分配到其它后端
+    """
+
+    def __init__(self, servers: List[tuple[str, List[str]]], pollInterval: float = 2.0, maxResubmit: int = 3,
+                 maxStallAttempts: int = 2, **clientOptions):
+        """
+        :param servers: (后端地址, 可执行的workflow名称列表) 的列表
+        :param pollInterval: 轮询 /queue 与重连断开后端的间隔秒数
+        :param maxResubmit: 单个prompt因后端断开而重新分配的最大次数
+        :param maxStallAttempts: 单个prompt因停滞被中断后重新排队的最大次数
+        :param clientOptions: 传递给每个后端 ComfyuiClient 的参数
+        """
+        if not servers:
+            raise ValueError("comfyui后端列表不能为空")
+        self._backends: List[_Backend] = [
+            _Backend(address, workflows, clientOptions) for address, workflows in servers
+        ]
+        self._pollInterval: float = pollInterval
+        self._maxResubmit: int = maxResubmit
+        self._maxStallAttempts: int = maxStallAttempts
+        self._poller: Optional[asyncio.Task] = None
+
+    def size(self) -> int:
+        return len(self._backends)
+
+    async def connect(self):
+        await asyncio.gather(*[self._connectBackend(backend, retry=True) for backend in self._backends])
+        if not any(backend.alive for backend in self._backends):
+            raise ConnectionError(f"没有可用的comfyui后端: {[backend.address for backend in self._backends]}")
+        self._poller = asyncio.create_task(self._pollLoop())
+
+    async def close(self):
+        if self._poller:
+            self._poller.cancel()
+            try:
+                await self._poller
+            except asyncio.CancelledError:
+                pass
+            self._poller = None
+        for backend in self._backends:
+            await backend.client.close()
+
+    @staticmethod
+    async def _connectBackend(backend: _Backend, retry: bool = False):
+        try:
+            if retry:
+                await backend.client.connectWithRetry()
+            else:
+                await backend.client.connect()
+            await backend.poll()
+            log.info(f"comfyui后端已连接: {backend.address}")
+        except OSError as e:
+            log.warn(f"comfyui后端连接失败: {backend.address}, {e}")
+
+    async def _pollLoop(self):
+        while True:
+            await asyncio.sleep(self._pollInterval)
+            for backend in self._backends:
+                if backend.client.reconnecting:
+                    continue  # 客户端正在自行重连
+                if not backend.alive:
+                    await self._connectBackend(backend)
+                    continue
+                try:
+                    await backend.poll()
+                except OSError as e:
+                    log.warn(f"获取comfyui后端队列深度失败: {backend.address}, {e}")
+
+    def _pick(self, workflowName: str, avoid: Optional[_Backend] = None,
+              affinity: Optional[tuple] = None) -> Optional[_Backend]:
+        candidates = [b for b in self._backends if b.alive and b.compatible(workflowName)]
+        if not candidates:
+            return None
+        # 优先避开上一次停滞的后端，没有其它可选后端时仍然使用它
+        preferred = [b for b in candidates if b is not avoid] or candidates
+        backend = min(preferred, key=lambda b: b.load())
+        if affinity is None or backend.affinity == affinity:
+            return backend
+        # 已经加载了相同模型的后端只多排队一个prompt时仍然优先使用, 切换模型通常比多等一个prompt更慢
+        same = [b for b in preferred if b.affinity == affinity and b.load() <= backend.load() + 1]
+        return min(same, key=lambda b: b.load()) if same else backend
+
+    async def submit(self, prompt: dict, workflowName: str = "", downloadPath: str = "",
+                     affinity: Optional[tuple] = None) -> asyncio.Future:
+        """
+        将prompt发送到负载最低的兼容后端
+        :param prompt: API格式的工作流
+        :param workflowName: 工作流文件名称，用于匹配后端的 workflows 限制
+        :param downloadPath: 输出图片流式下载到的目录，为空则保存在内存中
+        :param affinity: prompt使用的模型组合，负载相近时优先发送到已加载相同模型的后端
+        :return: 在prompt执行完毕后得到 PromptResult 的future
+        """
+        future = asyncio.get_running_loop().create_future()
+        task = asyncio.create_task(self._run(prompt, workflowName, downloadPath, affinity, future))
+        future.add_done_callback(lambda _: task.cancel() if not task.done() else None)
+        return future
+
+    async def _run(self, prompt: dict, workflowName: str, downloadPath: str, affinity: Optional[tuple],
+                   future: asyncio.Future):
+        attempts = 0
+        stalls = 0
+        stalledBackend: Optional[_Backend] = None
+        while not future.done():
+            backend = self._pick(workflowName, stalledBackend, affinity)
+            if not backend:
+                attempts += 1
+                if attempts > self._maxResubmit:
+                    self._setException(future, ConnectionError(f"没有可以执行 {workflowName} 的comfyui后端"))
+                    return
+                log.warn(f"没有可以执行 {workflowName} 的comfyui后端, {self._pollInterval}秒后重试")
+                await asyncio.sleep(self._pollInterval)
+                continue
+
+            try:
+                backend.markSubmitted()
+                if affinity is not None:
+                    backend.affinity = affinity
+                result: PromptResult = await (await backend.client.submit(prompt, downloadPath))
+            except ComfyuiRequestError as e:
+                # comfyui拒绝了prompt本身，换后端也无法执行
+                self._setException(future, e)
+                return
+            except ComfyuiStallError as e:
+                stalls += 1
+                if stalls > self._maxStallAttempts:
+                    self._setException(future, e)
+                    return
+                stalledBackend = backend
+                log.warn(f"comfyui后端 {backend.address} 上的prompt停滞, 重新排队({stalls}/{self._maxStallAttempts}): {e}")
+                continue
+            except OSError as e:
+                attempts += 1
+                if attempts > self._maxResubmit:
+                    self._setException(future, e)
+                    return
+                log.warn(f"comfyui后端 {backend.address} 失败, 重新分配prompt({attempts}/{self._maxResubmit}): {e}")
+                continue
+            except Exception as e:
+                self._setException(future, e)
+                return
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _setException(future: asyncio.Future, e: BaseException):
+        if not future.done():
+            future.set_exception(e)
@@ -1,122 +1,182 @@
-import hashlib
-import io
+import asyncio
+import concurrent.futures
 import json
 import os.path
+import threading
 import time
-import urllib.parse
-import urllib.request
-import uuid
-from typing import List, Dict
-
-import websocket  # NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
-from PIL import Image
+from concurrent.futures import Executor
+from typing import List, Dict, Coroutine, Any, Optional
 
 from src import log
 from src.config import config
+from src.socket.comfyui_client import PromptResult
+from src.socket.comfyui_pool import ComfyuiPool
+from src.utils.encoder import createEncodeExecutor, encodeJpeg, keepRaw, OutputCodec, COMPRESSED_EXTENSIONS
 
-server_address = "127.0.0.1:7860"
-client_id = str(uuid.uuid4())
+# 流水线模式下多个线程会同时写入调试记录文件
+_recordLock = threading.Lock()
 
 
 class Comfyui:
+    """
+    ComfyuiPool 的同步封装，事件循环运行在独立线程中，供 FlowParser 等同步代码调用
+    """
+
     def __init__(self):
-        self.ws = websocket.WebSocket()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="comfyui-loop", daemon=True)
+        self._thread.start()
+        self._encoder: Executor = createEncodeExecutor(config.comfyui_encode_executor, config.comfyui_encode_workers)
+        # 进行中的编码按调用线程分开记录，流水线模式下每个order的 flush() 只等待自己的图片
+        self._local = threading.local()
+        self._pool = ComfyuiPool(
+            [(server.address, server.workflows) for server in config.comfyui_servers],
+            config.comfyui_queue_poll_interval,
+            config.comfyui_max_resubmit,
+            config.comfyui_stall_max_attempts,
+            downloadConcurrency=config.comfyui_download_concurrency,
+            reconnectAttempts=config.comfyui_reconnect_attempts,
+            reconnectInitialDelay=config.comfyui_reconnect_initial_delay,
+            reconnectMaxDelay=config.comfyui_reconnect_max_delay,
+            promptTimeout=config.comfyui_prompt_timeout,
+            nodeStallTimeout=config.comfyui_node_stall_timeout,
+        )
         try:
-            self.ws.connect("ws://{}/ws?clientId={}".format(server_address, client_id))
-        except ConnectionRefusedError as e:
-            log.fatal(f"连接comfyui失败，可能是因为没有启动造成的: {e}")
+            self._call(self._pool.connect())
+        except OSError as e:
+            log.fatal(f"连接comfyui失败，已重试{config.comfyui_reconnect_attempts}次，可能是因为没有启动造成的: {e}")
+
+    @property
+    def _encoding(self) -> List[tuple[str, concurrent.futures.Future]]:
+        if not hasattr(self._local, "encoding"):
+            self._local.encoding = []
+        return self._local.encoding
+
+    @_encoding.setter
+    def _encoding(self, value: List[tuple[str, concurrent.futures.Future]]):
+        self._local.encoding = value
+
+    def _call(self, coro: Coroutine) -> Any:
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
 
     def close(self):
-        if self.ws and self.ws.connected:
-            self.ws.close()
-            log.info("WebSocket closed.")
+        self.flush()
+        self._encoder.shutdown()
+        if self._loop.is_running():
+            self._call(self._pool.close())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def size(self) -> int:
+        """
+        可以同时执行prompt的后端数量
+        """
+        return self._pool.size()
+
+    def capacity(self) -> int:
+        """
+        同时保持在comfyui队列中的prompt数量: 每个后端一个正在执行的prompt加上 prefetch 个预先排队的prompt
+        """
+        return self.size() * (1 + config.comfyui_prefetch)
 
     @staticmethod
-    def saveRecord(jsonFile: str):
-        with open(config.record_path, mode="w+", encoding="utf-8") as _f:
-            json.dump(json.loads(jsonFile), _f, ensure_ascii=False, indent=4)
-
-    def send(self, workflow: str, savePath: str) -> (List[str], Dict[str, List[dict]]):
+    def saveRecord(jsonFile: str | dict):
+        workflow = json.loads(jsonFile) if isinstance(jsonFile, str) else jsonFile
+        with _recordLock, open(config.record_path, mode="w+", encoding="utf-8") as _f:
+            json.dump(workflow, _f, ensure_ascii=False, indent=4)
+
+    def sendAsync(self, workflow: str | dict, savePath: str, workflowName: str = "",
+                  affinity: Optional[tuple] = None) -> concurrent.futures.Future:
+        """
+        提交工作流但不等待执行结果，配合 receive() 可以同时在多个后端上保持多个批次
+        :param workflow: 工作流JSON字符串, 或 WorkFlowParser.getWorkFlowDict() 得到的字典(免去一次解析)
+        """
         self.saveRecord(workflow)
-
-        images, outputs = self.get_images(json.loads(workflow))
+        return self.submit(json.loads(workflow) if isinstance(workflow, str) else workflow,
+                           workflowName, savePath, affinity)
+
+    def receive(self, future: concurrent.futures.Future, savePath: str) -> (List[str], Dict[str, List[dict]], dict):
+        """
+        等待prompt执行完毕，并将输出图片交给编码池转换为JPEG
+        返回的路径在 flush() 之后才保证写入完成，编码与下一个批次的生成/下载重叠进行
+
+        output_codec 为 passthrough / final 时直接保留comfyui输出的原始文件(PNG/WebP)，
+        final 模式会在后处理结束后由 extraImgPostProcess 统一编码一次
+        :return: (输出文件路径, comfyui的节点输出, prompt的执行耗时记录)
+        """
+        result: PromptResult = future.result()
+        self._recordOutputs(result)
+        images = result.images
 
         outputList: list[str] = []
         for node_id in images:
-            for image_data in images[node_id]:
-                hasher = hashlib.sha256()
-                hasher.update(image_data)
+            for image in images[node_id]:
                 tic = int(time.time() * 1000)
-                filename_base = f"{tic}-{hasher.hexdigest()}"
-                path = os.path.join(savePath, f"{filename_base}.jpg")
-
-                try:
-                    img = Image.open(io.BytesIO(image_data))
-                    if img.mode == 'RGBA' or img.mode == 'P':
-                        img = img.convert('RGB')
-                    elif img.mode != 'RGB' and img.mode != 'L':  # L is grayscale, also supported by JPG
-                        log.warn(
-                            f"Image {filename_base} has mode {img.mode}, attempting to save as JPG. May cause issues if not RGB/L.")
-                    img.save(path, format='JPEG', quality=95)  # Adjust quality (0-100) as needed
-                    outputList.append(path)
-
-                except Exception as e:
-                    log.error(f"Failed to process and save image {filename_base}.jpg: {e}")
-                    # Optionally save the raw data as PNG for debugging
-                    # fallback_path = os.path.join(savePath, f"{filename_base}_error.png")
-                    # try:
-                    #     with open(fallback_path, mode="wb") as f_err:
-                    #         f_err.write(image_data)
-                    #     log.warn(f"Saved raw image data to {fallback_path} due to conversion error.")
-                    # except IOError as io_err:
-                    #     log.error(f"Failed to save fallback PNG {fallback_path}: {io_err}")
-
-        return outputList, outputs
-
-    @staticmethod
-    def queue_prompt(prompt):
-        p = {"prompt": prompt, "client_id": client_id}
-        data = json.dumps(p).encode('utf-8')
-        req = urllib.request.Request("http://{}/prompt".format(server_address), data=data)
-        return json.loads(urllib.request.urlopen(req).read())
-
-    @staticmethod
-    def get_image(filename, subfolder, folder_type):
-        data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-        url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen("http://{}/view?{}".format(server_address, url_values)) as response:
-            return response.read()
-
-    @staticmethod
-    def get_history(prompt_id):
-        with urllib.request.urlopen("http://{}/history/{}".format(server_address, prompt_id)) as response:
-            return json.loads(response.read())
-
-    def get_images(self, prompt)->(dict,dict):
-        prompt_id = self.queue_prompt(prompt)['prompt_id']
-        output_images = {}
-        while True:
-            out = self.ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message['type'] == 'executing':
-                    data = message['data']
-                    if data['node'] is None and data['prompt_id'] == prompt_id:
-                        break  # Execution is done
-            else:
+                filename_base = f"{tic}-{image.sha256}"
+                if any(os.path.basename(p).startswith(filename_base) for p in outputList):
+                    # 同一批次中内容相同的输出(固定种子)不能编码到同一个文件
+                    filename_base = f"{filename_base}-{len(outputList)}"
+                extension = os.path.splitext(image.filename)[1].lower() or ".png"
+                if config.comfyui_output_codec == OutputCodec.JPEG.value and extension not in COMPRESSED_EXTENSIONS:
+                    path = os.path.join(savePath, f"{filename_base}.jpg")
+                    encoding = self._encoder.submit(encodeJpeg, image.path or image.data, path,
+                                                    config.comfyui_jpeg_quality)
+                else:
+                    path = os.path.join(savePath, f"{filename_base}{extension}")
+                    encoding = self._encoder.submit(keepRaw, image.path or image.data, path)
+                encoding.add_done_callback(lambda _f, _image=image, _path=path: _image.discard()
+                                           if not _f.exception() and _image.path != _path else None)
+                self._encoding.append((path, encoding))
+                outputList.append(path)
+
+        timing = result.timing.toDict() if result.timing else {}
+        if result.timing:
+            log.debug(f"prompt {result.promptID} 排队 {timing['queue_wait']:.2f}s 执行 {timing['execution_time']:.2f}s "
+                      f"缓存节点 {len(result.timing.cachedNodes)} 个, 最慢节点: {result.timing.slowestNodes()}")
+        return outputList, result.outputs, timing
+
+    def flush(self) -> List[str]:
+        """
+        等待当前线程提交的所有图片编码完成
+        :return: 编码失败的图片路径
+        """
+        failed: List[str] = []
+        totalSeconds = 0.0
+        encoding, self._encoding = self._encoding, []
+        for path, future in encoding:
+            try:
+                _, seconds, warning = future.result()
+            except Exception as e:
+                log.error(f"Failed to process and save image {os.path.basename(path)}: {e}")
+                failed.append(path)
                 continue
+            if warning:
+                log.warn(warning)
+            totalSeconds += seconds
+            log.debug(f"图片保存完成: {path} 耗时 {seconds:.3f}s")
+
+        if len(encoding) > len(failed):
+            log.info(f"保存了 {len(encoding) - len(failed)} 张图片, "
+                     f"平均每张耗时 {totalSeconds / (len(encoding) - len(failed)):.3f}s")
+        return failed
+
+    def submit(self, prompt: dict, workflowName: str = "", downloadPath: str = "",
+               affinity: Optional[tuple] = None) -> concurrent.futures.Future:
+        """
+        将prompt加入comfyui队列，不等待执行结果
+        :param prompt: API格式的工作流
+        :param workflowName: 工作流文件名称，用于选择可以执行的后端
+        :param downloadPath: 输出图片流式下载到的目录，为空则保存在内存中
+        :param affinity: prompt使用的模型组合，用于优先选择已加载相同模型的后端
+        :return: 得到 PromptResult 的future
+        """
+
+        async def _submit() -> PromptResult:
+            return await (await self._pool.submit(prompt, workflowName, downloadPath, affinity))
+
+        return asyncio.run_coroutine_threadsafe(_submit(), self._loop)
 
-        history = self.get_history(prompt_id)[prompt_id]
-
-        with open(config.record_comfyui_outputs_path, mode="w+", encoding="utf-8") as f:
-            f.write(json.dumps(history))
-
-        for node_id in history['outputs']:
-            node_output = history['outputs'][node_id]
-            images_output = []
-            if 'images' in node_output:
-                for image in node_output['images']:
-                    image_data = self.get_image(image['filename'], image['subfolder'], image['type'])
-                    images_output.append(image_data)
-            output_images[node_id] = images_output
-        return output_images, history['outputs']
\ No newline at end of file
+    @staticmethod
+    def _recordOutputs(result: PromptResult):
+        with _recordLock, open(config.record_comfyui_outputs_path, mode="w+", encoding="utf-8") as f:
+            f.write(json.dumps(result.history))
@@ -1,4 +1,5 @@
 import os
+import threading
 from typing import List, Optional
 
 from src import log
@@ -39,18 +40,22 @@ class Uploader:
     def __init__(self):
         self.historyOrder: List[Order] = []
         self.allOrderNumber: int = 0
+        self._lock = threading.Lock()  # 多个upload块同时上传时保护历史记录
+        self._inputLock = threading.Lock()  # 同一时间只有一个upload块在控制台询问
 
     def _replaceKeyword(self, order: Order, text: str) -> str:
         ci = CaptionInfo()
         previousUrl = ""
-        if self.historyOrder:  # 检查历史记录是否为空
+        if order.dependsOn:
+            previousUrl = order.dependsOn.dstURL
+        elif self.historyOrder:  # 检查历史记录是否为空, 从order记录恢复时没有依赖关系
             lastCompletedOrder = self.historyOrder[-1]  # 获取最后一个完成的 order
             previousUrl = lastCompletedOrder.dstURL if lastCompletedOrder.dstURL else ""  # 获取其 URL
         ci.url = previousUrl
 
         ci.number = order.len()
-        # self.allOrderNumber 在这里获取的是处理当前 order *之前* 的总数
-        ci.allNumber = self.allOrderNumber
+        # script中排在当前 order 之前的图片总数; 从order记录恢复时没有位置信息, 使用已上传的总数
+        ci.allNumber = order.imagesBefore if order.imagesBefore is not None else self.allOrderNumber
         caption = parseCaption(text, ci)
         order.ui.debug(f"处理后的 keyword: {caption}")
         return caption
@@ -82,22 +87,50 @@ class Uploader:
             return
 
     def append(self, order: Order):
+        tagAnalysisResult = self.tag(order)
+        if tagAnalysisResult is None:
+            order.finished.set()
+            return
+        self.upload(order, tagAnalysisResult)
+
+    def tag(self, order: Order) -> Optional[TagAnalysisResult]:
+        """
+        打标签阶段: 分析order的tag，失败时在控制台询问是否重试
+        :return: tag分析结果, 放弃重试时为None
+        """
         self._check(order)
 
         # 进行洗牌
-        tagAnalysisResult: Optional[TagAnalysisResult] = None
         while True:
             try:
-                tagAnalysisResult = parseImgTags(order)
-                break
+                return parseImgTags(order)
             except Exception as e:
                 order.ui.warn(f"tag分析失败: {e}")
-                ok = input("遇到意外失败,是否重试(y/n):").lower()
+                with self._inputLock:
+                    ok = input(f"uploads[{order.ui._uploadIndex}]遇到意外失败,是否重试(y/n):").lower()
                 if ok == "y" or ok == "yes":
                     continue
                 else:
+                    return None
+
+    def upload(self, order: Order, tagAnalysisResult: TagAnalysisResult):
+        """
+        上传阶段: 按照order的目标网站上传文件
+        依赖其它upload块的URL时，等待被依赖的upload块完成后再开始
+        """
+        try:
+            if order.dependsOn:
+                order.ui.debug(f"等待upload块[{order.dependsOn.ui._uploadIndex}]上传完成")
+                order.dependsOn.finished.wait()
+                if not order.dependsOn.dstURL and order.ui.targetWebsiteName != "test":
+                    # 被依赖的upload块被跳过或上传失败, 不发布 %url% 为空的描述; 依赖该order的upload块同样被跳过
+                    order.ui.error(f"依赖的upload块[{order.dependsOn.ui._uploadIndex}]没有得到URL, 跳过该upload块")
                     return
+            self._upload(order, tagAnalysisResult)
+        finally:
+            order.finished.set()
 
+    def _upload(self, order: Order, tagAnalysisResult: TagAnalysisResult):
         keepTags = [tagAnalysisResult.source, tagAnalysisResult.character]
 
         # 处理描述
@@ -108,14 +141,14 @@ class Uploader:
         # 拓展文件上传
         extensionFileContext = self._parseExtensionFileContext(order)
         if extensionFileContext:
-            extensionFileContextPath = os.path.join(config.output_path, "download_link.txt")
+            extensionFileContextPath = os.path.join(order.uploadDir(), "download_link.txt")
             createFile(extensionFileContextPath, extensionFileContext)
             files.append(extensionFileContextPath)
 
         # 如果启用了压缩上传
         if order.ui.targetPackerEnable:
             zipFilePath = compressFilesToZip(files[order.ui.targetPackerStartPos:],
-                                             os.path.join(config.output_path, "download_link.zip"))
+                                             os.path.join(order.uploadDir(), "download_link.zip"))
             if not zipFilePath:
                 order.ui.fatal("上传文件压缩失败")
             files = files[:order.ui.targetPackerStartPos]
@@ -226,5 +259,6 @@ class Uploader:
             case _:
                 order.ui.fatal(f"无效的上传网站: {order.ui.targetWebsiteName}")
 
-        self.historyOrder.append(order)
-        self.allOrderNumber += order.len()
+        with self._lock:
+            self.historyOrder.append(order)
+            self.allOrderNumber += order.len()
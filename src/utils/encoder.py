@@ -0,0 +1,68 @@
+import enum
+import io
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+# 注意: 该模块会在进程池的子进程中被导入，不要在这里导入 src.log / src.config，
+# 否则每个子进程都会重新初始化日志并覆盖日志文件
+# spawn方式(Windows)的子进程还会重新执行 main.py, 因此 main.py 只在 __main__ 中导入程序
+
+
+# comfyui按要求直接输出的压缩格式，已经是最终格式，不需要再次编码
+COMPRESSED_EXTENSIONS = (".jpg", ".jpeg", ".webp")
+
+
+class OutputCodec(enum.Enum):
+    JPEG = "jpeg"  # 下载后立即编码为JPEG
+    PASSTHROUGH = "passthrough"  # 保留comfyui输出的原始文件，不做任何编码
+    FINAL = "final"  # 后处理期间保留原始文件，全部后处理结束后编码一次JPEG
+
+
+def createEncodeExecutor(kind: str, workers: int) -> Executor:
+    """
+    创建图片编码使用的线程池或进程池
+    :param kind: "thread" 或 "process"
+    :param workers: 工作者数量
+    """
+    workers = max(1, workers)
+    if kind.lower() == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-encode")
+
+
+def encodeJpeg(source: str | bytes, path: str, quality: int = 95) -> tuple[str, float, str]:
+    """
+    将图片重新编码为JPEG
+    :param source: 原始图片的文件路径或内容
+    :param path: JPEG的保存路径
+    :param quality: JPEG质量(0-100)
+    :return: (保存路径, 编码耗时秒数, 警告信息)
+    """
+    tic = time.perf_counter()
+    warning = ""
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+        if img.mode == 'RGBA' or img.mode == 'P':
+            img = img.convert('RGB')
+        elif img.mode != 'RGB' and img.mode != 'L':  # L is grayscale, also supported by JPG
+            warning = f"Image {path} has mode {img.mode}, attempting to save as JPG. May cause issues if not RGB/L."
+        img.save(path, format='JPEG', quality=quality)
+    return path, time.perf_counter() - tic, warning
+
+
+def keepRaw(source: str | bytes, path: str) -> tuple[str, float, str]:
+    """
+    不重新编码，直接保留comfyui输出的原始文件
+    :param source: 原始图片的文件路径或内容
+    :param path: 保存路径
+    :return: (保存路径, 耗时秒数, 警告信息)
+    """
+    tic = time.perf_counter()
+    if isinstance(source, bytes):
+        with open(path, mode="wb") as f:
+            f.write(source)
+    elif os.path.abspath(source) != os.path.abspath(path):
+        os.replace(source, path)
+    return path, time.perf_counter() - tic, ""
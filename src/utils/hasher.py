@@ -1,10 +1,61 @@
 import hashlib
+import json
+import os
 import random
+import threading
 import time
 
-_SALT = random.randint(0, 2 ** 32 - 1)
+from src import log
+from src.config import config
+
 _MASK_63_BIT = 2 ** 63 - 1
 
+_SALT: str | None = None
+_saltLock = threading.Lock()
+
+
+def _loadSalt() -> str:
+    """
+    读取项目的持久化盐, 不存在时生成并保存, 使 uniform_string 得到的种子在多次运行之间保持一致
+    """
+    try:
+        with open(config.salt_path, mode="r", encoding="utf-8") as f:
+            salt = json.load(f).get("salt")
+        if salt is not None:
+            return str(salt)
+        log.warn(f"盐文件中没有salt键, 将重新生成: {config.salt_path}")
+    except FileNotFoundError:
+        pass
+    except (OSError, json.JSONDecodeError) as e:
+        log.warn(f"读取盐文件失败, 将重新生成: {config.salt_path}, {e}")
+
+    salt = str(random.randint(0, 2 ** 32 - 1))
+    try:
+        os.makedirs(os.path.dirname(config.salt_path), exist_ok=True)
+        with open(config.salt_path, mode="w", encoding="utf-8") as f:
+            json.dump({"salt": salt}, f)
+        log.info(f"已生成新的种子盐: {config.salt_path}")
+    except OSError as e:
+        log.warn(f"保存盐文件失败, 本次运行的种子无法在下次运行时复现: {e}")
+    return salt
+
+
+def getSalt() -> str:
+    global _SALT
+    with _saltLock:
+        if _SALT is None:
+            _SALT = _loadSalt()
+        return _SALT
+
+
+def setSalt(salt: str | int):
+    """
+    覆盖当前进程使用的盐, 用于script中global块的salt设置
+    """
+    global _SALT
+    with _saltLock:
+        _SALT = str(salt)
+
 
 def hashMixSalt(string: str) -> int:
     """
@@ -13,11 +64,23 @@ def hashMixSalt(string: str) -> int:
     :return:
     """
     hasher = hashlib.sha256()
-    hasher.update((string + str(_SALT)).encode())
+    hasher.update((string + getSalt()).encode())
     hashInt = int.from_bytes(hasher.digest(), byteorder='big')
     return hashInt & _MASK_63_BIT
 
 
+def deriveSeed(uniformString: str, orderIndex: int, imageIndex: int, nodeIndex: int = 0) -> int:
+    """
+    由 uniform_string 派生每张图片(及同一工作流中每个种子节点)的确定性种子
+    相同的盐与参数总是得到相同的种子, 重新运行或恢复时可以命中生成结果缓存与comfyui的节点缓存
+    :param uniformString: 统一标识字符
+    :param orderIndex: upload块序号
+    :param imageIndex: 图片在upload块中的序号
+    :param nodeIndex: 同一工作流中第几个种子节点
+    """
+    return hashMixSalt(f"{uniformString}\x00{orderIndex}\x00{imageIndex}\x00{nodeIndex}")
+
+
 if __name__ == '__main__':
     print(hashMixSalt("test"))
     time.sleep(2)
@@ -1,35 +1,330 @@
 import json
 import os
-from typing import Callable, Any, List, Type, Dict
+import threading
+from collections import OrderedDict
+from typing import Callable, Any, List, Type, Dict, Optional
 
 from src import log
 from src.config import config
 
 
+# 加载模型的节点类型及其指定模型文件的输入, 这些输入相同的工作流共享comfyui中已加载的模型
+LOADER_NODE_INPUTS: Dict[str, List[str]] = {
+    "CheckpointLoaderSimple": ["ckpt_name"],
+    "CheckpointLoader": ["ckpt_name", "config_name"],
+    "UNETLoader": ["unet_name"],
+    "CLIPLoader": ["clip_name"],
+    "DualCLIPLoader": ["clip_name1", "clip_name2"],
+    "VAELoader": ["vae_name"],
+    "LoraLoader": ["lora_name"],
+    "LoraLoaderModelOnly": ["lora_name"],
+}
+
+# 生成空latent的节点类型
+LATENT_SOURCE_NODES = ("EmptyLatentImage", "EmptySD3LatentImage")
+
+# 编译模板时预先记录位置的键, 每个批次都会修改它们
+TEMPLATE_INDEXED_KEYS = ("seed", "batch_size", "text")
+
+
+def _findKeyPaths(data: Any, key: str, path: tuple, results: List[tuple]):
+    """
+    深度优先查找所有名为key的键的位置, 匹配的值内部不再继续查找
+    """
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k == key:
+                results.append(path + (k,))
+            else:
+                _findKeyPaths(v, key, path + (k,), results)
+    elif isinstance(data, list):
+        for i, item in enumerate(data):
+            _findKeyPaths(item, key, path + (i,), results)
+
+
+def _findPlaceholderPaths(data: Any, path: tuple, results: List[tuple]):
+    if isinstance(data, dict):
+        for k, v in data.items():
+            _findPlaceholderPaths(v, path + (k,), results)
+    elif isinstance(data, list):
+        for i, item in enumerate(data):
+            _findPlaceholderPaths(item, path + (i,), results)
+    elif isinstance(data, str) and "%" in data:
+        results.append(path)
+
+
+def _collectKeys(data: Any, keys: set):
+    if isinstance(data, dict):
+        for k, v in data.items():
+            keys.add(k)
+            _collectKeys(v, keys)
+    elif isinstance(data, list):
+        for item in data:
+            _collectKeys(item, keys)
+
+
+class NodeIndex:
+    """
+    工作流节点的索引: 按 class_type、_meta.title 以及键名查找节点, 不再遍历整个JSON
+
+    byKey 记录顶层、节点、节点的 inputs / _meta 三层中每个键的位置, 顺序与深度优先遍历一致;
+    更深层出现过的键记录在 deepKeys 中, 查询这些键时仍需要遍历
+    """
+
+    def __init__(self, workFlow: dict):
+        self.byClass: Dict[str, List[str]] = {}
+        self.byTitle: Dict[str, List[str]] = {}
+        self.byKey: Dict[str, List[tuple]] = {}
+        self.deepKeys: set = set()
+        for nodeID, node in workFlow.items():
+            self._addKey(nodeID, (nodeID,))
+            if not isinstance(node, dict):
+                _collectKeys(node, self.deepKeys)
+                continue
+            classType = node.get("class_type")
+            if isinstance(classType, str):
+                self.byClass.setdefault(classType, []).append(nodeID)
+            meta = node.get("_meta")
+            if isinstance(meta, dict) and isinstance(meta.get("title"), str):
+                self.byTitle.setdefault(meta["title"], []).append(nodeID)
+            for k, v in node.items():
+                self._addKey(k, (nodeID, k))
+                if k in ("inputs", "_meta") and isinstance(v, dict):
+                    for inputName, value in v.items():
+                        self._addKey(inputName, (nodeID, k, inputName))
+                        _collectKeys(value, self.deepKeys)
+                else:
+                    _collectKeys(v, self.deepKeys)
+
+    def _addKey(self, key: str, path: tuple):
+        self.byKey.setdefault(key, []).append(path)
+
+    def nodesWithInput(self, key: str) -> List[str]:
+        return [path[0] for path in self.byKey.get(key, []) if len(path) == 3 and path[1] == "inputs"]
+
+
+class WorkflowTemplate:
+    """
+    编译后的工作流: 只解析一次JSON, 并预先记录 seed / batch_size / text 以及 %占位符% 的位置
+    模板本身不会被修改, WorkFlowParser 在它的写时复制副本上修改
+    """
+
+    def __init__(self, workFlow: dict):
+        self.workFlow: dict = workFlow
+        self.paths: Dict[str, List[tuple]] = {}
+        for key in TEMPLATE_INDEXED_KEYS:
+            self.paths[key] = []
+            _findKeyPaths(workFlow, key, (), self.paths[key])
+        self.placeholders: List[tuple] = []
+        _findPlaceholderPaths(workFlow, (), self.placeholders)
+        self.index: NodeIndex = NodeIndex(workFlow)
+
+    @classmethod
+    def fromString(cls, text: str) -> "WorkflowTemplate":
+        return cls(json.loads(text))
+
+
+class WorkflowCache:
+    """
+    进程内的工作流文件缓存, 以文件路径为键保存编译好的模板
+    每次读取都会比较文件的修改时间与大小, 文件被修改后重新解析; 超过 maxSize 时淘汰最久未使用的模板
+    """
+
+    def __init__(self, maxSize: int):
+        self._maxSize = maxSize
+        self._entries: OrderedDict[str, tuple[int, int, WorkflowTemplate]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> WorkflowTemplate:
+        """
+        :raise OSError: 文件无法读取
+        :raise json.JSONDecodeError: 文件不是有效的JSON
+        """
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                self._entries.move_to_end(path)
+                return entry[2]
+
+        with open(path, mode="r", encoding="utf-8") as f:
+            template = WorkflowTemplate.fromString(f.read())
+        if self._maxSize <= 0:
+            return template
+
+        with self._lock:
+            self._entries[path] = (stat.st_mtime_ns, stat.st_size, template)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._maxSize:
+                self._entries.popitem(last=False)
+        return template
+
+    def warm(self, dirPath: str) -> int:
+        """
+        预先解析目录中的全部工作流文件
+        :return: 成功缓存的工作流数量
+        """
+        if not os.path.isdir(dirPath):
+            return 0
+        count = 0
+        for name in sorted(os.listdir(dirPath)):
+            path = os.path.join(dirPath, name)
+            if not name.lower().endswith(".json") or not os.path.isfile(path):
+                continue
+            if count >= self._maxSize:
+                log.debug(f"工作流缓存已满, 不再预加载: {name}")
+                break
+            try:
+                self.get(path)
+            except (OSError, ValueError) as e:
+                log.warn(f"预加载工作流失败: {path}, {e}")
+                continue
+            count += 1
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+workflowCache = WorkflowCache(config.comfyui_workflow_cache_size)
+
+
 class WorkFlowParser:
     """
     批量对工作流API节点进行批量或顺序操作
+
+    所有修改都作用在模板的写时复制副本上: 只复制被修改的节点, 未修改的节点与模板共享,
+    直到 getWorkFlow() 发送时才序列化一次
     """
 
     def __init__(self):
-        self.workFlow: str = ""
+        self._template: Optional[WorkflowTemplate] = None
+        self._workFlow: dict = {}
+        self._owned: set = set()  # 当前副本中已经复制过、可以直接修改的容器
+        self._structureChanged: bool = False  # 节点被替换或新增后, 模板中记录的位置不再可靠
+        self._raw: Optional[str] = None  # 尚未解析的工作流字符串
+        self._index: Optional[NodeIndex] = None  # 结构改变后重新建立的索引
+
+    @property
+    def workFlow(self) -> str:
+        return self.getWorkFlow()
+
+    @workFlow.setter
+    def workFlow(self, wf: str):
+        self.reloadWorkFlow(wf)
 
     def reloadFile(self, workflowName: str):
         workflowPath = os.path.join(config.workflow_path,workflowName)
         if not os.path.isfile(workflowPath):
             log.fatal(f"工作流不存在: {workflowPath}")
 
-        with open(workflowPath, mode="r", encoding="utf-8") as f:
-            try:
-                self.workFlow: str = f.read()
-            except Exception as e:
-                log.fatal(f"无效的iterScript配置：{e}")
+        try:
+            self.loadTemplate(workflowCache.get(workflowPath))
+        except Exception as e:
+            log.fatal(f"无效的iterScript配置：{e}")
 
     def reloadWorkFlow(self, wf: str):
         if not isinstance(wf, str):
             log.error(f"重载工作流时遇到了意外错误：{wf}")
 
-        self.workFlow = wf
+        # 延迟到第一次读取或修改时再解析
+        self._template = None
+        self._raw = wf
+
+    def loadTemplate(self, template: WorkflowTemplate):
+        """
+        以编译好的模板开始一个新的副本
+        """
+        self._template = template
+        self._raw = None
+        self._workFlow = dict(template.workFlow)
+        self._owned = {id(self._workFlow)}
+        self._structureChanged = False
+        self._index = None
+
+    def loadWorkFlowDict(self, workFlow: dict):
+        """
+        直接使用已经解析好的工作流(例如comfyui返回的节点输出), 不会修改传入的字典
+        """
+        self.loadTemplate(WorkflowTemplate(workFlow))
+
+    def _current(self) -> dict:
+        if self._raw is not None:
+            self.loadTemplate(WorkflowTemplate.fromString(self._raw))
+        return self._workFlow
+
+    def _own(self, container: Any) -> Any:
+        if id(container) in self._owned:
+            return container
+        copied = dict(container) if isinstance(container, dict) else list(container)
+        self._owned.add(id(copied))
+        return copied
+
+    def _set(self, path: tuple, value: Any):
+        """
+        写时复制: 只复制从根到目标位置路径上的容器
+        """
+        container = self._current()
+        for step in path[:-1]:
+            child = self._own(container[step])
+            container[step] = child
+            container = child
+        container[path[-1]] = value
+
+    def _get(self, path: tuple) -> Any:
+        data = self._current()
+        for step in path:
+            data = data[step]
+        return data
+
+    def _nodeIndex(self) -> NodeIndex:
+        self._current()
+        if not self._structureChanged:
+            return self._template.index
+        if self._index is None:
+            self._index = NodeIndex(self._workFlow)
+        return self._index
+
+    def findNodes(self, classType: Optional[str] = None, title: Optional[str] = None,
+                  inputKey: Optional[str] = None) -> List[str]:
+        """
+        按条件查找节点ID, 多个条件同时满足, 例如 findNodes("KSampler", inputKey="seed")
+        """
+        index = self._nodeIndex()
+        candidates: Optional[List[str]] = None
+        for nodeIDs in (index.byClass.get(classType, []) if classType is not None else None,
+                        index.byTitle.get(title, []) if title is not None else None,
+                        index.nodesWithInput(inputKey) if inputKey is not None else None):
+            if nodeIDs is None:
+                continue
+            candidates = nodeIDs if candidates is None else [nodeID for nodeID in candidates if nodeID in nodeIDs]
+        if candidates is None:
+            return list(self._workFlow)
+        return candidates
+
+    def resolveNodes(self, name: str) -> List[str]:
+        """
+        节点ID, 或者 _meta.title 为name的所有节点
+        """
+        if isinstance(self._current().get(name), dict):
+            return [name]
+        return self.findNodes(title=name)
+
+    def getNode(self, nodeID: str) -> Optional[dict]:
+        """
+        节点的只读视图, 修改请使用 setUnsafelyNodeID / setNodeInputs
+        """
+        node = self._current().get(nodeID)
+        return node if isinstance(node, dict) else None
+
+    def _keyPaths(self, key: str) -> List[tuple]:
+        self._current()
+        if not self._structureChanged and key in self._template.paths:
+            return self._template.paths[key]
+        paths: List[tuple] = []
+        _findKeyPaths(self._workFlow, key, (), paths)
+        return paths
 
     @staticmethod
     def _checkFormat(k, v, typ, keyword):
@@ -55,24 +350,148 @@ class WorkFlowParser:
         self._replace(str(key), str(value))
 
     def setUnsafelyNodeID(self, nodeID: str, key: str, value: Any):
-        workFlow: dict = json.loads(self.workFlow)
-
-        node = workFlow.get(nodeID)
+        node = self._current().get(nodeID)
         inputs = node.get("inputs")
         if not inputs:
             log.fatal(f"setUnsafelyNodeID: 尝试获取{node}的inputs键失败")
-        inputs[key] = value
+        self._set((nodeID, "inputs", key), value)
 
-        self.workFlow = json.dumps(workFlow)
+    def replaceNodeClass(self, classTypes: List[str], newClassType: str, inputs: Dict[str, Any]) -> List[str]:
+        """
+        将所有class_type属于classTypes的节点替换为newClassType，保留原节点的images输入
+        :param classTypes: 要替换的节点类型
+        :param newClassType: 替换后的节点类型
+        :param inputs: 替换后节点额外的输入
+        :return: 被替换的节点ID
+        """
+        workFlow = self._current()
+        replaced: List[str] = []
+        for nodeID, node in workFlow.items():
+            if not isinstance(node, dict) or node.get("class_type") not in classTypes:
+                continue
+            newInputs = {"images": node.get("inputs", {}).get("images")}
+            newInputs.update(inputs)
+            newNode = dict(node)
+            newNode["class_type"] = newClassType
+            newNode["inputs"] = newInputs
+            self._owned.update((id(newNode), id(newInputs)))
+            workFlow[nodeID] = newNode
+            replaced.append(nodeID)
+
+        if replaced:
+            self._structureChanged = True
+            self._index = None
+        log.debug(f"已将节点{replaced}替换为{newClassType}")
+        return replaced
+
+    def setSaveFormat(self, outputFormat: str, quality: int) -> List[str]:
+        """
+        将SaveImage节点替换为可以直接保存WebP/JPEG的节点，减少从comfyui传输的数据量
+        :param outputFormat: webp / jpg / png
+        :param quality: 压缩质量(0-100)
+        :return: 被替换的节点ID
+        """
+        saveNode = config.comfyui_save_node
+        inputs: Dict[str, Any] = dict(saveNode.inputs)
+        inputs[saveNode.format_input] = outputFormat
+        inputs[saveNode.quality_input] = quality
+        return self.replaceNodeClass(["SaveImage"], saveNode.class_type, inputs)
+
+    def getNodeInputs(self, key: str) -> Dict[str, Any]:
+        """
+        所有拥有该输入的节点 {节点ID: 输入值}, 例如记录每个采样器实际使用的种子
+        """
+        return {nodeID: self._get((nodeID, "inputs", key)) for nodeID in self._nodeIndex().nodesWithInput(key)}
+
+    def setNodeInputs(self, key: str, values: Dict[str, Any]) -> List[str]:
+        """
+        按节点ID设置输入值, 工作流中不存在或没有该输入的节点会被忽略
+        :return: 实际设置的节点ID
+        """
+        workFlow = self._current()
+        applied: List[str] = []
+        for nodeID, value in values.items():
+            node = workFlow.get(nodeID)
+            if isinstance(node, dict) and key in node.get("inputs", {}):
+                self._set((nodeID, "inputs", key), value)
+                applied.append(nodeID)
+        return applied
+
+    def insertLatentFromBatch(self, batchIndex: int, length: int = 1) -> List[str]:
+        """
+        在每个空latent节点之后插入 LatentFromBatch，只对批次中的第batchIndex张进行采样
+        采样器会按照原批次大小生成噪声再取出对应位置，因此与整批生成时该位置的结果相同
+        :return: 插入的节点ID
+        """
+        workFlow = self._current()
+        index = self._nodeIndex()
+        sources = [nodeID for classType in LATENT_SOURCE_NODES for nodeID in index.byClass.get(classType, [])]
+        nextID = max([int(nodeID) for nodeID in workFlow if nodeID.isdigit()] or [0]) + 1
+        inserted: List[str] = []
+        for sourceID in sources:
+            newID = str(nextID)
+            nextID += 1
+            for nodeID, node in list(workFlow.items()):
+                if not isinstance(node, dict):
+                    continue
+                for inputName, value in node.get("inputs", {}).items():
+                    if isinstance(value, list) and len(value) == 2 and value[0] == sourceID:
+                        self._set((nodeID, "inputs", inputName), [newID, value[1]])
+            workFlow[newID] = {
+                "class_type": "LatentFromBatch",
+                "inputs": {"samples": [sourceID, 0], "batch_index": batchIndex, "length": length},
+                "_meta": {"title": "Latent From Batch"},
+            }
+            inserted.append(newID)
+
+        if inserted:
+            self._structureChanged = True
+            self._index = None
+        log.debug(f"在空latent节点{sources}之后插入LatentFromBatch{inserted}: batch_index={batchIndex}")
+        return inserted
+
+    def getModelSet(self) -> tuple:
+        """
+        工作流中所有加载模型节点的 (class_type, 模型文件) 组合, 用于将使用相同模型的批次排在一起
+        """
+        models = set()
+        workFlow = self._current()
+        index = self._nodeIndex()
+        for classType, inputNames in LOADER_NODE_INPUTS.items():
+            for nodeID in index.byClass.get(classType, []):
+                inputs = workFlow[nodeID].get("inputs", {})
+                for inputName in inputNames:
+                    value = inputs.get(inputName)
+                    if isinstance(value, str):
+                        models.add((classType, value))
+        return tuple(sorted(models))
 
     def replace(self, key: str, value):
         self._replace(key, value)
 
     def _replace(self, key, value):
-        self.workFlow = self.workFlow.replace(key, value)
+        if self._raw is None and self._template and not self._structureChanged and key.startswith("%") \
+                and key.endswith("%") and len(key) > 1:
+            # %占位符% 只会出现在字符串值中, 直接修改模板中记录的位置
+            for path in self._template.placeholders:
+                text = self._get(path)
+                if isinstance(text, str) and key in text:
+                    self._set(path, text.replace(key, value))
+            return
+        self._raw = self.getWorkFlow().replace(key, value)
 
     def getWorkFlow(self) -> str:
-        return self.workFlow
+        if self._raw is not None:
+            return self._raw
+        if self._template is None:
+            return ""
+        return json.dumps(self._workFlow)
+
+    def getWorkFlowDict(self) -> dict:
+        """
+        不经过序列化直接得到修改后的工作流, 与模板共享未修改的节点, 调用方不能修改它
+        """
+        return self._current()
 
     def getAllCustomKeyValueType(self, key: str, valueType: Type) -> List[Any]:
         """
@@ -86,13 +505,20 @@ class WorkFlowParser:
             List[Any]: 包含所有找到的匹配值的列表。
         """
         try:
-            workFlowData = json.loads(self.workFlow)
+            index = self._nodeIndex()
         except json.JSONDecodeError as e:
             log.error(f"无法解析工作流JSON以查找键 '{key}': {e}")
             return []  # 解析失败返回空列表
 
         elements: List[Any] = []
-        self._recursiveFindKeyValue(workFlowData, key, valueType, elements)
+        if key in index.deepKeys:
+            # 该键出现在索引未覆盖的深层结构中, 仍然遍历整个工作流
+            self._recursiveFindKeyValue(self._workFlow, key, valueType, elements)
+            return elements
+        for path in index.byKey.get(key, []):
+            value = self._get(path)
+            if isinstance(value, valueType):
+                elements.append(value)
         return elements
 
     def _recursiveFindKeyValue(self, data: Any, target_key: str, target_type: Type, results: List[Any]):
@@ -134,25 +560,9 @@ class WorkFlowParser:
         :param function:
         :return:
         """
-        workFlow = json.loads(self.workFlow)
         randomNumbers: List[int] = []
-
-        def _setAllCustomKeyValue(wf) -> Any:
-            if isinstance(wf, dict):
-                newDict = {}
-                for k, v in wf.items():
-                    if k == key:
-                        var = function()
-                        randomNumbers.append(var)
-                        newDict[k] = var
-                    else:
-                        newDict[k] = _setAllCustomKeyValue(v)
-                return newDict
-            elif isinstance(wf, list):
-                return [_setAllCustomKeyValue(item) for item in wf]
-            else:
-                return wf
-
-        workFlow = _setAllCustomKeyValue(workFlow)
-        self.workFlow = json.dumps(workFlow)
+        for path in self._keyPaths(key):
+            var = function()
+            randomNumbers.append(var)
+            self._set(path, var)
         log.debug(f"设置当前全局键值{key}: {randomNumbers}")
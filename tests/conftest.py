@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# src.config / src.log 在导入时按Windows风格的相对路径创建配置与日志文件, 测试在临时目录中导入它们
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="autoloader-tests-"))
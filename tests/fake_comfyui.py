@@ -0,0 +1,236 @@
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_OPCODE_TEXT = 0x1
+_OPCODE_BINARY = 0x2
+_OPCODE_CLOSE = 0x8
+_OPCODE_PING = 0x9
+_OPCODE_PONG = 0xA
+
+# 一张1x1的PNG
+PNG_1X1 = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==")
+
+
+def _frame(opcode: int, payload: bytes) -> bytes:
+    header = bytes([0x80 | opcode])
+    if len(payload) < 126:
+        header += bytes([len(payload)])
+    elif len(payload) < 65536:
+        header += bytes([126]) + struct.pack(">H", len(payload))
+    else:
+        header += bytes([127]) + struct.pack(">Q", len(payload))
+    return header + payload
+
+
+class _WsConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, message: dict):
+        self.writer.write(_frame(_OPCODE_TEXT, json.dumps(message).encode("utf-8")))
+        await self.writer.drain()
+
+    async def serve(self):
+        """
+        读取客户端的帧, 只处理 ping 与 close
+        """
+        try:
+            while True:
+                b0, b1 = await self.reader.readexactly(2)
+                length = b1 & 0x7F
+                if length == 126:
+                    length = struct.unpack(">H", await self.reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack(">Q", await self.reader.readexactly(8))[0]
+                mask = await self.reader.readexactly(4) if b1 & 0x80 else b"\0\0\0\0"
+                payload = bytes(c ^ mask[i % 4] for i, c in enumerate(await self.reader.readexactly(length)))
+                opcode = b0 & 0x0F
+                if opcode == _OPCODE_PING:
+                    self.writer.write(_frame(_OPCODE_PONG, payload))
+                elif opcode == _OPCODE_CLOSE:
+                    self.writer.write(_frame(_OPCODE_CLOSE, payload[:2]))
+                    await self.writer.drain()
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+
+    def kill(self):
+        """
+        不发送close帧直接断开, 模拟后端崩溃
+        """
+        self.writer.transport.abort()
+
+
+class FakeComfyui:
+    """
+    本地的假comfyui后端: 实现 /prompt /history /queue /view /interrupt 与 /ws
+
+    每个prompt提交后由 behavior 决定推送哪些websocket消息, 默认立即执行完毕并输出一张图片
+    queueDepth 为其它客户端占用的队列长度, /queue 中还包含已提交但尚未写入历史记录的prompt
+    """
+
+    def __init__(self, queueDepth: int = 0):
+        self.queueDepth: int = queueDepth
+        self.prompts: Dict[str, dict] = {}
+        self.queue: List[str] = []
+        self.history: Dict[str, dict] = {}
+        self.interrupts: List[str] = []
+        self.behavior: Callable[["FakeComfyui", str], Awaitable[None]] = FakeComfyui.complete
+        # 设置后在返回 /prompt 的HTTP响应之前执行, 用于让websocket消息先于prompt_id到达
+        self.beforeResponse: Optional[Callable[["FakeComfyui", str], Awaitable[None]]] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._websockets: List[_WsConnection] = []
+        self._connections: List[asyncio.StreamWriter] = []
+        self._background: set = set()
+        self.port: int = 0
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            self._server = None
+        for ws in self._websockets:
+            ws.kill()
+        for writer in self._connections:
+            writer.transport.abort()
+        self._websockets.clear()
+        self._connections.clear()
+        for task in list(self._background):
+            task.cancel()
+
+    async def restart(self):
+        """
+        在同一端口上重启, 队列与历史记录全部丢失
+        """
+        await self.stop()
+        self.queue.clear()
+        self.history.clear()
+        await self.start()
+
+    def dropWebsockets(self):
+        """
+        只断开websocket连接, 队列中的prompt继续保留
+        """
+        for ws in self._websockets:
+            ws.kill()
+        self._websockets.clear()
+
+    def finish(self, promptID: str, output: dict):
+        self.history[promptID] = {"outputs": {"9": output}, "status": {"status_str": "success", "messages": []}}
+        if promptID in self.queue:
+            self.queue.remove(promptID)
+
+    async def broadcast(self, message: dict):
+        for ws in list(self._websockets):
+            try:
+                await ws.send(message)
+            except ConnectionError:
+                pass
+
+    @staticmethod
+    async def complete(server: "FakeComfyui", promptID: str):
+        await server.broadcast({"type": "execution_start", "data": {"prompt_id": promptID}})
+        await server.broadcast({"type": "executing", "data": {"node": "9", "prompt_id": promptID}})
+        output = {"images": [{"filename": f"{promptID}.png", "subfolder": "", "type": "output"}]}
+        await server.broadcast({"type": "executed", "data": {"node": "9", "output": output, "prompt_id": promptID}})
+        server.finish(promptID, output)
+        await server.broadcast({"type": "executing", "data": {"node": None, "prompt_id": promptID}})
+
+    @staticmethod
+    async def hang(server: "FakeComfyui", promptID: str):
+        """
+        开始执行后不再推送任何消息
+        """
+        await server.broadcast({"type": "execution_start", "data": {"prompt_id": promptID}})
+        await server.broadcast({"type": "executing", "data": {"node": "3", "prompt_id": promptID}})
+
+    @staticmethod
+    async def silent(server: "FakeComfyui", promptID: str):
+        """
+        开始执行但不推送任何消息, 相当于客户端错过了 execution_start
+        """
+
+    @staticmethod
+    async def lose(server: "FakeComfyui", promptID: str):
+        """
+        prompt不推送任何消息就从队列中消失
+        """
+        server.queue.remove(promptID)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.append(writer)
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {k.strip().lower(): v.strip() for k, v in
+                           (line.split(":", 1) for line in lines[1:] if ":" in line)}
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = urlsplit(target).path
+
+                if path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                    accept = base64.b64encode(
+                        hashlib.sha1((headers["sec-websocket-key"] + _WS_GUID).encode()).digest()).decode()
+                    writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                                  f"Connection: Upgrade\r\nSec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+                    await writer.drain()
+                    ws = _WsConnection(reader, writer)
+                    self._websockets.append(ws)
+                    await ws.serve()
+                    return
+                status, contentType, payload = await self._route(method, path, body)
+                writer.write((f"HTTP/1.1 {status}\r\nContent-Type: {contentType}\r\n"
+                              f"Content-Length: {len(payload)}\r\nConnection: keep-alive\r\n\r\n").encode() + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, path: str, body: bytes) -> tuple[str, str, bytes]:
+        def _json(data) -> tuple[str, str, bytes]:
+            return "200 OK", "application/json", json.dumps(data).encode("utf-8")
+
+        if method == "POST" and path == "/prompt":
+            promptID = str(uuid.uuid4())
+            self.prompts[promptID] = json.loads(body)["prompt"]
+            self.queue.append(promptID)
+            if self.beforeResponse:
+                await self.beforeResponse(self, promptID)
+            else:
+                task = asyncio.create_task(self.behavior(self, promptID))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            return _json({"prompt_id": promptID, "number": len(self.prompts)})
+        if method == "GET" and path.startswith("/history/"):
+            promptID = path[len("/history/"):]
+            return _json({promptID: self.history[promptID]} if promptID in self.history else {})
+        if method == "GET" and path == "/queue":
+            items = [[i, promptID, {}, {}, []] for i, promptID in enumerate(self.queue)]
+            items += [[len(items) + i, f"other-{i}", {}, {}, []] for i in range(self.queueDepth)]
+            return _json({"queue_running": items[:1], "queue_pending": items[1:]})
+        if method == "GET" and path == "/view":
+            return "200 OK", "image/png", PNG_1X1
+        if method == "POST" and path == "/interrupt":
+            self.interrupts.append(json.loads(body or b"{}").get("prompt_id", ""))
+            return _json({})
+        return "404 Not Found", "text/plain", b"not found"
@@ -0,0 +1,86 @@
+from typing import List
+
+from src.mode_parser.batch_planner import BatchKey, planBatches, splitBatch
+from src.mode_parser.upload_block import Order, UploadInfo
+
+
+def _order(index: int, number: int, batch: int, uniformString: str = "") -> Order:
+    ui = UploadInfo(index)
+    ui.workflowName = "flux.json"
+    ui.number = number
+    ui.batch = batch
+    ui.workflowUniformString = uniformString
+    return Order(ui)
+
+
+def _indexes(batch) -> List[int]:
+    return [image.getIndex() for _, image in batch.members]
+
+
+def test_uniform_orders_are_not_packed_together():
+    first, second = _order(0, 3, 4, "x"), _order(1, 3, 4, "y")
+
+    batches = planBatches([first, second])
+
+    assert [batch.orders() for batch in batches] == [[first], [second]]
+
+
+def test_random_seed_orders_are_packed_together():
+    first, second = _order(0, 3, 4), _order(1, 3, 4)
+
+    batches = planBatches([first, second])
+
+    assert [batch.size() for batch in batches] == [4, 2]
+    assert batches[0].orders() == [first, second]
+
+
+def test_resumed_order_keeps_batch_boundaries_and_seed_indexes():
+    order = _order(0, 8, 4, "x")
+    assert [(batch.seedIndex, _indexes(batch)) for batch in planBatches([order])] == [
+        (0, [0, 1, 2, 3]), (4, [4, 5, 6, 7])]
+
+    for image in order.getImages()[:3]:
+        image.outputPath = "done.png"
+
+    assert [(batch.seedIndex, _indexes(batch)) for batch in planBatches([order])] == [
+        (3, [3]), (4, [4, 5, 6, 7])]
+
+
+def test_split_batch_offsets_seed_index():
+    (batch,) = planBatches([_order(0, 4, 4, "x")])
+
+    assert [(part.seedIndex, _indexes(part)) for part in splitBatch(batch, 2)] == [(0, [0, 1]), (2, [2, 3])]
+
+
+def test_packed_group_uses_smallest_batch_and_merges_remainder():
+    first, second = _order(0, 3, 4), _order(1, 5, 2)
+
+    batches = planBatches([first, second])
+
+    assert [batch.size() for batch in batches] == [2, 2, 2, 2]
+    assert batches[1].orders() == [first, second]
+
+
+def test_sweep_variants_are_batched_separately():
+    order = _order(0, 4, 4, "x")
+    order.ui.workflowSweep = {"3": {"cfg": [5, 7]}}
+    order = Order(order.ui)
+
+    batches = planBatches([order])
+
+    assert [(batch.seedIndex, _indexes(batch)) for batch in batches] == [(0, [0, 1]), (0, [2, 3])]
+    assert [batch.members[0][1].params for batch in batches] == [{"3": {"cfg": 5}}, {"3": {"cfg": 7}}]
+
+
+def test_batch_size_callback_overrides_script_batch():
+    batches = planBatches([_order(0, 5, 4)], lambda key, requested: 2)
+
+    assert [batch.size() for batch in batches] == [2, 2, 1]
+
+
+def test_batch_key_includes_params_and_seed_source():
+    base = BatchKey("flux.json", (), None, "", 0)
+
+    assert base == BatchKey("flux.json", (), None, "", 0)
+    assert base != BatchKey("flux.json", (), None, "", 0, '{"3": {"cfg": 5}}')
+    assert base != BatchKey("flux.json", (), None, "", 0, "", ("x", 0))
@@ -0,0 +1,186 @@
+import asyncio
+
+import pytest
+
+from src.socket import comfyui_client
+from src.socket.comfyui_client import ComfyuiClient, ComfyuiStallError
+from tests.fake_comfyui import FakeComfyui, PNG_1X1
+
+
+async def _started(server: FakeComfyui) -> FakeComfyui:
+    await server.start()
+    return server
+
+
+def test_routes_concurrent_prompts_by_prompt_id():
+    async def scenario():
+        server = await _started(FakeComfyui())
+        client = ComfyuiClient(server.address)
+        await client.connect()
+        try:
+            futures = [await client.submit({"1": {"class_type": "KSampler", "inputs": {"seed": i}}})
+                       for i in range(3)]
+            results = await asyncio.wait_for(asyncio.gather(*futures), 5)
+        finally:
+            await client.close()
+            await server.stop()
+
+        assert len({result.promptID for result in results}) == 3
+        for result in results:
+            assert server.prompts[result.promptID]
+            (image,) = result.images["9"]
+            assert image.filename == f"{result.promptID}.png"
+            assert image.data == PNG_1X1
+
+    asyncio.run(scenario())
+
+
+def test_replays_messages_that_arrive_before_prompt_id():
+    async def scenario():
+        server = await _started(FakeComfyui())
+        # 整个执行过程的websocket消息都先于 /prompt 的HTTP响应到达
+        server.beforeResponse = FakeComfyui.complete
+        client = ComfyuiClient(server.address)
+        await client.connect()
+        try:
+            result = await asyncio.wait_for(await client.submit({}), 5)
+        finally:
+            await client.close()
+            await server.stop()
+
+        assert result.promptID in server.history
+        assert result.timing.startedAt and result.timing.finishedAt
+        assert not client._orphans
+
+    asyncio.run(scenario())
+
+
+def test_interrupts_stalled_prompt(monkeypatch):
+    monkeypatch.setattr(comfyui_client, "_WATCHDOG_INTERVAL", 0.05)
+
+    async def scenario():
+        server = await _started(FakeComfyui())
+        server.behavior = FakeComfyui.hang
+        client = ComfyuiClient(server.address, nodeStallTimeout=0.2)
+        await client.connect()
+        try:
+            future = await client.submit({})
+            with pytest.raises(ComfyuiStallError) as e:
+                await asyncio.wait_for(future, 5)
+        finally:
+            await client.close()
+            await server.stop()
+
+        assert e.value.nodeID == "3"
+        assert server.interrupts == [e.value.promptID]
+
+    asyncio.run(scenario())
+
+
+def test_fails_prompt_lost_by_restarted_backend():
+    async def scenario():
+        server = await _started(FakeComfyui())
+        server.behavior = FakeComfyui.hang
+        client = ComfyuiClient(server.address, reconnectInitialDelay=0.05, reconnectMaxDelay=0.05)
+        await client.connect()
+        try:
+            future = await client.submit({})
+            await server.restart()
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(future, 5)
+            assert client.connected
+            assert client.inflight() == 0
+        finally:
+            await client.close()
+            await server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_keeps_queued_prompt_across_reconnect():
+    async def scenario():
+        server = await _started(FakeComfyui())
+        server.behavior = FakeComfyui.hang
+        client = ComfyuiClient(server.address, reconnectInitialDelay=0.05, reconnectMaxDelay=0.05)
+        await client.connect()
+        try:
+            future = await client.submit({})
+            (promptID,) = server.prompts
+            server.dropWebsockets()
+            while not (server._websockets and client.connected):
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.2)  # 等待重连后的核对完成
+            assert not future.done()
+            # 重连后prompt继续执行并完成
+            await FakeComfyui.complete(server, promptID)
+            result = await asyncio.wait_for(future, 5)
+        finally:
+            await client.close()
+            await server.stop()
+
+        assert result.promptID == promptID
+
+    asyncio.run(scenario())
+
+
+def test_fails_queued_prompt_missing_from_queue(monkeypatch):
+    monkeypatch.setattr(comfyui_client, "_WATCHDOG_INTERVAL", 0.05)
+
+    async def scenario():
+        server = await _started(FakeComfyui())
+        server.behavior = FakeComfyui.lose
+        client = ComfyuiClient(server.address, nodeStallTimeout=0.2)
+        await client.connect()
+        try:
+            future = await client.submit({})
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(future, 5)
+        finally:
+            await client.close()
+            await server.stop()
+
+        assert not server.interrupts
+
+    asyncio.run(scenario())
+
+
+def test_stall_timeout_applies_when_execution_start_was_missed(monkeypatch):
+    monkeypatch.setattr(comfyui_client, "_WATCHDOG_INTERVAL", 0.05)
+
+    async def scenario():
+        server = await _started(FakeComfyui())
+        server.behavior = FakeComfyui.silent
+        client = ComfyuiClient(server.address, nodeStallTimeout=0.2)
+        await client.connect()
+        try:
+            future = await client.submit({})
+            with pytest.raises(ComfyuiStallError) as e:
+                await asyncio.wait_for(future, 5)
+        finally:
+            await client.close()
+            await server.stop()
+
+        assert server.interrupts == [e.value.promptID]
+
+    asyncio.run(scenario())
+
+
+def test_identical_downloads_get_separate_files(tmp_path):
+    async def scenario():
+        server = await _started(FakeComfyui())
+        client = ComfyuiClient(server.address)
+        await client.connect()
+        try:
+            return await asyncio.gather(*[client.getImage("same.png", "", "output", str(tmp_path))
+                                          for _ in range(4)])
+        finally:
+            await client.close()
+            await server.stop()
+
+    images = asyncio.run(scenario())
+
+    assert len({image.path for image in images}) == 4
+    assert len({image.sha256 for image in images}) == 1
+    images[0].discard()
+    for image in images[1:]:
+        assert image.read() == PNG_1X1
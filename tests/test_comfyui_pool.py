@@ -0,0 +1,86 @@
+import asyncio
+from typing import List
+
+from src.socket import comfyui_client
+from src.socket.comfyui_pool import ComfyuiPool
+from tests.fake_comfyui import FakeComfyui
+
+_CLIENT_OPTIONS = {"reconnectAttempts": 1, "reconnectInitialDelay": 0.05, "reconnectMaxDelay": 0.05}
+
+
+async def _startAll(servers: List[FakeComfyui]) -> ComfyuiPool:
+    for server in servers:
+        await server.start()
+    pool = ComfyuiPool([(server.address, []) for server in servers], pollInterval=60, **_CLIENT_OPTIONS)
+    await pool.connect()
+    return pool
+
+
+async def _stopAll(pool: ComfyuiPool, servers: List[FakeComfyui]):
+    await pool.close()
+    for server in servers:
+        await server.stop()
+
+
+async def _waitFor(predicate, timeout: float = 5.0):
+    async def _poll():
+        while not predicate():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(_poll(), timeout)
+
+
+def test_dispatches_to_least_loaded_backend():
+    async def scenario():
+        busy, idle = FakeComfyui(queueDepth=3), FakeComfyui(queueDepth=0)
+        pool = await _startAll([busy, idle])
+        try:
+            result = await asyncio.wait_for(await pool.submit({}), 5)
+        finally:
+            await _stopAll(pool, [busy, idle])
+
+        assert result.promptID in idle.prompts
+        assert not busy.prompts
+
+    asyncio.run(scenario())
+
+
+def test_requeues_prompt_when_backend_dies():
+    async def scenario():
+        dying, spare = FakeComfyui(queueDepth=0), FakeComfyui(queueDepth=5)
+        dying.behavior = FakeComfyui.hang
+        pool = await _startAll([dying, spare])
+        try:
+            future = await pool.submit({"1": {"class_type": "KSampler", "inputs": {}}})
+            await _waitFor(lambda: dying.prompts)
+            await dying.stop()
+            result = await asyncio.wait_for(future, 5)
+        finally:
+            await _stopAll(pool, [dying, spare])
+
+        assert result.promptID in spare.prompts
+        assert list(spare.prompts.values()) == list(dying.prompts.values())
+
+    asyncio.run(scenario())
+
+
+def test_requeues_stalled_prompt_on_another_backend(monkeypatch):
+    monkeypatch.setattr(comfyui_client, "_WATCHDOG_INTERVAL", 0.05)
+
+    async def scenario():
+        stalled, spare = FakeComfyui(queueDepth=0), FakeComfyui(queueDepth=5)
+        stalled.behavior = FakeComfyui.hang
+        for server in (stalled, spare):
+            await server.start()
+        pool = ComfyuiPool([(stalled.address, []), (spare.address, [])], pollInterval=60, maxStallAttempts=1,
+                           nodeStallTimeout=0.2, **_CLIENT_OPTIONS)
+        await pool.connect()
+        try:
+            result = await asyncio.wait_for(await pool.submit({}), 5)
+        finally:
+            await _stopAll(pool, [stalled, spare])
+
+        assert stalled.interrupts == list(stalled.prompts)
+        assert result.promptID in spare.prompts
+
+    asyncio.run(scenario())
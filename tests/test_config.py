@@ -0,0 +1,13 @@
+import pytest
+from pydantic import ValidationError
+
+from src.config import Configuration
+
+
+def test_output_codec_is_normalized():
+    assert Configuration.model_validate({"comfyui": {"output_codec": "PassThrough"}}).comfyui.output_codec == "passthrough"
+
+
+def test_unknown_output_codec_is_rejected():
+    with pytest.raises(ValidationError):
+        Configuration.model_validate({"comfyui": {"output_codec": "png"}})
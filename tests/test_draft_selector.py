@@ -0,0 +1,42 @@
+import pytest
+
+from src.mode_parser.draft_selector import applyDraft
+from src.utils.workflow import WorkFlowParser
+
+
+def _workflow(samplerID: str, steps: int) -> dict:
+    return {
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}},
+        samplerID: {"class_type": "KSampler",
+                    "inputs": {"seed": 0, "steps": steps, "model": ["4", 0], "latent_image": ["5", 0]}},
+    }
+
+
+def _parser(workFlow: dict) -> WorkFlowParser:
+    wfp = WorkFlowParser()
+    wfp.loadWorkFlowDict(workFlow)
+    return wfp
+
+
+def test_final_workflow_reuses_draft_seed_and_batch_position():
+    draft = _parser(_workflow("3", 8))
+    draft.setNodeInputs("seed", {"3": 123456})
+    seeds = draft.getNodeInputs("seed")
+
+    final = _parser(_workflow("3", 30))
+    assert applyDraft(final, seeds, 4, 2) == ["3"]
+
+    workFlow = final.getWorkFlowDict()
+    assert workFlow["3"]["inputs"]["seed"] == 123456
+    assert workFlow["5"]["inputs"]["batch_size"] == 4
+    (latentID,) = [nodeID for nodeID, node in workFlow.items() if node["class_type"] == "LatentFromBatch"]
+    assert workFlow[latentID]["inputs"]["batch_index"] == 2
+    assert workFlow["3"]["inputs"]["latent_image"] == [latentID, 0]
+
+
+def test_final_workflow_without_draft_sampler_is_rejected():
+    final = _parser(_workflow("13", 30))
+
+    with pytest.raises(ValueError):
+        applyDraft(final, {"3": 123456}, 4, 2)
@@ -0,0 +1,31 @@
+import pytest
+
+from src.utils import hasher
+from src.utils.hasher import deriveSeed
+
+
+@pytest.fixture(autouse=True)
+def _salt(monkeypatch):
+    monkeypatch.setattr(hasher, "_SALT", "salt-a")
+
+
+def test_derive_seed_is_deterministic():
+    assert deriveSeed("x", 0, 3, 1) == deriveSeed("x", 0, 3, 1)
+
+
+def test_derive_seed_depends_on_every_part():
+    seeds = {deriveSeed("x", 0, 0, 0), deriveSeed("y", 0, 0, 0), deriveSeed("x", 1, 0, 0),
+             deriveSeed("x", 0, 1, 0), deriveSeed("x", 0, 0, 1)}
+
+    assert len(seeds) == 5
+
+
+def test_derive_seed_changes_with_salt():
+    before = deriveSeed("x", 0, 0)
+    hasher.setSalt("salt-b")
+
+    assert deriveSeed("x", 0, 0) != before
+
+
+def test_derive_seed_fits_in_63_bits():
+    assert all(0 <= deriveSeed("x", 0, i) < 2 ** 63 for i in range(100))
@@ -0,0 +1,66 @@
+from typing import List
+
+import pytest
+
+from src.mode_parser.order_graph import buildChains, groupChainsByModelSet, runChains
+from src.mode_parser.upload_block import Order, UploadInfo
+
+
+def _orders(count: int) -> List[Order]:
+    return [Order(UploadInfo(i)) for i in range(count)]
+
+
+def _indexes(orders: List[Order]) -> List[int]:
+    return [order.ui._uploadIndex for order in orders]
+
+
+def test_build_chains_follows_depends_on():
+    orders = _orders(4)
+    orders[2].dependsOn = orders[1]
+    orders[3].dependsOn = orders[2]
+
+    assert [_indexes(chain) for chain in buildChains(orders)] == [[0], [1, 2, 3]]
+
+
+def test_group_chains_by_model_set_keeps_chains_in_order():
+    orders = _orders(4)
+    orders[2].dependsOn = orders[1]
+    models = {0: ("a",), 1: ("b",), 2: ("a",), 3: ("a",)}
+
+    scheduled = groupChainsByModelSet(orders, lambda order: models[order.ui._uploadIndex], loaded=("b",))
+
+    assert _indexes(scheduled) == [1, 2, 0, 3]
+
+
+def test_run_chains_stops_after_first_failure():
+    orders = _orders(4)
+    started: List[int] = []
+
+    def _run(order: Order):
+        started.append(order.ui._uploadIndex)
+        if order.ui._uploadIndex == 0:
+            raise SystemExit(1)
+
+    with pytest.raises(SystemExit):
+        runChains(orders, _run, 1)
+
+    assert started == [0]
+    assert all(order.finished.is_set() for order in orders)
+
+
+def test_run_chains_skips_rest_of_failed_chain():
+    orders = _orders(3)
+    orders[1].dependsOn = orders[0]
+    orders[2].dependsOn = orders[1]
+    started: List[int] = []
+
+    def _run(order: Order):
+        started.append(order.ui._uploadIndex)
+        if order.ui._uploadIndex == 1:
+            raise RuntimeError("upload failed")
+
+    with pytest.raises(RuntimeError):
+        runChains(orders, _run, 2)
+
+    assert started == [0, 1]
+    assert orders[2].finished.is_set()
@@ -0,0 +1,41 @@
+from src.aigc.prompt_extractor import extractPositiveTags, parsePromptWeights
+
+
+def test_parse_prompt_weights():
+    assert parsePromptWeights(r"(a), [b], (c:1.3), ((d)), \(e\), f, BREAK, a") == [
+        ("a", 1.1), ("b", 0.9091), ("c", 1.3), ("d", 1.21), ("(e)", 1.0), ("f", 1.0)]
+
+
+def test_parse_prompt_weights_closes_unbalanced_group():
+    assert parsePromptWeights("masterpiece, (cat") == [("masterpiece", 1.0), ("cat", 1.1)]
+
+
+def _text(text: str, clip: str = "4") -> dict:
+    return {"class_type": "CLIPTextEncode", "inputs": {"text": text, "clip": [clip, 1]}}
+
+
+def test_extracts_only_positive_prompt():
+    graph = {
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "6": _text("masterpiece, (cat:1.2)"),
+        "7": _text("lowres, bad hands"),
+        "3": {"class_type": "KSampler", "inputs": {"seed": 1, "model": ["4", 0],
+                                                   "positive": ["6", 0], "negative": ["7", 0]}},
+    }
+
+    assert extractPositiveTags(graph) == [("masterpiece", 1.0), ("cat", 1.2)]
+
+
+def test_follows_positive_side_of_controlnet_and_primitive_strings():
+    graph = {
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "model.safetensors"}},
+        "10": {"class_type": "PrimitiveString", "inputs": {"value": "1girl, smile"}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": ["10", 0], "clip": ["4", 1]}},
+        "7": _text("lowres"),
+        "11": {"class_type": "ControlNetApplyAdvanced",
+               "inputs": {"positive": ["6", 0], "negative": ["7", 0], "strength": 1.0}},
+        "3": {"class_type": "KSampler", "inputs": {"seed": 1, "model": ["4", 0],
+                                                   "positive": ["11", 0], "negative": ["11", 1]}},
+    }
+
+    assert extractPositiveTags(graph) == [("1girl", 1.0), ("smile", 1.0)]
@@ -0,0 +1,54 @@
+import os
+
+from src.mode_parser.result_cache import ResultCache, workflowKey
+
+
+def _image(path, content: bytes) -> str:
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_workflow_key_is_canonical():
+    assert workflowKey({"b": 1, "a": {"y": 2, "x": 1}}) == workflowKey('{"a": {"x": 1, "y": 2}, "b": 1}')
+    assert workflowKey({"seed": 1}) != workflowKey({"seed": 2})
+
+
+def test_put_and_get_copy_outputs(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), 0, 0)
+    outputs = [_image(tmp_path / "a.png", b"first"), _image(tmp_path / "b.png", b"second")]
+    cache.put("key", outputs)
+    saveDir = tmp_path / "out"
+    saveDir.mkdir()
+
+    paths = cache.get("key", str(saveDir))
+
+    assert [open(path, "rb").read() for path in paths] == [b"first", b"second"]
+    assert all(os.path.dirname(path) == str(saveDir) for path in paths)
+    assert cache.get("other", str(saveDir)) is None
+
+
+def test_index_survives_reopen(tmp_path):
+    ResultCache(str(tmp_path / "cache"), 0, 0).put("key", [_image(tmp_path / "a.png", b"first")])
+
+    (path,) = ResultCache(str(tmp_path / "cache"), 0, 0).get("key", str(tmp_path))
+
+    assert open(path, "rb").read() == b"first"
+
+
+def test_missing_object_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), 0, 0)
+    cache.put("key", [_image(tmp_path / "a.png", b"first")])
+    for name in os.listdir(tmp_path / "cache" / "objects"):
+        os.remove(tmp_path / "cache" / "objects" / name)
+
+    assert cache.get("key", str(tmp_path)) is None
+
+
+def test_evicts_least_recently_used_over_size_limit(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), 10, 0)
+    cache.put("old", [_image(tmp_path / "a.png", b"123456")])
+    cache.put("new", [_image(tmp_path / "b.png", b"abcdef")])
+
+    assert cache.get("old", str(tmp_path)) is None
+    assert cache.get("new", str(tmp_path)) is not None
+    assert len(os.listdir(tmp_path / "cache" / "objects")) == 1
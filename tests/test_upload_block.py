@@ -0,0 +1,76 @@
+from src.mode_parser.upload_block import Order, UploadInfo, linkDependencies
+
+
+def _ui(index: int = 0, number: int = 4) -> UploadInfo:
+    ui = UploadInfo(index)
+    ui.workflowName = "flux.json"
+    ui.number = number
+    ui.batch = 2
+    return ui
+
+
+def test_sweep_grid_varies_last_parameter_fastest():
+    ui = _ui()
+    ui.workflowSweep = {"3": {"cfg": [5, 7]}, "LoRA": {"strength_model": [0.5, 1.0]}}
+
+    assert ui.sweepVariants() == [
+        {"3": {"cfg": 5}, "LoRA": {"strength_model": 0.5}},
+        {"3": {"cfg": 5}, "LoRA": {"strength_model": 1.0}},
+        {"3": {"cfg": 7}, "LoRA": {"strength_model": 0.5}},
+        {"3": {"cfg": 7}, "LoRA": {"strength_model": 1.0}},
+    ]
+
+
+def test_sweep_list_pairs_values_by_position():
+    ui = _ui()
+    ui.workflowSweepMode = "list"
+    ui.workflowSweep = {"3": {"cfg": [5, 7], "steps": [20, 30]}}
+
+    assert ui.sweepVariants() == [{"3": {"cfg": 5, "steps": 20}}, {"3": {"cfg": 7, "steps": 30}}]
+
+
+def test_sweep_list_requires_equal_lengths():
+    ui = _ui()
+    ui.workflowSweepMode = "list"
+    ui.workflowSweep = {"3": {"cfg": [5, 7], "steps": [20]}}
+
+    assert not ui._checkSweep()
+
+
+def test_sweep_needs_at_least_one_image_per_variant():
+    ui = _ui(number=1)
+    ui.workflowSweep = {"3": {"cfg": [5, 7]}}
+
+    assert not ui._checkSweep()
+
+
+def test_images_are_spread_over_sweep_variants():
+    ui = _ui(number=5)
+    ui.workflowSweep = {"3": {"cfg": [5, 7]}}
+    images = Order(ui).getImages()
+
+    assert [image.params["3"]["cfg"] for image in images] == [5, 5, 5, 7, 7]
+    assert [image.sweepIndex for image in images] == [0, 1, 2, 0, 1]
+
+
+def test_without_sweep_images_have_no_params():
+    images = Order(_ui()).getImages()
+
+    assert [image.params for image in images] == [{}] * 4
+
+
+def test_draft_number_defaults_to_oversampling():
+    ui = _ui(number=3)
+    assert ui.draftNumber() == 6
+    ui.workflowDraftNumber = 4
+    assert ui.draftNumber() == 4
+
+
+def test_link_dependencies_counts_images_by_script_position():
+    orders = [Order(_ui(i, number)) for i, number in enumerate((2, 3, 1))]
+    orders[2].ui.targetCaption = "see %url%"
+
+    linkDependencies(orders)
+
+    assert [order.imagesBefore for order in orders] == [0, 2, 5]
+    assert [order.dependsOn for order in orders] == [None, None, orders[1]]
@@ -0,0 +1,112 @@
+import json
+import os
+
+from src.utils.workflow import WorkflowCache, WorkflowTemplate, WorkFlowParser
+
+
+def _workFlow() -> dict:
+    return {
+        "3": {"class_type": "KSampler", "inputs": {"seed": 0, "steps": 20, "latent_image": ["5", 0]},
+              "_meta": {"title": "Base"}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "%prompt%, cat"}, "_meta": {"title": "Positive"}},
+        "9": {"class_type": "SaveImage", "inputs": {"images": ["8", 0], "filename_prefix": "%name%"}},
+    }
+
+
+def _parser(template: WorkflowTemplate) -> WorkFlowParser:
+    wfp = WorkFlowParser()
+    wfp.loadTemplate(template)
+    return wfp
+
+
+def test_template_records_indexed_keys_and_placeholders():
+    template = WorkflowTemplate(_workFlow())
+
+    assert template.paths["seed"] == [("3", "inputs", "seed")]
+    assert template.paths["batch_size"] == [("5", "inputs", "batch_size")]
+    assert sorted(template.placeholders) == [("6", "inputs", "text"), ("9", "inputs", "filename_prefix")]
+
+
+def test_patches_copy_on_write_without_touching_template():
+    template = WorkflowTemplate(_workFlow())
+    original = json.dumps(template.workFlow, sort_keys=True)
+
+    first, second = _parser(template), _parser(template)
+    first.setAllCustomKeyValue("seed", lambda: 42)
+    first.setNodeInputs("steps", {"3": 8})
+    first.setStrCustomKey("%prompt%", "masterpiece")
+
+    assert json.dumps(template.workFlow, sort_keys=True) == original
+    patched = first.getWorkFlowDict()
+    assert patched["3"]["inputs"] == {"seed": 42, "steps": 8, "latent_image": ["5", 0]}
+    assert patched["6"]["inputs"]["text"] == "masterpiece, cat"
+    # 未修改的节点与模板共享
+    assert patched["5"] is template.workFlow["5"]
+    assert second.getWorkFlowDict()["3"]["inputs"]["seed"] == 0
+
+
+def test_find_and_resolve_nodes():
+    wfp = _parser(WorkflowTemplate(_workFlow()))
+
+    assert wfp.findNodes("KSampler") == ["3"]
+    assert wfp.findNodes(inputKey="text") == ["6"]
+    assert wfp.findNodes("KSampler", inputKey="text") == []
+    assert wfp.resolveNodes("Positive") == ["6"]
+    assert wfp.resolveNodes("9") == ["9"]
+    assert wfp.resolveNodes("missing") == []
+
+
+def test_index_follows_structure_changes():
+    wfp = _parser(WorkflowTemplate(_workFlow()))
+
+    wfp.replaceNodeClass(["SaveImage"], "SaveImageWebsocket", {})
+    (latentID,) = wfp.insertLatentFromBatch(1)
+
+    assert wfp.findNodes("SaveImageWebsocket") == ["9"]
+    assert wfp.findNodes("SaveImage") == []
+    assert wfp.getWorkFlowDict()["3"]["inputs"]["latent_image"] == [latentID, 0]
+
+
+def test_getting_values_of_deep_keys_walks_the_workflow():
+    workFlow = _workFlow()
+    workFlow["10"] = {"class_type": "Custom", "inputs": {"options": {"seed": 7}}}
+    wfp = _parser(WorkflowTemplate(workFlow))
+
+    assert sorted(wfp.getAllCustomKeyValueType("seed", int)) == [0, 7]
+
+
+def test_workflow_cache_reuses_template_until_file_changes(tmp_path):
+    path = tmp_path / "flux.json"
+    path.write_text(json.dumps(_workFlow()), encoding="utf-8")
+    cache = WorkflowCache(4)
+
+    first = cache.get(str(path))
+    assert cache.get(str(path)) is first
+
+    changed = _workFlow()
+    changed["3"]["inputs"]["steps"] = 30
+    path.write_text(json.dumps(changed), encoding="utf-8")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+    reloaded = cache.get(str(path))
+    assert reloaded is not first
+    assert reloaded.workFlow["3"]["inputs"]["steps"] == 30
+
+
+def test_workflow_cache_evicts_least_recently_used(tmp_path):
+    paths = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}.json"
+        path.write_text(json.dumps(_workFlow()), encoding="utf-8")
+        paths.append(str(path))
+    cache = WorkflowCache(2)
+
+    a = cache.get(paths[0])
+    cache.get(paths[1])
+    cache.get(paths[0])
+    cache.get(paths[2])
+
+    assert cache.get(paths[0]) is a
+    assert [os.path.basename(path) for path in cache._entries] == ["c.json", "a.json"]